@@ -0,0 +1,394 @@
+"""Бэкенды генерации и выбор между ними.
+
+Бэкенд — модель (или провайдер) со своей ценой, ожидаемой длительностью
+генерации и возможностями: принимает ли он входные фото и сколько.
+Список задаётся GENERATION_BACKENDS (JSON), по умолчанию это одна
+google/nano-banana.
+
+Методы бэкенда блокирующие, как и клиент Replicate: create создаёт
+предсказание, get и cancel работают с ним по id. Бот вызывает их через
+call_replicate — в пуле потоков, с повторами и предохранителем.
+
+BackendRouter ведёт по каждому бэкенду скользящие p95 длительности и долю
+ошибок за последние минуты и выбирает основной бэкенд: самый дешёвый из
+тех, что не сильно медленнее самого быстрого. Если ответа нет дольше срока
+(HEDGE_AFTER или p95 основного), тот же запрос дублируется на следующий
+бэкенд — побеждает первый ответ, второе предсказание отменяется. Ошибка
+сервиса переводит запрос на следующий бэкенд. StubBackend — локальная
+модель для проверки маршрутизации без сети (bench/bench_router.py).
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from collections import deque
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+BACKEND_SECONDS = REGISTRY.histogram(
+    "bot_backend_seconds", "Генерация на бэкенде по исходу (ok, error, lost)", ("backend", "outcome")
+)
+BACKEND_ROUTED = REGISTRY.counter(
+    "bot_backend_routed_total", "Запуски генерации по бэкендам и роли (primary, hedge, fallback)", ("backend", "role")
+)
+
+class NoBackend(Exception):
+    """Ни один бэкенд не подходит для запроса"""
+
+
+class AttemptCanceled(Exception):
+    """Попытку на бэкенде отменили извне, а не маршрутизатор"""
+
+
+DEFAULT_BACKENDS = [{
+    "name": "nano-banana",
+    "model": "google/nano-banana",
+    "cost": 0.039,
+    "latency": 20,
+    "image_input": True,
+    "max_images": 4,
+}]
+
+
+class ReplicateBackend:
+    """Модель на Replicate: официальная (owner/name) или версия (owner/name:version)"""
+
+    kind = "replicate"
+
+    def __init__(self, name: str, model: str, client_factory, cost: float = 0.0, latency: float = 20.0,
+                 image_input: bool = True, max_images: int = 4, image_field: str = "image_input",
+                 input: dict = None):
+        self.name = name
+        self.model = model
+        self.cost = cost
+        self.latency = latency
+        self.image_input = image_input
+        self.max_images = max_images
+        self.image_field = image_field
+        self.input = input or {}
+        self._client_factory = client_factory
+
+    def build_input(self, prompt: str, images: list = None) -> dict:
+        """Входные данные модели: постоянные параметры бэкенда, описание и фото"""
+        data = dict(self.input, prompt=prompt)
+        if images and self.image_input:
+            images = images[:self.max_images]
+            data[self.image_field] = images if self.max_images > 1 else images[0]
+        return data
+
+    def create(self, input: dict, webhook: str = None):
+        params = {"webhook": webhook, "webhook_events_filter": ["completed"]} if webhook else {}
+        client = self._client_factory()
+        if ":" in self.model:
+            return client.predictions.create(version=self.model.split(":", 1)[1], input=input, **params)
+        return client.models.predictions.create(self.model, input=input, **params)
+
+    def get(self, prediction_id: str):
+        return self._client_factory().predictions.get(prediction_id)
+
+    def cancel(self, prediction_id: str):
+        return self._client_factory().predictions.cancel(prediction_id)
+
+    def check(self):
+        """Доступна ли модель (заодно загружается библиотека replicate)"""
+        return self._client_factory().models.get(self.model.split(":", 1)[0])
+
+
+class StubPrediction:
+    """Предсказание заглушки: те же поля, что у Prediction из replicate"""
+
+    __slots__ = ("id", "status", "output", "error", "created", "duration", "fails")
+
+    def __init__(self, duration: float, fails: bool):
+        self.id = uuid.uuid4().hex
+        self.status = "starting"
+        self.output = None
+        self.error = None
+        self.created = time.monotonic()
+        self.duration = duration
+        self.fails = fails
+
+
+class StubBackend:
+    """Локальный бэкенд без сети: длительность latency ± jitter, доля slow_rate
+    генераций в slow_factor раз дольше, доля error_rate завершается ошибкой.
+
+    Параметры можно менять на ходу — так бенчмарк изображает деградацию.
+    """
+
+    kind = "stub"
+
+    def __init__(self, name: str, cost: float = 0.0, latency: float = 1.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_factor: float = 5.0,
+                 image_input: bool = True, max_images: int = 4, output: str = None):
+        self.name = name
+        self.cost = cost
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.image_input = image_input
+        self.max_images = max_images
+        self.output = output
+        self._predictions = {}
+        self.created = 0
+        self.canceled = 0
+
+    def build_input(self, prompt: str, images: list = None) -> dict:
+        data = {"prompt": prompt}
+        if images and self.image_input:
+            data["image_input"] = images[:self.max_images]
+        return data
+
+    def create(self, input: dict, webhook: str = None):
+        duration = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if random.random() < self.slow_rate:
+            duration *= self.slow_factor
+        prediction = StubPrediction(duration, random.random() < self.error_rate)
+        self._predictions[prediction.id] = prediction
+        self.created += 1
+        return prediction
+
+    def get(self, prediction_id: str):
+        prediction = self._predictions[prediction_id]
+        if prediction.status in ("succeeded", "failed", "canceled"):
+            self._predictions.pop(prediction_id, None)
+            return prediction
+        elapsed = time.monotonic() - prediction.created
+        if elapsed >= prediction.duration:
+            if prediction.fails:
+                prediction.status, prediction.error = "failed", "stub model error"
+            else:
+                prediction.status = "succeeded"
+                prediction.output = [self.output or f"stub://{self.name}/{prediction.id}.png"]
+            self._predictions.pop(prediction_id, None)
+        elif elapsed >= min(0.1, prediction.duration / 2):
+            prediction.status = "processing"
+        return prediction
+
+    def cancel(self, prediction_id: str):
+        prediction = self._predictions.pop(prediction_id, None)
+        if prediction is not None and prediction.status in ("starting", "processing"):
+            prediction.status = "canceled"
+            self.canceled += 1
+        return prediction
+
+    def check(self):
+        return None
+
+
+def load_backends(config: str, client_factory) -> list:
+    """Бэкенды из JSON-списка GENERATION_BACKENDS (пустая строка — бэкенд по умолчанию)"""
+    entries = json.loads(config) if config and config.strip() else DEFAULT_BACKENDS
+    backends = []
+    for entry in entries:
+        entry = dict(entry)
+        kind = entry.pop("type", "replicate")
+        if kind == "stub":
+            backends.append(StubBackend(**entry))
+        elif kind == "replicate":
+            entry.setdefault("name", entry["model"].split("/")[-1].split(":")[0])
+            backends.append(ReplicateBackend(client_factory=client_factory, **entry))
+        else:
+            raise ValueError(f"неизвестный тип бэкенда: {kind}")
+    if not backends:
+        raise ValueError("не задано ни одного бэкенда генерации")
+    if len({backend.name for backend in backends}) != len(backends):
+        raise ValueError("имена бэкендов генерации повторяются")
+    return backends
+
+
+class BackendStats:
+    """Скользящая статистика бэкенда: исходы генераций за последние max_age секунд"""
+
+    __slots__ = ("samples", "max_age")
+
+    def __init__(self, window: int, max_age: float):
+        # (время, длительность, успех)
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+
+    def add(self, seconds: float, ok: bool):
+        self.samples.append((time.monotonic(), seconds, ok))
+
+    def _recent(self):
+        cutoff = time.monotonic() - self.max_age
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return self.samples
+
+    def count(self):
+        return len(self._recent())
+
+    def p95(self):
+        """p95 длительности успешных генераций или None, если их нет"""
+        durations = sorted(seconds for _, seconds, ok in self._recent() if ok)
+        if not durations:
+            return None
+        return durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+
+    def error_rate(self):
+        samples = self._recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+
+class BackendRouter:
+    """Выбор бэкенда, дублирование медленных запросов и переход на запасной.
+
+    hedge_after — срок до дублирования запроса (0 — p95 основного бэкенда);
+    max_hedge_ratio — какая доля запросов может дублироваться: дубль стоит
+    денег, и при общей деградации он только удвоил бы нагрузку.
+    """
+
+    def __init__(self, backends: list, hedge_after: float = 0.0, max_hedge_ratio: float = 0.1,
+                 latency_slack: float = 1.5, max_error_rate: float = 0.5, min_samples: int = 5,
+                 window: int = 100, max_age: float = 600.0):
+        self.backends = backends
+        self.hedge_after = hedge_after
+        self.max_hedge_ratio = max_hedge_ratio
+        self.latency_slack = latency_slack
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.stats = {backend.name: BackendStats(window, max_age) for backend in backends}
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def expected_latency(self, backend) -> float:
+        """Ожидаемая длительность с учётом повторов после ошибок"""
+        stats = self.stats[backend.name]
+        enough = stats.count() >= self.min_samples
+        p95 = stats.p95() if enough else None
+        error_rate = stats.error_rate() if enough else 0.0
+        return (p95 or backend.latency) / max(1.0 - error_rate, 0.05)
+
+    def candidates(self, images: int = 0) -> list:
+        """Бэкенды в порядке попыток: основной, затем запасные по ожидаемой длительности"""
+        backends = [b for b in self.backends if not images or (b.image_input and images <= b.max_images)]
+        if not backends:
+            # Фото больше, чем принимает любой бэкенд: лишние отбрасываются
+            backends = [b for b in self.backends if b.image_input] if images else []
+        healthy = [b for b in backends if not self._failing(b)] or backends
+        ordered = sorted(healthy, key=self.expected_latency)
+        if not ordered:
+            return []
+        fast_enough = self.expected_latency(ordered[0]) * self.latency_slack
+        primary = min(
+            (b for b in ordered if self.expected_latency(b) <= fast_enough), key=lambda b: b.cost
+        )
+        rest = [b for b in ordered if b is not primary]
+        # Неисправные — в самом конце: к ним переходим, только когда остальные не ответили
+        return [primary] + rest + [b for b in backends if b not in healthy]
+
+    def find(self, model: str):
+        """Бэкенд Replicate по имени модели из ответа API (owner/name) или None"""
+        for backend in self.backends:
+            if getattr(backend, "model", "").split(":", 1)[0] == model:
+                return backend
+        return None
+
+    def _failing(self, backend) -> bool:
+        stats = self.stats[backend.name]
+        return stats.count() >= self.min_samples and stats.error_rate() >= self.max_error_rate
+
+    def hedge_delay(self, backend) -> float:
+        """Через сколько секунд дублировать запрос к backend"""
+        if self.hedge_after > 0:
+            return self.hedge_after
+        stats = self.stats[backend.name]
+        p95 = stats.p95() if stats.count() >= self.min_samples else None
+        return p95 or backend.latency
+
+    def _may_hedge(self) -> bool:
+        return self.hedges < self.max_hedge_ratio * self.requests
+
+    def record(self, backend, seconds: float, outcome: str):
+        """Учёт генерации: ok, error или lost (отменена, проиграв дублю)"""
+        BACKEND_SECONDS.observe(seconds, backend=backend.name, outcome=outcome)
+        # Длительность проигравшего — лишь нижняя граница настоящей, и она всегда
+        # больше срока дублирования: в статистике она завышала бы p95. Замедление
+        # и так видно — дублируется не больше max_hedge_ratio запросов
+        if outcome != "lost":
+            self.stats[backend.name].add(seconds, outcome == "ok")
+
+    async def run(self, attempt, images: int = 0, fallback_on=lambda e: True):
+        """Результат attempt(backend) на первом ответившем бэкенде.
+
+        attempt — корутина генерации на бэкенде. Исключение, для которого
+        fallback_on ложно (отмена пользователем, отказ по содержанию), сразу
+        пробрасывается; остальные переводят запрос на следующий бэкенд.
+        """
+        candidates = self.candidates(images)
+        if not candidates:
+            raise NoBackend("ни один бэкенд не принимает входные фото")
+        self.requests += 1
+        running = {}
+        queue = list(candidates)
+        error = None
+        won = False
+
+        def launch(role: str):
+            backend = queue.pop(0)
+            BACKEND_ROUTED.inc(backend=backend.name, role=role)
+            task = asyncio.ensure_future(attempt(backend))
+            running[task] = (backend, time.monotonic(), role)
+            return backend
+
+        primary = launch("primary")
+        hedge_at = time.monotonic() + self.hedge_delay(primary)
+        try:
+            while running:
+                timeout = None
+                if queue and len(running) == 1 and hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Срок вышел: дублируем на следующий бэкенд, если это не слишком часто
+                    hedge_at = None
+                    if self._may_hedge():
+                        self.hedges += 1
+                        backend = launch("hedge")
+                        logger.info(f"⏱ {primary.name} не ответил за {self.hedge_delay(primary):.1f}с, "
+                                    f"дублируем на {backend.name}")
+                    continue
+
+                for task in done:
+                    backend, started, role = running.pop(task)
+                    seconds = time.monotonic() - started
+                    if task.cancelled():
+                        # Это не сбой бэкенда: в статистику не идёт, запрос переходит дальше
+                        error = AttemptCanceled(f"попытка на {backend.name} отменена")
+                        logger.warning(f"⚠️ {error}")
+                        continue
+                    if task.exception() is None:
+                        self.record(backend, seconds, "ok")
+                        won = True
+                        if role == "hedge":
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                    if not fallback_on(error):
+                        raise error
+                    self.record(backend, seconds, "error")
+                    logger.warning(f"⚠️ Бэкенд {backend.name} не справился: {error}")
+                if not running and queue:
+                    self.fallbacks += 1
+                    primary = launch("fallback")
+                    hedge_at = time.monotonic() + self.hedge_delay(primary)
+            raise error
+        finally:
+            # Ответил другой бэкенд или запрос отменён: остальные предсказания не нужны
+            for task, (backend, started, _) in running.items():
+                task.cancel()
+                if won:
+                    self.record(backend, time.monotonic() - started, "lost")
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
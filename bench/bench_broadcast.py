@@ -0,0 +1,144 @@
+"""Рассылка через ограничитель исходящих сообщений.
+
+Поднимает фейковый Bot API с лимитом сообщений в секунду (сверх него — 429)
+и долей пользователей, заблокировавших бота, наполняет базу пользователями
+и проводит рассылку бота. Посередине рассылка прерывается, как при
+перезапуске процесса, и продолжается с сохранённого курсора. Параллельно
+идут обычные ответы пользователям и подтверждения платежей — видно,
+сколько они ждут за массовой рассылкой.
+
+В отчёте: скорость рассылки, ответы 429, дубли и пропуски после
+возобновления, помеченные заблокированными, ожидание ответов по приоритетам.
+
+Запуск: python -m bench.bench_broadcast --users 1500 --rate 28 --flood-limit 30 --interrupt 10
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+from bench.loadtest import TOKEN, percentile  # noqa: E402
+
+# Чаты обычных ответов и платежей: вне диапазона пользователей рассылки
+INTERACTIVE_CHAT = 10 ** 9
+
+
+async def interactive_traffic(app, ratelimit, stop: asyncio.Event, waits: dict):
+    """Ответы пользователям (NORMAL) и подтверждения оплаты (HIGH) во время рассылки"""
+    chat = INTERACTIVE_CHAT
+    while not stop.is_set():
+        for name, priority in (("normal", ratelimit.NORMAL), ("high", ratelimit.HIGH)):
+            chat += 1
+            started = time.monotonic()
+            with ratelimit.send_priority(priority):
+                await app.bot.send_message(chat, f"ответ {name}")
+            waits[name].append(time.monotonic() - started)
+        await asyncio.sleep(0.25)
+
+
+async def run(args):
+    fake = FakeTelegram(args.telegram_latency, flood_limit=args.flood_limit)
+    user_ids = list(range(1, args.users + 1))
+    fake.blocked = {str(user_id) for user_id in random.sample(user_ids, int(args.users * args.blocked))}
+    await fake.start()
+
+    workdir = tempfile.mkdtemp(prefix="broadcast-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "RENDER_URL": "http://127.0.0.1:9",
+        "REPLICATE_API_TOKEN": "broadcast",
+        "TELEGRAM_API_URL": fake.base_url,
+        "DB_FILE": os.path.join(workdir, "bot.db"),
+        "TELEGRAM_RATE": str(args.rate),
+        "BROADCAST_CONCURRENCY": str(args.concurrency),
+    })
+    import bot
+    import ratelimit
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    app = bot.build_application()
+    await app.initialize()
+    await bot.db.open()
+    for user_id in user_ids:
+        await bot.db.get_user(user_id)
+    await bot.db.flush()
+
+    broadcast_id = await bot.db.create_broadcast(text="📣 Новости бота")
+    waits = {"normal": [], "high": []}
+    stop = asyncio.Event()
+    traffic = asyncio.create_task(interactive_traffic(app, ratelimit, stop, waits))
+
+    started = time.monotonic()
+    runs = 0
+    while True:
+        broadcast = await bot.db.claim_broadcast(bot.WORKER_NAME, bot.BROADCAST_LEASE)
+        if broadcast is None:
+            break
+        runs += 1
+        task = asyncio.create_task(bot.run_broadcast(app.bot, broadcast))
+        if runs == 1 and args.interrupt:
+            done, _ = await asyncio.wait({task}, timeout=args.interrupt)
+            if not done:
+                # Как остановка процесса: прогресс сохраняется, аренда снимается
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                print(f"⏹ Рассылка прервана через {args.interrupt:g}с, продолжаем с курсора")
+                continue
+        await task
+    elapsed = time.monotonic() - started
+    stop.set()
+    await traffic
+
+    latest = await bot.db.latest_broadcast()
+    blocked_marked = await bot.db._run(
+        bot.db._fetchone, "SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL"
+    )
+    deliveries = Counter(
+        user_id for user_id in user_ids
+        for method, _ in fake.chat_calls.get(str(user_id), ()) if method == "sendMessage"
+    )
+    reachable = [user_id for user_id in user_ids if str(user_id) not in fake.blocked]
+    missed = sum(1 for user_id in reachable if not deliveries[user_id])
+    duplicates = sum(count - 1 for count in deliveries.values() if count > 1)
+
+    print(f"\n📣 Рассылка #{broadcast_id}: {latest['status']}, запусков {runs}, {elapsed:.1f}с")
+    print(f"   отправлено {latest['sent']}, заблокировали {latest['blocked']}, ошибок {latest['failed']}")
+    print(f"   скорость {latest['sent'] / elapsed:.1f} сообщ./с при лимите {args.rate:g}/с")
+    print(f"   ответов 429: {fake.flood_errors}, RetryAfter в ограничителе: {bot.outbound_limiter.retry_afters}")
+    print(f"   не получили {missed} из {len(reachable)}, дублей {duplicates}, "
+          f"помечено заблокировавшими {blocked_marked[0]} из {len(fake.blocked)}")
+    for name, values in waits.items():
+        if values:
+            print(f"   ожидание {name}: p50 {percentile(values, 0.5) * 1000:.0f} мс, "
+                  f"p95 {percentile(values, 0.95) * 1000:.0f} мс ({len(values)} сообщений)")
+
+    await bot.db.close()
+    await app.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1500)
+    parser.add_argument("--blocked", type=float, default=0.1, help="доля заблокировавших бота")
+    parser.add_argument("--rate", type=float, default=28, help="TELEGRAM_RATE бота")
+    parser.add_argument("--flood-limit", type=int, default=30, help="лимит фейкового Bot API в секунду")
+    parser.add_argument("--concurrency", type=int, default=32, help="BROADCAST_CONCURRENCY")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--interrupt", type=float, default=10, help="прервать рассылку через столько секунд (0 — нет)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
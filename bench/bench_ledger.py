@@ -0,0 +1,107 @@
+"""Свёртка журнала транзакций и /history на большом журнале.
+
+Наполняет базу журналом за прошедший год (покупки и списания случайных
+пользователей), замеряет запрос истории пользователя, сворачивает строки
+старше срока хранения в итоги и архив и повторяет замер. В конце — сверка
+балансов всех пользователей со снимками и проверка файлов архива.
+
+Запуск: python -m bench.bench_ledger --rows 1000000 --users 5000 --retention-days 90
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage, verify_archive_file  # noqa: E402
+from bench.loadtest import percentile  # noqa: E402
+
+
+async def measure_history(db, users: int, requests: int):
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        await db.history(random.randint(1, users), 10)
+        latencies.append(time.perf_counter() - started)
+    return percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="ledger-")
+    db = Storage(os.path.join(workdir, "bot.db"))
+    await db.open()
+    for user_id in range(1, args.users + 1):
+        await db.get_user(user_id)
+    await db.flush()
+
+    # Журнал за год: строки равномерно по времени, каждая 50-я — покупка
+    started_at = datetime.now() - timedelta(days=365)
+    step = 365 * 86400 / args.rows
+
+    def seed():
+        rows, deltas = [], {}
+        for i in range(args.rows):
+            user_id = random.randint(1, args.users)
+            created_at = (started_at + timedelta(seconds=i * step)).isoformat()
+            if i % 50 == 0:
+                rows.append((user_id, "buy", 10, f"bench-{i}", created_at))
+            else:
+                rows.append((user_id, "spend", -1, None, created_at))
+            deltas[user_id] = deltas.get(user_id, 0) + rows[-1][2]
+        db._begin()
+        db._conn.executemany(
+            "INSERT INTO transactions (user_id, type, amount, payment_id, created_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        db._conn.executemany("UPDATE users SET balance = balance + ? WHERE id=?",
+                             [(delta, user_id) for user_id, delta in deltas.items()])
+        db._flush()
+
+    started = time.perf_counter()
+    await db._run(seed)
+    print(f"📥 Журнал: {args.rows} строк за {time.perf_counter() - started:.1f}с")
+
+    p50, p95 = await measure_history(db, args.users, args.requests)
+    print(f"🧾 /history до свёртки: p50 {p50:.2f} мс, p95 {p95:.2f} мс")
+
+    archive_dir = os.path.join(workdir, "archive")
+    started = time.perf_counter()
+    compacted, files = await db.compact_ledger(args.retention_days * 86400, archive_dir, batch=args.batch)
+    elapsed = time.perf_counter() - started
+    left = (await db._run(db._fetchone, "SELECT COUNT(*) FROM transactions"))[0]
+    size = sum(os.path.getsize(os.path.join(archive_dir, name)) for name in os.listdir(archive_dir))
+    print(f"🗜 Свёрнуто {compacted} строк в {files} файлов ({size / 1048576:.1f} МБ) за {elapsed:.1f}с "
+          f"({compacted / elapsed:.0f} строк/с), в журнале осталось {left}")
+
+    p50, p95 = await measure_history(db, args.users, args.requests)
+    print(f"🧾 /history после свёртки: p50 {p50:.2f} мс, p95 {p95:.2f} мс")
+
+    mismatched = 0
+    for user_id in range(1, args.users + 1):
+        if not (await db.verify_ledger(user_id))["ok"]:
+            mismatched += 1
+    archives = await db.ledger_archives()
+    broken = sum(
+        not verify_archive_file(os.path.join(archive_dir, name), sha256) for name, _, _, sha256 in archives
+    )
+    print(f"✅ Балансы не сходятся у {mismatched} из {args.users}, повреждённых файлов архива {broken}")
+    await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--retention-days", type=int, default=90, help="LEDGER_RETENTION_DAYS")
+    parser.add_argument("--batch", type=int, default=5000, help="строк в одном файле архива")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов истории в замере")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Маршрутизация генераций между бэкендами без сети.
+
+Два локальных бэкенда StubBackend: основной дешёвый и запасной вдвое
+дороже, но немного быстрее. Поток запросов проходит через BackendRouter
+по фазам: всё в порядке, основной бэкенд замедлился, восстановился,
+сбоит. Тот же поток прогоняется и без маршрутизации — только основной
+бэкенд, как было до появления бэкендов.
+
+В отчёте по каждой фазе: p50/p95/p99 от запроса до результата, доля
+неудач, дублированные запросы и переходы на запасной, доля ответов
+каждого бэкенда и стоимость одного результата (все созданные
+предсказания, включая отменённые дубли).
+
+Запуск: python -m bench.bench_router --rate 20 --phase 15 --latency 1.0
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backends import BackendRouter, StubBackend  # noqa: E402
+from bench.loadtest import percentile  # noqa: E402
+
+TERMINAL = ("succeeded", "failed", "canceled")
+
+# Фаза: название и параметры основного бэкенда (latency — множитель)
+PHASES = (
+    ("норма", {}),
+    ("основной замедлился в 3 раза", {"latency": 3}),
+    ("основной восстановился", {}),
+    ("основной сбоит в 60% запросов", {"error_rate": 0.6}),
+)
+
+
+class StubFailure(Exception):
+    pass
+
+
+async def attempt(backend, poll: float):
+    """Генерация на заглушке так же, как в боте: создание и опрос до завершения"""
+    prediction = backend.create({"prompt": "bench"})
+    try:
+        while prediction.status not in TERMINAL:
+            await asyncio.sleep(poll)
+            prediction = backend.get(prediction.id)
+    except asyncio.CancelledError:
+        # Ответил другой бэкенд
+        backend.cancel(prediction.id)
+        raise
+    if prediction.status != "succeeded":
+        raise StubFailure(prediction.error)
+    return backend.name
+
+
+def make_router(args, routed: bool):
+    primary = StubBackend("primary", cost=0.02, latency=args.latency, jitter=args.latency * 0.3,
+                          slow_rate=args.slow_rate, slow_factor=4)
+    backends = [primary]
+    if routed:
+        backends.append(StubBackend("fallback", cost=0.04, latency=args.latency * 0.8,
+                                    jitter=args.latency * 0.2, slow_rate=args.slow_rate, slow_factor=4))
+    return BackendRouter(backends, args.hedge_after, args.hedge_ratio, max_age=args.max_age), primary
+
+
+async def run_phase(router, args):
+    latencies, winners = [], Counter()
+    failures = 0
+    created = {backend.name: backend.created for backend in router.backends}
+    hedges, fallbacks = router.hedges, router.fallbacks
+
+    async def one():
+        nonlocal failures
+        started = time.monotonic()
+        try:
+            winners[await router.run(lambda backend: attempt(backend, args.poll))] += 1
+            latencies.append(time.monotonic() - started)
+        except StubFailure:
+            failures += 1
+
+    tasks = []
+    deadline = time.monotonic() + args.phase
+    while time.monotonic() < deadline:
+        tasks.append(asyncio.create_task(one()))
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+
+    cost = sum((backend.created - created[backend.name]) * backend.cost for backend in router.backends)
+    return {
+        "requests": len(tasks),
+        "latencies": latencies,
+        "failures": failures,
+        "winners": winners,
+        "cost": cost,
+        "hedges": router.hedges - hedges,
+        "fallbacks": router.fallbacks - fallbacks,
+    }
+
+
+def report(name: str, result: dict):
+    latencies = result["latencies"]
+    delivered = len(latencies)
+    share = ", ".join(f"{backend} {count / max(delivered, 1):.0%}"
+                      for backend, count in sorted(result["winners"].items()))
+    print(f"   {name:<14} p50 {percentile(latencies, 0.5):5.2f}с  p95 {percentile(latencies, 0.95):5.2f}с  "
+          f"p99 {percentile(latencies, 0.99):5.2f}с  неудач {result['failures'] / result['requests']:4.0%}  "
+          f"дублей {result['hedges']:3}  запасной {result['fallbacks']:3}  "
+          f"${result['cost'] / max(delivered, 1):.4f}/результат  ({share})")
+
+
+async def run(args):
+    modes = {"маршрутизация": make_router(args, True), "только основной": make_router(args, False)}
+    for phase, changes in PHASES:
+        print(f"\n🧭 Фаза «{phase}», {args.phase:g}с при {args.rate:g} запросах/с")
+        for router, primary in modes.values():
+            primary.latency = args.latency * changes.get("latency", 1)
+            primary.jitter = primary.latency * 0.3
+            primary.error_rate = changes.get("error_rate", 0.0)
+        # Режимы идут одновременно: одна и та же фаза для обоих
+        outcomes = await asyncio.gather(*(run_phase(router, args) for router, _ in modes.values()))
+        results = dict(zip(modes, outcomes))
+        for name, result in results.items():
+            report(name, result)
+        router = modes["маршрутизация"][0]
+        states = []
+        for backend in router.backends:
+            stats = router.stats[backend.name]
+            p95 = stats.p95()
+            states.append(f"{backend.name} p95 {f'{p95:.2f}с' if p95 is not None else '—'} "
+                          f"ошибок {stats.error_rate():.0%} из {stats.count()}")
+        print(f"   основной после фазы: {router.candidates()[0].name}; " + ", ".join(states))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20, help="запросов в секунду")
+    parser.add_argument("--phase", type=float, default=15, help="длительность фазы, с")
+    parser.add_argument("--latency", type=float, default=1.0, help="длительность генерации основного бэкенда, с")
+    parser.add_argument("--slow-rate", type=float, default=0.03, help="доля генераций вчетверо дольше обычного")
+    parser.add_argument("--hedge-after", type=float, default=0, help="HEDGE_AFTER (0 — p95 бэкенда)")
+    parser.add_argument("--hedge-ratio", type=float, default=0.1, help="HEDGE_MAX_RATIO")
+    parser.add_argument("--max-age", type=float, default=10,
+                        help="сколько секунд помнить исходы генераций (в боте — 600)")
+    parser.add_argument("--poll", type=float, default=0.05, help="период опроса предсказания, с")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
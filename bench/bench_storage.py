@@ -0,0 +1,120 @@
+"""Сравнение хранилища с прежним подходом «новое соединение на каждый запрос».
+
+Нагрузка повторяет то, что делает бот: на одну генерацию приходится
+get_user, а каждая пятая операция — списание через update_balance.
+
+Запуск: python -m bench.bench_storage --ops 5000 --users 500
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import SCHEMA, Storage  # noqa: E402
+
+
+# ---------- прежняя реализация из bot.py ----------
+
+def legacy_init(path):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_user(path, user_id):
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("SELECT id, balance FROM users WHERE id=?", (user_id,))
+    row = cur.fetchone()
+    if not row:
+        cur.execute(
+            "INSERT INTO users (id, balance, created_at) VALUES (?, ?, ?)",
+            (user_id, 3, datetime.now().isoformat()),
+        )
+        conn.commit()
+        balance = 3
+    else:
+        balance = row[1]
+    conn.close()
+    return balance
+
+
+def legacy_update_balance(path, user_id, delta, tx_type):
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
+    cur.execute(
+        "INSERT INTO transactions (user_id, type, amount, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, tx_type, delta, datetime.now().isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+
+def workload(ops, users, seed=1):
+    rnd = random.Random(seed)
+    return [("spend" if i % 5 == 4 else "get", rnd.randrange(users)) for i in range(ops)]
+
+
+async def bench_legacy(path, plan):
+    """Прежний код, как он работал: синхронно прямо в событийном цикле"""
+    legacy_init(path)
+    started = time.perf_counter()
+    for op, user_id in plan:
+        if op == "get":
+            legacy_get_user(path, user_id)
+        else:
+            legacy_update_balance(path, user_id, -1, "spend")
+        await asyncio.sleep(0)
+    return time.perf_counter() - started
+
+
+async def bench_storage(path, plan, concurrency):
+    storage = Storage(path)
+    await storage.open()
+    queue = list(plan)
+
+    async def client():
+        while queue:
+            op, user_id = queue.pop()
+            if op == "get":
+                await storage.get_user(user_id)
+            else:
+                await storage.update_balance(user_id, -1, "spend")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await storage.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16, help="одновременных обработчиков для Storage")
+    args = parser.parse_args()
+
+    plan = workload(args.ops, args.users)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = asyncio.run(bench_legacy(os.path.join(tmp, "legacy.db"), plan))
+        pooled = asyncio.run(bench_storage(os.path.join(tmp, "storage.db"), plan, args.concurrency))
+
+    print(f"операций: {args.ops}, пользователей: {args.users}")
+    print(f"connect на каждый вызов: {args.ops / legacy:10.0f} оп/с  ({legacy:.2f}с)")
+    print(f"Storage (WAL, 1 соед.):  {args.ops / pooled:10.0f} оп/с  ({pooled:.2f}с)")
+    print(f"ускорение: x{legacy / pooled:.1f}")
+
+
+if __name__ == "__main__":
+    main()
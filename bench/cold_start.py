@@ -0,0 +1,110 @@
+"""Холодный старт bot.py: через сколько после запуска процесса открыт порт
+и отправлен ответ на первый апдейт.
+
+Запускает бота отдельным процессом против фейковых Bot API и Replicate
+с сетевыми задержками, шлёт /start, как только порт принимает соединения
+(так делает Telegram, повторяя доставку вебхука), и ждёт ответа.
+Замер повторяется несколько раз, в отчёте медианы и худшие значения.
+
+Запуск: python -m bench.cold_start --runs 5 --telegram-latency 0.15 --replicate-latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import ClientSession  # noqa: E402
+
+from bench.fake_replicate import FakeReplicate  # noqa: E402
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+from bench.loadtest import TOKEN, UpdateFactory, free_port  # noqa: E402
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+
+
+async def cold_start(args, fake_telegram: FakeTelegram, fake_replicate: FakeReplicate, user_id: int) -> dict:
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="cold-start-")
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "RENDER_URL": f"http://127.0.0.1:{port}",
+        "REPLICATE_API_TOKEN": "cold-start",
+        "REPLICATE_BASE_URL": fake_replicate.base_url,
+        "TELEGRAM_API_URL": fake_telegram.base_url,
+        "DB_FILE": os.path.join(workdir, "bot.db"),
+        "PORT": str(port),
+        "TRANSLATOR": "stub",
+    }
+    output = None if args.verbose else asyncio.subprocess.DEVNULL
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(sys.executable, BOT_PATH, env=env, stdout=output, stderr=output)
+
+    listening = replied = None
+    update = UpdateFactory().command(user_id, "/start")
+    async with ClientSession() as session:
+        while time.monotonic() - started < args.timeout:
+            try:
+                async with session.post(f"http://127.0.0.1:{port}/{TOKEN}", json=update) as response:
+                    await response.read()
+                    if response.status == 200:
+                        listening = time.monotonic() - started
+                        break
+            except OSError:
+                pass
+            await asyncio.sleep(0.01)
+
+        while listening and time.monotonic() - started < args.timeout:
+            calls = [at for method, at in fake_telegram.chat_calls.get(str(user_id), []) if method == "sendMessage"]
+            if calls:
+                replied = calls[0] - started
+                break
+            await asyncio.sleep(0.01)
+
+    process.terminate()
+    await process.wait()
+    return {"listening": listening, "first_reply": replied}
+
+
+def describe(values: list) -> str:
+    values = [v for v in values if v is not None]
+    if not values:
+        return "—"
+    return f"медиана {statistics.median(values):.2f}с, худший {max(values):.2f}с"
+
+
+async def run(args):
+    fake_telegram = FakeTelegram(args.telegram_latency)
+    fake_replicate = FakeReplicate(api_latency=args.replicate_latency)
+    await fake_telegram.start()
+    await fake_replicate.start()
+
+    results = []
+    for attempt in range(args.runs):
+        result = await cold_start(args, fake_telegram, fake_replicate, 5000 + attempt)
+        print(f"   запуск {attempt + 1}: порт {result['listening'] or 0:.2f}с, "
+              f"ответ {result['first_reply'] or 0:.2f}с")
+        results.append(result)
+
+    print(f"\n🚪 Порт открыт: {describe([r['listening'] for r in results])}")
+    print(f"💬 Ответ на первый апдейт: {describe([r['first_reply'] for r in results])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--telegram-latency", type=float, default=0.15, help="задержка ответа Bot API, с")
+    parser.add_argument("--replicate-latency", type=float, default=0.5, help="задержка ответа API Replicate, с")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--verbose", action="store_true", help="показывать вывод бота")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
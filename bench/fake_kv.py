@@ -0,0 +1,135 @@
+"""Локальная подмена key-value сервера (протокол RESP) для хранилища сессий.
+
+Понимает команды, которые использует sessions.KVSessionStore, и немного
+служебных: PING, AUTH, SELECT, GET, MGET, SET (с EX), MSET, DEL, DBSIZE,
+FLUSHDB. Данные живут в памяти процесса, истечение проверяется при чтении.
+
+Запуск: python -m bench.fake_kv --port 6390
+Бот подключается через SESSION_BACKEND=kv SESSION_KV_URL=redis://127.0.0.1:6390/0
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+
+class FakeKV:
+    """Состояние фейкового key-value сервера"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        # key → (значение, момент истечения или None)
+        self.data = {}
+        self.commands = Counter()
+        self.url = ""
+
+    def _get(self, key: bytes):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _execute(self, command: list):
+        name = command[0].upper().decode()
+        args = command[1:]
+        self.commands[name] += 1
+        if name in ("PING", "AUTH", "SELECT"):
+            return "+PONG" if name == "PING" else "+OK"
+        if name == "GET":
+            return self._get(args[0])
+        if name == "MGET":
+            return [self._get(key) for key in args]
+        if name == "SET":
+            expires = None
+            if len(args) >= 4 and args[2].upper() == b"EX":
+                expires = time.monotonic() + int(args[3])
+            self.data[args[0]] = (args[1], expires)
+            return "+OK"
+        if name == "MSET":
+            for key, value in zip(args[::2], args[1::2]):
+                self.data[key] = (value, None)
+            return "+OK"
+        if name == "DEL":
+            return sum(self.data.pop(key, None) is not None for key in args)
+        if name == "DBSIZE":
+            return len(self.data)
+        if name == "FLUSHDB":
+            self.data.clear()
+            return "+OK"
+        return f"-ERR unknown command '{name}'"
+
+    @classmethod
+    def _encode(cls, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, str):
+            return reply.encode() + b"\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(cls._encode(item) for item in reply)
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Инлайн-команда (например, из telnet)
+            return line.split()
+        command = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            command.append((await reader.readexactly(length + 2))[:-2])
+        return command
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                if not command:
+                    continue
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(self._encode(self._execute(command)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        """Запуск сервера в текущем цикле, возвращает asyncio.Server"""
+        server = await asyncio.start_server(self.handle, host, port)
+        actual_port = server.sockets[0].getsockname()[1]
+        self.url = f"redis://{host}:{actual_port}/0"
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    args = parser.parse_args()
+
+    fake = FakeKV(args.latency)
+
+    async def run():
+        server = await fake.start(args.host, args.port)
+        print(f"fake key-value сервер на {fake.url}")
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Локальная подмена API Replicate для тестов и нагрузочных прогонов.
+
+Поддерживает ровно то, что использует бот: создание предсказания официальной
+модели, получение и отмену предсказания, описание модели и отдачу картинок.
+Если при создании передан webhook, по завершении на него отправляется POST,
+подписанный, как это делает настоящий Replicate: ключ подписи отдаётся
+по GET /v1/webhooks/default/secret.
+
+Запуск: python -m bench.fake_replicate --port 8001 --latency 3 --error-rate 0.1
+Бот подключается через REPLICATE_BASE_URL=http://127.0.0.1:8001
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import ClientSession, web
+
+# Прозрачный PNG 1x1
+PNG_1X1 = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeReplicate:
+    """Состояние фейкового сервера"""
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 api_latency: float = 0.0):
+        self.latency = latency
+        # Задержка ответа на сам запрос к API (сеть до Replicate), не путать со временем генерации
+        self.api_latency = api_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.predictions = {}
+        self.webhooks = {}
+        self.canceled = 0
+        self.tasks = set()
+        self.created = 0
+        self.webhooks_sent = 0
+        self.base_url = ""
+        self.signing_key = "whsec_" + base64.b64encode(os.urandom(24)).decode()
+
+    def _prediction_json(self, prediction_id: str):
+        return self.predictions[prediction_id]
+
+    async def _complete(self, prediction_id: str, webhook: str):
+        prediction = self.predictions[prediction_id]
+        await asyncio.sleep(0.05)
+        if prediction["status"] == "canceled":
+            return
+        prediction["status"] = "processing"
+        prediction["started_at"] = _now()
+
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        await asyncio.sleep(delay)
+        if prediction["status"] == "canceled":
+            return
+
+        if random.random() < self.error_rate:
+            prediction["status"] = "failed"
+            prediction["error"] = "fake model error"
+        else:
+            prediction["status"] = "succeeded"
+            prediction["output"] = [f"{self.base_url}/images/{prediction_id}.png"]
+        prediction["completed_at"] = _now()
+
+        if webhook:
+            await self._send_webhook(webhook, prediction)
+
+    def _sign(self, webhook_id: str, timestamp: str, body: bytes) -> str:
+        secret = base64.b64decode(self.signing_key.removeprefix("whsec_"))
+        digest = hmac.new(secret, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+        return "v1," + base64.b64encode(digest).decode()
+
+    async def _send_webhook(self, webhook: str, prediction: dict):
+        body = json.dumps(prediction).encode()
+        webhook_id, timestamp = f"msg_{uuid.uuid4().hex}", str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "webhook-id": webhook_id,
+            "webhook-timestamp": timestamp,
+            "webhook-signature": self._sign(webhook_id, timestamp, body),
+        }
+        try:
+            async with ClientSession() as session:
+                async with session.post(webhook, data=body, headers=headers) as resp:
+                    await resp.read()
+            self.webhooks_sent += 1
+        except Exception as e:
+            print(f"webhook {webhook} failed: {e}")
+
+    async def create_prediction(self, request: web.Request):
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        body = await request.json()
+        owner, name = request.match_info["owner"], request.match_info["name"]
+        prediction_id = uuid.uuid4().hex
+        self.predictions[prediction_id] = {
+            "id": prediction_id,
+            "model": f"{owner}/{name}",
+            "version": "fake",
+            "status": "starting",
+            "input": body.get("input"),
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": _now(),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel",
+            },
+        }
+        self.created += 1
+        if body.get("webhook"):
+            self.webhooks[prediction_id] = body["webhook"]
+        task = asyncio.create_task(self._complete(prediction_id, body.get("webhook")))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.json_response(self.predictions[prediction_id], status=201)
+
+    async def get_prediction(self, request: web.Request):
+        prediction_id = request.match_info["id"]
+        if prediction_id not in self.predictions:
+            return web.json_response({"detail": "Not found."}, status=404)
+        return web.json_response(self._prediction_json(prediction_id))
+
+    async def cancel_prediction(self, request: web.Request):
+        prediction_id = request.match_info["id"]
+        prediction = self.predictions.get(prediction_id)
+        if prediction is None:
+            return web.json_response({"detail": "Not found."}, status=404)
+        if prediction["status"] in ("starting", "processing"):
+            prediction["status"] = "canceled"
+            prediction["completed_at"] = _now()
+            self.canceled += 1
+            # Как настоящий Replicate: отмена — тоже завершение, о нём приходит вебхук
+            webhook = self.webhooks.get(prediction_id)
+            if webhook:
+                task = asyncio.create_task(self._send_webhook(webhook, dict(prediction)))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        return web.json_response(prediction)
+
+    async def get_model(self, request: web.Request):
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        owner, name = request.match_info["owner"], request.match_info["name"]
+        return web.json_response({
+            "url": f"https://replicate.com/{owner}/{name}",
+            "owner": owner,
+            "name": name,
+            "description": "fake model",
+            "visibility": "public",
+            "github_url": None,
+            "paper_url": None,
+            "license_url": None,
+            "run_count": self.created,
+            "cover_image_url": None,
+            "default_example": None,
+            "latest_version": None,
+        })
+
+    async def webhook_secret(self, request: web.Request):
+        return web.json_response({"key": self.signing_key})
+
+    async def image(self, request: web.Request):
+        return web.Response(body=PNG_1X1, content_type="image/png")
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/v1/models/{owner}/{name}/predictions", self.create_prediction)
+        app.router.add_get("/v1/models/{owner}/{name}", self.get_model)
+        app.router.add_get("/v1/predictions/{id}", self.get_prediction)
+        app.router.add_post("/v1/predictions/{id}/cancel", self.cancel_prediction)
+        app.router.add_get("/v1/webhooks/default/secret", self.webhook_secret)
+        app.router.add_get("/images/{name}", self.image)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        """Запуск сервера в текущем цикле, возвращает runner"""
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{actual_port}"
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=2.0, help="время генерации, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="разброс времени генерации, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля неудачных предсказаний")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа API, с")
+    args = parser.parse_args()
+
+    fake = FakeReplicate(args.latency, args.jitter, args.error_rate, args.api_latency)
+
+    async def run():
+        await fake.start(args.host, args.port)
+        print(f"fake Replicate на {fake.base_url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
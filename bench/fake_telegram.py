@@ -0,0 +1,177 @@
+"""Локальная подмена Bot API Telegram для нагрузочных прогонов.
+
+Отвечает на методы, которые вызывает бот, правдоподобными объектами
+(сообщения, фото, участник канала, файл), отдаёт файлы по /file/bot<токен>/...
+и запоминает каждый вызов: метод, чат и время. По отправкам результатов
+(sendPhoto, sendDocument, sendMediaGroup) нагрузочный прогон считает
+время от сообщения пользователя до ответа.
+
+Может изображать лимиты Telegram: больше flood_limit новых сообщений за
+секунду получают 429 с retry_after, а чаты из blocked — 403, как от
+пользователя, заблокировавшего бота.
+
+Запуск: python -m bench.fake_telegram --port 8002 --latency 0.05
+Бот подключается через TELEGRAM_API_URL=http://127.0.0.1:8002
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+from bench.fake_replicate import PNG_1X1
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+# Методы, которыми бот доставляет результат генерации
+DELIVERY_METHODS = {"sendPhoto", "sendDocument", "sendMediaGroup"}
+
+
+class FakeTelegram:
+    """Состояние фейкового сервера Bot API"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, member_status: str = "member",
+                 flood_limit: int = 0, blocked: set = ()):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.member_status = member_status
+        self.flood_limit = flood_limit
+        self.blocked = {str(chat_id) for chat_id in blocked}
+        self.calls = Counter()
+        self.errors = 0
+        self.flood_errors = 0
+        # Секунда (int(time.monotonic())) и сколько сообщений в ней принято
+        self._flood_window = (0, 0)
+        # chat_id → моменты доставки результатов (time.monotonic)
+        self.deliveries = defaultdict(list)
+        self.texts = Counter()
+        # chat_id → (метод, момент вызова) для всех вызовов с chat_id
+        self.chat_calls = defaultdict(list)
+        self._message_id = 0
+        self._file_id = 0
+        self.base_url = ""
+
+    def _next_message(self, chat_id, **extra):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    def _next_file(self):
+        self._file_id += 1
+        return f"fake-file-{self._file_id}", f"fake-unique-{self._file_id}"
+
+    def _photo(self):
+        file_id, unique_id = self._next_file()
+        return [{"file_id": file_id, "file_unique_id": unique_id, "width": 1, "height": 1, "file_size": len(PNG_1X1)}]
+
+    def _result(self, method: str, params: dict):
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            self.texts[str(params.get("text", ""))[:40]] += 1
+            return self._next_message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self._next_message(chat_id, photo=self._photo())
+        if method == "sendDocument":
+            file_id, unique_id = self._next_file()
+            return self._next_message(chat_id, document={"file_id": file_id, "file_unique_id": unique_id})
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            group_id = str(self._message_id)
+            return [self._next_message(chat_id, photo=self._photo(), media_group_id=group_id) for _ in media]
+        if method in ("editMessageReplyMarkup", "sendInvoice"):
+            return self._next_message(chat_id)
+        if method == "copyMessage":
+            return {"message_id": self._next_message(chat_id)["message_id"]}
+        if method == "getChatMember":
+            return {"status": self.member_status, "user": {"id": int(params.get("user_id", 0)),
+                                                            "is_bot": False, "first_name": "User"}}
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": "fake-unique",
+                    "file_path": f"photos/{params.get('file_id')}.png", "file_size": len(PNG_1X1)}
+        # setWebhook, deleteMessage, answerCallbackQuery, answerPreCheckoutQuery, ...
+        return True
+
+    async def api(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error: fake"}, status=500
+            )
+        if self.flood_limit and (method.startswith("send") or method == "copyMessage"):
+            second, count = self._flood_window
+            now = int(time.monotonic())
+            count = count + 1 if now == second else 1
+            self._flood_window = (now, count)
+            if count > self.flood_limit:
+                self.flood_errors += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+        if params.get("chat_id") in self.blocked:
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403
+            )
+        if "chat_id" in params:
+            self.chat_calls[params["chat_id"]].append((method, time.monotonic()))
+        if method in DELIVERY_METHODS and "chat_id" in params:
+            self.deliveries[int(params["chat_id"])].append(time.monotonic())
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def file(self, request: web.Request):
+        return web.Response(body=PNG_1X1, content_type="image/png")
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/bot{token}/{method}", self.api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.file)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        """Запуск сервера в текущем цикле, возвращает runner"""
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{actual_port}"
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--flood-limit", type=int, default=0, help="сообщений в секунду до ответа 429 (0 — без лимита)")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.latency, args.error_rate, flood_limit=args.flood_limit)
+
+    async def run():
+        await fake.start(args.host, args.port)
+        print(f"fake Bot API на {fake.base_url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
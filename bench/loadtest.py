@@ -0,0 +1,581 @@
+"""Нагрузочный прогон bot.py без настоящих Telegram и Replicate.
+
+Поднимает фейковые Bot API и Replicate, запускает Application бота с его
+веб-сервером и шлёт на вебхук синтетические апдейты с заданной частотой:
+/start, нажатия меню, генерации по тексту и по фото, платежи. В отчёте:
+апдейты в секунду, p50/p95/p99 по обработчикам, время от сообщения до
+результата, задержки операций с базой и рост памяти. Прогоны с разными
+настройками (хранилище, очередь, кэш) сравниваются по этим числам.
+
+Запуск: python -m bench.loadtest --rate 50 --duration 30 --replicate-latency 2
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import ClientSession  # noqa: E402
+
+from bench.fake_kv import FakeKV  # noqa: E402
+from bench.fake_replicate import FakeReplicate  # noqa: E402
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+
+TOKEN = "123456:loadtest"
+
+# Доли сценариев в потоке апдейтов
+SCENARIOS = {
+    "start": 0.15,
+    "menu": 0.30,
+    "text_generation": 0.30,
+    "photo_generation": 0.15,
+    "payment": 0.10,
+}
+
+PROMPTS = ["кот в шляпе", "закат над морем", "робот читает книгу", "горы в тумане", "неоновый город"]
+
+
+class Recorder:
+    """Подмена гистограммы: сохраняет каждое значение для точных перцентилей"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def observe(self, value, **labels):
+        self.samples[tuple(labels.values())].append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class UpdateFactory:
+    """Синтетические апдейты в формате Bot API"""
+
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    @staticmethod
+    def _user(user_id: int):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message(self, user_id: int, **content):
+        update_id, message_id = self._ids()
+        return {"update_id": update_id, "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **content,
+        }}
+
+    def command(self, user_id: int, command: str):
+        return self.message(user_id, text=command,
+                            entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+    def callback(self, user_id: int, data: str):
+        update_id, message_id = self._ids()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+                "text": "Главное меню:",
+            },
+        }}
+
+    def photo(self, user_id: int, caption: str):
+        return self.message(user_id, caption=caption, photo=[{
+            "file_id": f"in-{self.message_id}", "file_unique_id": f"in-u-{self.message_id}", "width": 1, "height": 1,
+        }])
+
+    def pre_checkout(self, user_id: int, payload: str):
+        self.update_id += 1
+        return {"update_id": self.update_id, "pre_checkout_query": {
+            "id": str(self.update_id), "from": self._user(user_id),
+            "currency": "XTR", "total_amount": 40, "invoice_payload": payload,
+        }}
+
+    def payment(self, user_id: int, payload: str):
+        return self.message(user_id, successful_payment={
+            "currency": "XTR", "total_amount": 40, "invoice_payload": payload,
+            "telegram_payment_charge_id": uuid.uuid4().hex, "provider_payment_charge_id": "",
+        })
+
+
+class LoadTest:
+    """Генератор нагрузки и сбор результатов"""
+
+    def __init__(self, args):
+        self.args = args
+        self.factory = UpdateFactory()
+        self.session = None
+        # Экземпляры бота; апдейты раздаются по кругу
+        self.webhook_urls = []
+        # Фейковый Bot API: по нему пользователь видит ответ бота
+        self.telegram = None
+        self.posted = 0
+        self.posted_total = 0
+        self.post_errors = 0
+        self.scenarios = Counter()
+        # user_id → момент отправки запроса на генерацию
+        self.generation_sent = {}
+        self.next_user = 1000
+
+    async def post(self, update: dict):
+        url = self.webhook_urls[self.posted_total % len(self.webhook_urls)]
+        self.posted_total += 1
+        try:
+            async with self.session.post(url, json=update) as response:
+                await response.read()
+                self.posted += 1
+                if response.status != 200:
+                    self.post_errors += 1
+        except Exception:
+            self.post_errors += 1
+
+    async def wait_reply(self, user_id: int, timeout: float = 30):
+        """Ожидание первого сообщения бота в чат пользователя"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if any(method == "sendMessage" for method, _ in self.telegram.chat_calls.get(str(user_id), ())):
+                return
+            await asyncio.sleep(0.02)
+
+    def new_user(self) -> int:
+        self.next_user += 1
+        return self.next_user
+
+    async def scenario(self, name: str):
+        f = self.factory
+        self.scenarios[name] += 1
+        if name == "start":
+            await self.post(f.command(self.new_user(), "/start"))
+        elif name == "menu":
+            user_id = random.randint(1001, max(1001, self.next_user))
+            await self.post(f.callback(user_id, random.choice(["balance", "help", "buy"])))
+        elif name in ("text_generation", "photo_generation"):
+            # Каждая генерация — новый пользователь: доставку легко сопоставить с запросом
+            user_id = self.new_user()
+            await self.post(f.callback(user_id, "generate"))
+            # Пользователь пишет описание, увидев приглашение бота, и ещё думает:
+            # вебхук отвечает до обработки апдейта, без ожидания сообщение обгонит нажатие
+            await self.wait_reply(user_id)
+            await asyncio.sleep(self.args.think_time)
+            prompt = random.choice(PROMPTS) if self.args.repeat_prompts else f"{random.choice(PROMPTS)} {user_id}"
+            self.generation_sent[user_id] = time.monotonic()
+            if name == "text_generation":
+                await self.post(f.message(user_id, text=prompt))
+            else:
+                await self.post(f.photo(user_id, prompt))
+        elif name == "payment":
+            user_id = random.randint(1001, max(1001, self.next_user))
+            await self.post(f.pre_checkout(user_id, "buy_10"))
+            await self.post(f.payment(user_id, "buy_10"))
+
+    async def generate_load(self):
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+        interval = 1 / self.args.rate
+        tasks = set()
+        started = time.monotonic()
+        tick = 0
+        while time.monotonic() - started < self.args.duration:
+            task = asyncio.create_task(self.scenario(random.choices(names, weights)[0]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            tick += 1
+            # Открытая модель нагрузки: темп не зависит от скорости ответов бота
+            await asyncio.sleep(max(0.0, started + tick * interval - time.monotonic()))
+        if tasks:
+            await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+
+def summarize(samples: dict, scale: int = 1000, digits: int = 1) -> dict:
+    """Перцентили по точным выборкам Recorder"""
+    return {
+        labels[0]: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * scale, digits),
+            "p95_ms": round(percentile(values, 0.95) * scale, digits),
+            "p99_ms": round(percentile(values, 0.99) * scale, digits),
+        }
+        for labels, values in sorted(samples.items())
+    }
+
+
+def parse_histograms(texts: list, name: str) -> dict:
+    """Сумма корзин гистограммы name по выгрузкам /metrics нескольких экземпляров.
+
+    Возвращает значение первой метки → {граница le: накопленное количество}.
+    """
+    merged = defaultdict(Counter)
+    prefix = f"{name}_bucket{{"
+    for text in texts:
+        for line in text.splitlines():
+            if not line.startswith(prefix):
+                continue
+            labels, value = line[len(prefix):].rsplit("} ", 1)
+            pairs = dict(pair.split("=", 1) for pair in labels.split(","))
+            bound = float(pairs.pop("le").strip('"'))
+            label = next(iter(pairs.values()), '""').strip('"')
+            merged[label][bound] += float(value)
+    return merged
+
+
+def bucket_quantile(buckets: dict, q: float) -> float:
+    """Оценка квантиля по корзинам, как histogram_quantile в Prometheus"""
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1e-9)
+        lower, below = bound, count
+    return lower
+
+
+def summarize_buckets(histograms: dict, scale: int = 1000, digits: int = 1) -> dict:
+    return {
+        label: {
+            "count": int(buckets[float("inf")]),
+            "p50_ms": round(bucket_quantile(buckets, 0.50) * scale, digits),
+            "p95_ms": round(bucket_quantile(buckets, 0.95) * scale, digits),
+            "p99_ms": round(bucket_quantile(buckets, 0.99) * scale, digits),
+        }
+        for label, buckets in sorted(histograms.items())
+    }
+
+
+class InProcessBot:
+    """Бот в процессе нагрузочного прогона: точные перцентили и доступ к внутренностям"""
+
+    def __init__(self, args):
+        self.args = args
+        self.port = free_port()
+        self.webhook_urls = [f"http://127.0.0.1:{self.port}/{TOKEN}"]
+        self.health_urls = [f"http://127.0.0.1:{self.port}/"]
+
+    async def start(self, env: dict):
+        os.environ.update(env)
+        import bot
+        import storage
+        import translation
+
+        if not self.args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        # Точные перцентили вместо корзин гистограмм
+        bot.UPDATE_SECONDS = Recorder()
+        storage.DB_SECONDS = Recorder()
+        translation.TRANSLATION_SECONDS = Recorder()
+        self.bot, self.storage, self.translation = bot, storage, translation
+        self.stop_event = asyncio.Event()
+        self.server = asyncio.create_task(bot.serve(bot.build_application(), self.port, self.stop_event))
+
+    async def handled(self, session) -> int:
+        return sum(len(values) for values in self.bot.UPDATE_SECONDS.samples.values())
+
+    def busy(self) -> bool:
+        return bool(len(self.bot.generation_queue) or self.bot.generations_in_flight)
+
+    def rss(self) -> int:
+        return rss_bytes()
+
+    async def stats(self, session) -> dict:
+        return {
+            "handlers": summarize(self.bot.UPDATE_SECONDS.samples),
+            "db_commits": self.bot.db.commits,
+            "db_operations": summarize(self.storage.DB_SECONDS.samples, digits=2),
+            "translation": summarize(self.translation.TRANSLATION_SECONDS.samples, digits=2),
+        }
+
+    async def stop(self):
+        self.stop_event.set()
+        await self.server
+
+
+class ReplicaBots:
+    """Несколько процессов bot.py за балансировщиком по кругу"""
+
+    def __init__(self, args):
+        self.args = args
+        self.ports = [free_port() for _ in range(args.replicas)]
+        self.webhook_urls = [f"http://127.0.0.1:{port}/{TOKEN}" for port in self.ports]
+        self.health_urls = [f"http://127.0.0.1:{port}/" for port in self.ports]
+        self.processes = []
+
+    async def start(self, env: dict):
+        bot_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+        output = None if self.args.verbose else asyncio.subprocess.DEVNULL
+        for port in self.ports:
+            replica_env = {**os.environ, **env, "PORT": str(port), "REPLICAS": str(self.args.replicas)}
+            self.processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, bot_path, env=replica_env, stdout=output, stderr=output,
+            ))
+
+    async def _scrape(self, session) -> list:
+        texts = []
+        for port in self.ports:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                texts.append(await response.text())
+        return texts
+
+    async def handled(self, session) -> int:
+        histograms = parse_histograms(await self._scrape(session), "bot_update_seconds")
+        return int(sum(buckets[float("inf")] for buckets in histograms.values()))
+
+    def busy(self) -> bool:
+        return False
+
+    def rss(self) -> int:
+        try:
+            import psutil
+        except ImportError:
+            return 0
+        return sum(psutil.Process(process.pid).memory_info().rss for process in self.processes)
+
+    async def stats(self, session) -> dict:
+        texts = await self._scrape(session)
+        return {
+            # Между экземплярами доступны только корзины гистограмм: перцентили оценочные
+            "handlers": summarize_buckets(parse_histograms(texts, "bot_update_seconds")),
+            "db_commits": None,
+            "db_operations": summarize_buckets(parse_histograms(texts, "bot_db_operation_seconds"), digits=2),
+            "translation": summarize_buckets(parse_histograms(texts, "bot_translation_seconds"), digits=2),
+        }
+
+    async def stop(self):
+        for process in self.processes:
+            process.terminate()
+        await asyncio.gather(*(process.wait() for process in self.processes))
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    fake_replicate = FakeReplicate(args.replicate_latency, args.replicate_jitter, args.replicate_error_rate)
+    fake_telegram = FakeTelegram(args.telegram_latency, args.telegram_error_rate, flood_limit=args.flood_limit)
+    await fake_replicate.start()
+    await fake_telegram.start()
+
+    target = ReplicaBots(args) if args.replicas else InProcessBot(args)
+    env = {
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "RENDER_URL": target.health_urls[0].rstrip("/"),
+        "REPLICATE_API_TOKEN": "loadtest",
+        "REPLICATE_BASE_URL": fake_replicate.base_url,
+        "REPLICATE_POLL_INTERVAL": str(args.poll_interval),
+        "TELEGRAM_API_URL": fake_telegram.base_url,
+        "DB_FILE": os.path.join(workdir, "bot.db"),
+        "SESSION_BACKEND": args.session_backend,
+        "TELEGRAM_RATE": str(args.telegram_rate),
+        "TELEGRAM_CHAT_RATE": str(args.telegram_chat_rate),
+        "TRANSLATOR": args.translator,
+        "TRANSLATOR_STUB_LATENCY": str(args.translator_latency),
+    }
+    if args.session_backend == "kv":
+        fake_kv = FakeKV()
+        await fake_kv.start()
+        env["SESSION_KV_URL"] = fake_kv.url
+    if args.webhook_mode:
+        env["REPLICATE_WEBHOOK_MODE"] = "1"
+    await target.start(env)
+
+    load = LoadTest(args)
+    load.webhook_urls = target.webhook_urls
+    load.telegram = fake_telegram
+    async with ClientSession() as session:
+        load.session = session
+        for url in target.health_urls:
+            for _ in range(300):
+                try:
+                    async with session.get(url) as response:
+                        if response.status == 200:
+                            break
+                except OSError:
+                    pass
+                await asyncio.sleep(0.1)
+
+        rss_before = target.rss()
+        started = time.monotonic()
+        elapsed = await load.generate_load()
+
+        # Ждём обработки всех апдейтов и доставки начатых генераций
+        processed_at = None
+        deadline = started + elapsed + args.drain_timeout
+        while time.monotonic() < deadline:
+            if processed_at is None and await target.handled(session) >= load.posted:
+                processed_at = time.monotonic()
+            pending = [u for u in load.generation_sent if not fake_telegram.deliveries.get(u)]
+            if processed_at and not pending and not target.busy():
+                break
+            await asyncio.sleep(0.2)
+        processed_at = processed_at or time.monotonic()
+        rss_after = target.rss()
+        handled = await target.handled(session)
+        stats = await target.stats(session)
+
+    await target.stop()
+
+    e2e = [
+        fake_telegram.deliveries[user_id][0] - sent
+        for user_id, sent in load.generation_sent.items()
+        if fake_telegram.deliveries.get(user_id)
+    ]
+
+    report = {
+        "config": vars(args),
+        "load_seconds": round(elapsed, 2),
+        "posted": load.posted,
+        "post_errors": load.post_errors,
+        "scenarios": dict(load.scenarios),
+        "handled": handled,
+        # Пропускная способность: апдейты до момента, когда обработан последний
+        "updates_per_second": round(handled / (processed_at - started), 1),
+        "handlers": stats["handlers"],
+        "generation": {
+            "requested": len(load.generation_sent),
+            "delivered": len(e2e),
+            "p50_s": round(percentile(e2e, 0.50), 2),
+            "p95_s": round(percentile(e2e, 0.95), 2),
+            "p99_s": round(percentile(e2e, 0.99), 2),
+            "replicate_predictions": fake_replicate.created,
+        },
+        "db": {
+            "commits": stats["db_commits"],
+            "operations": stats["db_operations"],
+        },
+        "translation": stats["translation"],
+        "telegram_calls": dict(fake_telegram.calls),
+        "telegram_429": fake_telegram.flood_errors,
+        "memory": {
+            "rss_before_mb": round(rss_before / 1048576, 1),
+            "rss_after_mb": round(rss_after / 1048576, 1),
+            "growth_mb": round((rss_after - rss_before) / 1048576, 1),
+        },
+    }
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n📊 Нагрузка {report['load_seconds']}с: отправлено апдейтов {report['posted']} "
+          f"(ошибок {report['post_errors']}), обработано {report['handled']}, {report['updates_per_second']}/с")
+    print(f"   сценарии: {report['scenarios']}")
+    print("\n⏱ Обработчики (мс):")
+    print(f"   {'обработчик':<28}{'кол-во':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, row in report["handlers"].items():
+        print(f"   {name:<28}{row['count']:>8}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}")
+    g = report["generation"]
+    print(f"\n🎨 Генерации: запрошено {g['requested']}, доставлено {g['delivered']}, "
+          f"предсказаний Replicate {g['replicate_predictions']}")
+    print(f"   от сообщения до результата: p50 {g['p50_s']}с, p95 {g['p95_s']}с, p99 {g['p99_s']}с")
+    print(f"\n💾 База: коммитов {report['db']['commits']}")
+    print(f"   {'операция':<28}{'кол-во':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, row in report["db"]["operations"].items():
+        print(f"   {name:<28}{row['count']:>8}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}")
+    if report["translation"]:
+        # Исходы: cached — из кэша, translated — переводчиком, timeout — не уложился в бюджет
+        print("\n🌐 Перевод описаний (мс):")
+        print(f"   {'исход':<28}{'кол-во':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for name, row in report["translation"].items():
+            print(f"   {name:<28}{row['count']:>8}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}")
+    m = report["memory"]
+    print(f"\n🧠 Память: {m['rss_before_mb']} → {m['rss_after_mb']} МБ ({m['growth_mb']:+} МБ)")
+    print(f"\n📨 Вызовы Bot API: {report['telegram_calls']}, ответов 429: {report['telegram_429']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20, help="сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=20, help="длительность нагрузки, с")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="ожидание начатых генераций, с")
+    parser.add_argument("--replicate-latency", type=float, default=2.0)
+    parser.add_argument("--replicate-jitter", type=float, default=0.5)
+    parser.add_argument("--replicate-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-rate", type=float, default=0,
+                        help="TELEGRAM_RATE бота, сообщений в секунду (0 — без ограничения)")
+    parser.add_argument("--telegram-chat-rate", type=float, default=0, help="TELEGRAM_CHAT_RATE бота")
+    parser.add_argument("--flood-limit", type=int, default=0,
+                        help="фейковый Bot API отвечает 429 сверх стольких сообщений в секунду")
+    parser.add_argument("--think-time", type=float, default=0.5, help="пауза между приглашением бота и описанием, с")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="REPLICATE_POLL_INTERVAL")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="экземпляров бота в отдельных процессах, апдейты по кругу; "
+                             "0 — бот в процессе прогона с точными перцентилями")
+    parser.add_argument("--session-backend", choices=("sqlite", "kv"), default="sqlite",
+                        help="хранилище сессий; kv — с фейковым key-value сервером")
+    parser.add_argument("--webhook-mode", action="store_true", help="REPLICATE_WEBHOOK_MODE=1")
+    parser.add_argument("--translator", choices=("stub", "google", "off"), default="stub",
+                        help="TRANSLATOR бота; stub — локальная заглушка без сети")
+    parser.add_argument("--translator-latency", type=float, default=0.05, help="задержка заглушки переводчика, с")
+    parser.add_argument("--repeat-prompts", action="store_true",
+                        help="повторяющиеся описания (проверка кэша и объединения запросов)")
+    parser.add_argument("--json", metavar="PATH", help="сохранить отчёт в JSON")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
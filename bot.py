@@ -1,17 +1,36 @@
+import time
+
+# Отсчёт холодного старта: до открытия порта и до первого апдейта
+PROCESS_STARTED = time.monotonic()
+
 import os
+import argparse
 import logging
-import sqlite3
-import time
 import signal
 import sys
 import asyncio
+import hashlib
+import hmac
+import base64
+import math
+import threading
+import json
+import random
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from datetime import datetime
+from urllib.parse import urlparse
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Update,
     LabeledPrice,
     PreCheckoutQuery,
+    InputFile,
+    InputMediaPhoto,
 )
 from telegram.ext import (
     Application,
@@ -22,10 +41,22 @@ from telegram.ext import (
     filters,
     PreCheckoutQueryHandler,
 )
-from telegram.error import Forbidden, TimedOut, NetworkError
-import replicate
-import requests
-from apscheduler.schedulers.background import BackgroundScheduler
+from telegram.error import Forbidden, TimedOut, NetworkError, BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.helpers import escape_markdown
+import aiohttp
+from aiohttp import web
+import httpx
+from storage import Storage, verify_archive_file
+from sessions import Sessions, SQLiteSessionStore, KVSessionStore
+from maintenance import Maintenance
+from ratelimit import OutboundLimiter, send_priority, HIGH, BULK
+from translation import PromptTranslator, GoogleTranslator, StubTranslator
+from backends import AttemptCanceled, BackendRouter, NoBackend, load_backends
+import metrics
+from metrics import REGISTRY
+import tracing
+from tracing import span
 import platform
 
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
@@ -39,16 +70,19 @@ logger = logging.getLogger(__name__)
 running = True
 start_time = time.time()
 
-def signal_handler(sig, frame):
-    """Обработчик сигналов остановки"""
-    global running
-    logger.info("📴 Получен сигнал остановки, завершаем работу...")
-    running = False
-    time.sleep(2)
-    sys.exit(0)
+def install_signal_handlers(stop_event: asyncio.Event):
+    """SIGINT и SIGTERM запускают плавную остановку: выполняющиеся генерации
+    дорабатываются, а не обрываются вместе с процессом"""
+    loop = asyncio.get_running_loop()
+
+    def stop(sig):
+        global running
+        logger.info(f"📴 Получен сигнал {sig.name}, завершаем работу...")
+        running = False
+        stop_event.set()
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop, sig)
 
 # ==================== ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ ====================
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -56,6 +90,138 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 RENDER_URL = os.getenv("RENDER_URL")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 
+# Сколько генераций одновременно уходит в Replicate и сколько апдейтов
+# Telegram обрабатывается параллельно
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# Очередь генераций: число воркеров и пределы, после которых новые задачи отклоняются
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", str(GENERATION_CONCURRENCY)))
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "200"))
+QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", "3"))
+
+# Задачи очереди: аренда воркера (продлевается, пока задача выполняется),
+# период опроса очереди, число попыток для задачи, прерванной падением
+# процесса, и сколько остановка ждёт выполняющиеся задачи
+JOB_LEASE = int(os.getenv("JOB_LEASE", "60"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "25"))
+
+# Через сколько секунд неподтверждённый резерв генерации возвращается на баланс
+HOLD_TIMEOUT = int(os.getenv("HOLD_TIMEOUT", "3600"))
+
+# Через сколько секунд предсказание, чей вебхук Replicate так и не пришёл,
+# считается потерянным (резерв возвращается), и при какой доле свободных
+# страниц базы плановое обслуживание выполняет VACUUM
+PENDING_TIMEOUT = int(os.getenv("PENDING_TIMEOUT", str(6 * 3600)))
+VACUUM_FREE_RATIO = float(os.getenv("VACUUM_FREE_RATIO", "0.25"))
+
+# Кэш готовых изображений для повторяющихся запросов
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") == "1"
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+
+# Перевод описаний на английский перед генерацией: TRANSLATOR=google, stub
+# (локальная заглушка для проверок) или off; сколько секунд ждать перевод,
+# прежде чем генерировать по исходному тексту, и сколько переводов хранить
+TRANSLATOR = os.getenv("TRANSLATOR", "google")
+TRANSLATION_BUDGET = float(os.getenv("TRANSLATION_BUDGET", "1.5"))
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "20000"))
+
+# Варианты и альбомы: сколько вариантов можно заказать за раз, сколько фото
+# альбома уходит в модель и сколько секунд ждать остальные фото альбома
+MAX_VARIANTS = 4
+MAX_INPUT_IMAGES = int(os.getenv("MAX_INPUT_IMAGES", "4"))
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+
+# Сколько задача ждёт общую генерацию с тем же запросом, прежде чем сдаться
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv("SINGLE_FLIGHT_TIMEOUT", "600"))
+
+# Общая HTTP-сессия: размер пула соединений, таймаут запроса
+# и предел размера скачиваемого результата
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "60"))
+MAX_RESULT_BYTES = int(os.getenv("MAX_RESULT_BYTES", str(50 * 1024 * 1024)))
+
+# Кэш проверки подписки на канал: сколько секунд доверять положительному
+# и отрицательному ответу, как часто обновлять статус активных пользователей (0 — никогда)
+SUBSCRIPTION_TTL = int(os.getenv("SUBSCRIPTION_TTL", str(6 * 3600)))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "60"))
+SUBSCRIPTION_REFRESH_INTERVAL = int(os.getenv("SUBSCRIPTION_REFRESH_INTERVAL", "900"))
+
+# Повторы временных ошибок Replicate и предохранитель: после BREAKER_FAILURES
+# неудач подряд (или половины ошибок среди последних вызовов) запросы
+# отклоняются сразу, пробный вызов — через BREAKER_RESET_TIMEOUT секунд
+REPLICATE_MAX_RETRIES = int(os.getenv("REPLICATE_MAX_RETRIES", "3"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = int(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# Ход генерации: статус предсказания опрашивается каждые REPLICATE_POLL_INTERVAL
+# секунд, сообщение о статусе правится не чаще раза в PROGRESS_EDIT_INTERVAL
+# секунд (смена статуса — сразу, но не чаще раза в секунду)
+REPLICATE_POLL_INTERVAL = float(os.getenv("REPLICATE_POLL_INTERVAL", "0.5"))
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "5"))
+# Отмену задачи этого процесса воркер видит сразу, а флаг cancel_requested
+# в базе (отмена из другого процесса) читает не чаще раза в CANCEL_CHECK_INTERVAL секунд
+CANCEL_CHECK_INTERVAL = float(os.getenv("CANCEL_CHECK_INTERVAL", "5"))
+
+# Бэкенды генерации (JSON-список моделей с ценой, скоростью и возможностями)
+# и маршрутизация: запрос без ответа дольше HEDGE_AFTER секунд (0 — p95
+# бэкенда) дублируется на следующий, но не больше доли HEDGE_MAX_RATIO запросов
+GENERATION_BACKENDS = os.getenv("GENERATION_BACKENDS", "")
+HEDGE_AFTER = float(os.getenv("HEDGE_AFTER", "0"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+
+# Трассировка: апдейты и задачи дольше TRACE_SLOW_MS пишутся в лог по этапам,
+# из них в лог попадает доля TRACE_SAMPLE_RATE
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+# Адрес сервера Bot API (по умолчанию api.telegram.org) и путь к базе
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+DB_FILE = os.getenv("DB_FILE", "bot.db")
+
+# Журнал транзакций: строки старше LEDGER_RETENTION_DAYS дней сворачиваются
+# в итоги по месяцам и переносятся в сжатые файлы в LEDGER_ARCHIVE_DIR
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "90"))
+LEDGER_ARCHIVE_DIR = os.getenv("LEDGER_ARCHIVE_DIR", os.path.splitext(DB_FILE)[0] + "-archive")
+
+# Состояние диалога: SESSION_BACKEND=sqlite (в базе бота) или kv (сервер RESP
+# по SESSION_KV_URL, записи живут SESSION_TTL секунд). REPLICAS — сколько
+# экземпляров бота за одним вебхуком; при нескольких кэши в памяти процесса
+# (сессии, балансы) отключаются, чтобы экземпляры не расходились
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_KV_URL = os.getenv("SESSION_KV_URL", "redis://127.0.0.1:6379/0")
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(30 * 86400)))
+REPLICAS = int(os.getenv("REPLICAS", "1"))
+# Балансы и сессии меняет не только этот процесс: несколько экземпляров или
+# генерации в отдельном процессе (веб-процесс с QUEUE_WORKERS=0); воркер
+# --worker включает этот режим в main, см. configure_shared_state
+SHARED_STATE = REPLICAS > 1 or QUEUE_WORKERS == 0
+DB_FLUSH_INTERVAL_MS = os.getenv("DB_FLUSH_INTERVAL_MS")
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "50000"))
+
+# Исходящие сообщения: не больше TELEGRAM_RATE в секунду на процесс и
+# TELEGRAM_CHAT_RATE в секунду в один чат (0 — без ограничения). При нескольких
+# процессах бота общий лимит Telegram (~30/с) делится между ними
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+
+# Рассылка: сколько сообщений отправляется параллельно и сколько
+# получателей читается из базы за раз
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "32"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "500"))
+
+# Токен для /metrics (?token=... или заголовок Authorization: Bearer ...);
+# без него метрики открыты
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Режим вебхуков Replicate: бот создаёт предсказание и не ждёт его,
+# результат приходит POST-запросом на /replicate/<секрет>
+REPLICATE_WEBHOOK_MODE = os.getenv("REPLICATE_WEBHOOK_MODE", "0") == "1"
+REPLICATE_BASE_URL = os.getenv("REPLICATE_BASE_URL")
+
 if not TOKEN:
     logger.error("❌ TELEGRAM_BOT_TOKEN не установлен!")
     sys.exit(1)
@@ -69,96 +235,511 @@ if not REPLICATE_API_TOKEN:
 logger.info(f"🐍 Python version: {platform.python_version()}")
 logger.info(f"🚀 Render URL: {RENDER_URL}")
 
+# Секрет в пути вебхука Replicate; по умолчанию выводится из токена,
+# чтобы совпадать у всех экземпляров бота
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET") or hashlib.sha256(
+    f"replicate-webhook:{TOKEN}".encode()
+).hexdigest()[:32]
+REPLICATE_WEBHOOK_PATH = f"/replicate/{REPLICATE_WEBHOOK_SECRET}"
+# Ключ подписи вебхуков Replicate (whsec_...); без него бот запрашивает ключ
+# у API (GET /v1/webhooks/default/secret) при первом вебхуке. Подписанный
+# вебхук старше WEBHOOK_TOLERANCE секунд отклоняется как повтор
+REPLICATE_WEBHOOK_SIGNING_KEY = os.getenv("REPLICATE_WEBHOOK_SIGNING_KEY")
+WEBHOOK_TOLERANCE = int(os.getenv("WEBHOOK_TOLERANCE", "300"))
+
+# ==================== МЕТРИКИ ====================
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("bot_queue_wait_seconds", "Ожидание задачи в очереди генераций")
+REPLICATE_SECONDS = REGISTRY.histogram(
+    "bot_replicate_call_seconds", "Длительность вызовов Replicate", ("operation", "outcome")
+)
+DELIVERY_SECONDS = REGISTRY.histogram(
+    "bot_delivery_seconds", "Отправка результата пользователю: скачивание и загрузка в Telegram", ("kind",)
+)
+JOB_SECONDS = REGISTRY.histogram("bot_job_seconds", "Полное выполнение задачи воркером")
+REPLICATE_RETRIES = REGISTRY.counter("bot_replicate_retries_total", "Повторы вызовов Replicate", ("kind",))
+REPLICATE_ERRORS = REGISTRY.counter("bot_replicate_errors_total", "Ошибки вызовов Replicate", ("kind",))
+BREAKER_REJECTED = REGISTRY.counter("bot_breaker_rejected_total", "Вызовы, отклонённые предохранителем")
+UPDATE_SECONDS = REGISTRY.histogram("bot_update_seconds", "Обработка апдейта обработчиком", ("handler",))
+UPDATE_ERRORS = REGISTRY.counter("bot_update_errors_total", "Исключения в обработчиках", ("handler",))
+TELEGRAM_API_SECONDS = REGISTRY.histogram(
+    "bot_telegram_api_seconds", "Длительность запросов к Bot API", ("method", "outcome")
+)
+REGISTRY.gauge("bot_generations_in_flight", "Генерации, выполняющиеся в Replicate",
+               function=lambda: generations_in_flight)
+REGISTRY.gauge("bot_queue_depth", "Задачи в очереди генераций", function=lambda: len(generation_queue))
+REGISTRY.gauge("bot_breaker_open", "Предохранитель Replicate открыт (1) или закрыт (0)",
+               function=lambda: int(replicate_breaker.state != "closed"))
+REGISTRY.gauge("bot_uptime_seconds", "Время работы процесса", function=lambda: time.time() - start_time)
+STARTUP_SECONDS = REGISTRY.gauge(
+    "bot_startup_seconds", "Холодный старт: от запуска процесса до этапа (listening, ready, first_update)", ("stage",)
+)
+
+def mark_startup(stage: str):
+    """Отметка этапа холодного старта в логе и метриках"""
+    elapsed = time.monotonic() - PROCESS_STARTED
+    STARTUP_SECONDS.set(elapsed, stage=stage)
+    logger.info(f"⏱ Старт: {stage} через {elapsed:.2f}с после запуска")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером длительности каждого метода Bot API"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            outcome = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method=api_method, outcome=outcome)
+
+# Все вызовы Bot API идут через ограничитель: лимиты Telegram, приоритеты, RetryAfter
+outbound_limiter = OutboundLimiter(TELEGRAM_RATE, TELEGRAM_CHAT_RATE)
+
+tracer = tracing.Tracer(TRACE_SLOW_MS / 1000, TRACE_SAMPLE_RATE)
+
+def instrumented(callback):
+    """Обработчик с замером длительности, счётчиком исключений и трассой этапов"""
+    name = callback.__name__
+
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        user = getattr(update, "effective_user", None)
+        try:
+            with tracer.trace(name, user_id=user.id if user else None):
+                async with session_scope(update, context):
+                    return await callback(update, context)
+        except Exception:
+            UPDATE_ERRORS.inc(handler=name)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = callback.__doc__
+    return wrapper
+
 # ==================== КЛИЕНТ REPLICATE ====================
-replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+# Библиотека replicate импортируется при первом обращении: на холодном старте
+# вебхук начинает принимать апдейты, не дожидаясь её загрузки
+_replicate_client = None
+
+def replicate_api():
+    """Клиент Replicate"""
+    global _replicate_client
+    if _replicate_client is None:
+        import replicate
+        _replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+    return _replicate_client
+
+generation_router = BackendRouter(
+    load_backends(GENERATION_BACKENDS, replicate_api), HEDGE_AFTER, HEDGE_MAX_RATIO
+)
 
-# ==================== БАЗА ДАННЫХ ====================
-DB_FILE = "bot.db"
+# ==================== ДВИЖОК ГЕНЕРАЦИИ ====================
+# Клиент Replicate синхронный (даже async_run ждёт результат через time.sleep),
+# поэтому вызовы уходят в отдельный ограниченный пул потоков, а событийный цикл
+# продолжает обслуживать остальные апдейты.
+generation_executor = ThreadPoolExecutor(
+    max_workers=GENERATION_CONCURRENCY,
+    thread_name_prefix="replicate",
+)
+# Сколько предсказаний одновременно опрашивается до завершения: слот занят
+# от создания предсказания до результата, а не на время одного HTTP-вызова
+generation_semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+generations_in_flight = 0
+
+async def run_in_generation_pool(func, *args, **kwargs):
+    """Выполнение блокирующего вызова Replicate вне событийного цикла"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(generation_executor, partial(func, *args, **kwargs))
+
+@asynccontextmanager
+async def generation_slot():
+    """Слот генерации на всё время жизни предсказания"""
+    global generations_in_flight
+    async with generation_semaphore:
+        generations_in_flight += 1
+        try:
+            yield
+        finally:
+            generations_in_flight -= 1
+
+# ==================== УСТОЙЧИВОСТЬ К СБОЯМ REPLICATE ====================
+SERVICE_BUSY_MESSAGE = "⏳ Сервис генерации сейчас перегружен. Попробуйте через пару минут."
+
+class GenerationError(Exception):
+    """Классифицированная ошибка Replicate.
+
+    kind — вид ошибки, retryable — поможет ли повтор, counts — говорит ли
+    ошибка о неисправности сервиса (учитывается предохранителем).
+    """
+
+    def __init__(self, kind: str, message: str, retryable: bool = False, counts: bool = True):
+        super().__init__(message)
+        self.kind = kind
+        self.retryable = retryable
+        self.counts = counts
+
+    @property
+    def user_message(self):
+        """Текст ошибки для пользователя"""
+        if self.kind == "busy":
+            return SERVICE_BUSY_MESSAGE
+        return generation_error(str(self))["error"]
+
+def classify_error(e: Exception) -> GenerationError:
+    """Вид ошибки по типу исключения и тексту ответа Replicate"""
+    if isinstance(e, GenerationError):
+        return e
+    from replicate.exceptions import ModelError, ReplicateError
+
+    text = str(e).lower()
+    if isinstance(e, (httpx.TimeoutException, httpx.TransportError)):
+        return GenerationError("network", str(e) or type(e).__name__, retryable=True)
+    if isinstance(e, json.JSONDecodeError):
+        # Вместо JSON с detail пришла страница шлюза (502/503/504)
+        return GenerationError("gateway", "bad gateway", retryable=True)
+    if "flagged as sensitive" in text or "nsfw" in text:
+        return GenerationError("rejected", str(e), counts=False)
+    if isinstance(e, ReplicateError):
+        if "insufficient credit" in text:
+            return GenerationError("billing", str(e))
+        if "rate limit" in text or "throttled" in text or "too many requests" in text:
+            return GenerationError("ratelimit", str(e), retryable=True)
+        if "invalid" in text or "validation" in text:
+            return GenerationError("invalid", str(e), counts=False)
+        if any(marker in text for marker in ("502", "503", "504", "bad gateway", "unavailable", "internal")):
+            return GenerationError("gateway", str(e), retryable=True)
+        return GenerationError("upstream", str(e))
+    if isinstance(e, ModelError):
+        return GenerationError("model", str(e))
+    return GenerationError("unknown", str(e))
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 10.0):
+    """Пауза перед повтором: экспонента с полным джиттером"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker:
+    """Предохранитель вызовов Replicate.
+
+    closed — вызовы идут; open — отклоняются сразу; half-open — после
+    reset_timeout пропускается один пробный вызов, его успех закрывает
+    предохранитель, неудача снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, window: int = 20,
+                 failure_rate: float = 0.5):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_rate = failure_rate
+        self._outcomes = deque(maxlen=window)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probe = False
+        self.consecutive_failures = 0
+        self.rejected = 0
+        self.failures_by_kind = {}
+
+    @property
+    def state(self):
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return self._state
+
+    @property
+    def recent_failure_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def is_open(self):
+        """Отклоняются ли сейчас вызовы (без траты пробного)"""
+        return self.state == "open" or (self.state == "half-open" and self._probe)
+
+    def allow(self):
+        """Можно ли выполнить вызов; в half-open пропускает один пробный"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe:
+            self._probe = True
+            return True
+        self.rejected += 1
+        return False
 
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    
-    # Таблица пользователей
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            balance INTEGER DEFAULT 3,
-            created_at TEXT
-        )
-    """)
-    
-    # Таблица транзакций
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            type TEXT,
-            amount INTEGER,
-            payment_id TEXT UNIQUE,
-            created_at TEXT
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
-
-def get_user(user_id: int):
-    """Получение или создание пользователя"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id, balance FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    
-    if not row:
-        cur.execute(
-            "INSERT INTO users (id, balance, created_at) VALUES (?, ?, ?)",
-            (user_id, 3, datetime.now().isoformat()),
+    def record_success(self):
+        self._outcomes.append(True)
+        self.consecutive_failures = 0
+        if self._state != "closed":
+            logger.info("✅ Предохранитель Replicate закрыт")
+            self._outcomes.clear()
+        self._state = "closed"
+        self._probe = False
+
+    def record_failure(self, kind: str):
+        self._outcomes.append(False)
+        self.consecutive_failures += 1
+        self.failures_by_kind[kind] = self.failures_by_kind.get(kind, 0) + 1
+        tripped = (
+            self.consecutive_failures >= self.failure_threshold
+            or (len(self._outcomes) >= self._outcomes.maxlen // 2
+                and self.recent_failure_rate >= self.failure_rate)
         )
-        conn.commit()
-        balance = 3
-        logger.info(f"👤 Новый пользователь: {user_id}")
-    else:
-        balance = row[1]
-    
-    conn.close()
-    return balance
+        if self._probe or (self._state == "closed" and tripped):
+            if self._state == "closed":
+                logger.warning(f"🔌 Предохранитель Replicate открыт: {self.consecutive_failures} ошибок подряд")
+            self._state = "open"
+            self._opened_at = time.monotonic()
+            self._probe = False
+
+    def record(self, error: GenerationError = None):
+        """Учёт результата вызова: None — успех"""
+        if error is None:
+            self.record_success()
+        elif error.counts:
+            self.record_failure(error.kind)
+        elif self._probe:
+            # Ответ по существу (например, цензура) — сервис работает
+            self.record_success()
+
+replicate_breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+
+async def call_replicate(func, *args, attempts: int = REPLICATE_MAX_RETRIES, guarded: bool = True, **kwargs):
+    """Вызов Replicate через предохранитель с повтором временных ошибок.
+
+    guarded=False — служебный вызов по уже созданному предсказанию (опрос,
+    отмена): он не отклоняется открытым предохранителем и не влияет на него.
+    """
+    for attempt in range(attempts):
+        if guarded and not replicate_breaker.allow():
+            BREAKER_REJECTED.inc()
+            raise GenerationError("busy", "circuit breaker is open", counts=False)
+        started = time.perf_counter()
+        try:
+            with span(f"replicate.{func.__name__}"):
+                result = await run_in_generation_pool(func, *args, **kwargs)
+        except Exception as e:
+            error = classify_error(e)
+            REPLICATE_SECONDS.observe(time.perf_counter() - started, operation=func.__name__, outcome="error")
+            REPLICATE_ERRORS.inc(kind=error.kind)
+            if guarded:
+                replicate_breaker.record(error)
+            if not error.retryable or attempt == attempts - 1:
+                raise error from e
+            REPLICATE_RETRIES.inc(kind=error.kind)
+            delay = backoff_delay(attempt)
+            logger.warning(f"⚠️ Временная ошибка Replicate ({error.kind}), повтор через {delay:.1f}с: {e}")
+            await asyncio.sleep(delay)
+        else:
+            REPLICATE_SECONDS.observe(time.perf_counter() - started, operation=func.__name__, outcome="ok")
+            if guarded:
+                replicate_breaker.record()
+            return result
 
-def update_balance(user_id: int, delta: int, tx_type: str, payment_id: str = None):
-    """Обновление баланса пользователя"""
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    
-    # Обновляем баланс
-    cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
-    
-    # Записываем транзакцию
-    if payment_id:
-        cur.execute(
-            "INSERT INTO transactions (user_id, type, amount, payment_id, created_at) VALUES (?, ?, ?, ?, ?)",
-            (user_id, tx_type, delta, payment_id, datetime.now().isoformat())
-        )
-    else:
-        cur.execute(
-            "INSERT INTO transactions (user_id, type, amount, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, tx_type, delta, datetime.now().isoformat())
-        )
-    
-    conn.commit()
-    conn.close()
-    logger.info(f"💰 Баланс обновлён: user={user_id}, delta={delta}, type={tx_type}")
-    return True
+# ==================== БАЗА ДАННЫХ ====================
+def db_flush_interval(shared: bool) -> float:
+    """Период группового коммита: открытая транзакция держит блокировку записи,
+    которую ждут остальные процессы, поэтому при нескольких фиксируем чаще"""
+    return int(DB_FLUSH_INTERVAL_MS or ("20" if shared else "200")) / 1000
+
+db = Storage(
+    DB_FILE,
+    flush_interval=db_flush_interval(SHARED_STATE),
+    flush_rows=int(os.getenv("DB_FLUSH_ROWS", "100")),
+    cache_size=0 if SHARED_STATE else BALANCE_CACHE_SIZE,
+)
 
-# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
-async def check_subscription(user_id, bot):
-    """Проверка подписки на канал"""
+# ==================== СЕССИИ ====================
+if SESSION_BACKEND == "kv":
+    session_store = KVSessionStore(SESSION_KV_URL, ttl=SESSION_TTL)
+else:
+    session_store = SQLiteSessionStore(db)
+sessions = Sessions(session_store, shared=SHARED_STATE)
+
+def configure_shared_state(shared: bool):
+    """Кэши балансов и сессий в памяти процесса и период коммита под режим
+    работы; вызывается из main до открытия базы"""
+    global SHARED_STATE
+    SHARED_STATE = shared
+    db.flush_interval = db_flush_interval(shared)
+    db.cache_size = 0 if shared else BALANCE_CACHE_SIZE
+    sessions.set_shared(shared)
+
+# Ключи сессий, для которых сейчас выполняются обработчики в этом процессе
+active_sessions = {}
+
+@asynccontextmanager
+async def session_scope(update, context):
+    """user_data и chat_data апдейта: загрузка из хранилища сессий и запись изменений"""
+    scopes = {}
+    if getattr(update, "effective_user", None) and context.user_data is not None:
+        scopes[f"user:{update.effective_user.id}"] = context.user_data
+    if getattr(update, "effective_chat", None) and context.chat_data is not None:
+        scopes[f"chat:{update.effective_chat.id}"] = context.chat_data
+    if not scopes:
+        yield
+        return
+
+    # Словарь, с которым уже работает другой обработчик этого процесса, не перечитываем
+    fresh = [key for key in scopes if not active_sessions.get(key)]
+    loaded = await sessions.load(fresh) if fresh else {}
+    snapshots = {}
+    for key, data in scopes.items():
+        active_sessions[key] = active_sessions.get(key, 0) + 1
+        if key in loaded:
+            data.clear()
+            data.update(loaded[key])
+        snapshots[key] = dict(data)
     try:
-        member = await bot.get_chat_member(chat_id="@imaigenpromts", user_id=user_id)
-        return member.status in ("member", "administrator", "creator")
-    except:
-        return False
+        yield
+    finally:
+        changed = {key: data for key, data in scopes.items() if data != snapshots[key]}
+        try:
+            if changed:
+                await sessions.save(changed)
+        finally:
+            for key in scopes:
+                active_sessions[key] -= 1
+                if active_sessions[key]:
+                    continue
+                del active_sessions[key]
+                # В памяти PTB сессия нужна только на время обработки
+                kind, _, entity_id = key.partition(":")
+                if kind == "user":
+                    context.application.drop_user_data(int(entity_id))
+                else:
+                    context.application.drop_chat_data(int(entity_id))
+
+async def end_generation_session(user_id: int):
+    """Сброс режима генерации после выдачи результата"""
+    try:
+        await sessions.update(f"user:{user_id}", can_generate=False)
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи сессии {user_id}: {e}")
+
+# ==================== ПОДПИСКА НА КАНАЛ ====================
+SUBSCRIPTION_CHANNEL = "@imaigenpromts"
+
+async def check_subscription(user_id, bot):
+    """Проверка подписки на канал запросом к Telegram"""
+    member = await bot.get_chat_member(chat_id=SUBSCRIPTION_CHANNEL, user_id=user_id)
+    return member.status in ("member", "administrator", "creator")
+
+class SubscriptionCache:
+    """Статус подписки с TTL: в памяти и в SQLite, чтобы пережить перезапуск.
+
+    Положительный ответ хранится долго, отрицательный — коротко, чтобы
+    подписавшийся пользователь не ждал. Подтвердившие подписку однажды
+    больше не проверяются.
+    """
+
+    def __init__(self, storage: Storage, ttl: int, negative_ttl: int, max_entries: int = 50000):
+        self.storage = storage
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # user_id → (subscribed, confirmed, checked_at)
+        self._entries = OrderedDict()
+        # user_id → время последнего обращения, для фонового обновления
+        self._active = OrderedDict()
+        self.hits = 0
+        self.requests = 0
+        self.errors = 0
+
+    def _remember(self, user_id: int, entry: tuple):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _entry(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = await self.storage.subscription_get(user_id)
+            if entry is not None:
+                self._remember(user_id, entry)
+        return entry
+
+    def _fresh(self, entry: tuple, now: float):
+        subscribed, _, checked_at = entry
+        return now - checked_at < (self.ttl if subscribed else self.negative_ttl)
+
+    async def refresh(self, bot, user_id: int, confirmed: bool = False):
+        """Проверка подписки в Telegram и сохранение ответа"""
+        self.requests += 1
+        subscribed = await check_subscription(user_id, bot)
+        entry = await self._entry(user_id)
+        confirmed = confirmed and subscribed or bool(entry and entry[1])
+        entry = (subscribed, confirmed, time.time())
+        self._remember(user_id, entry)
+        await self.storage.subscription_put(user_id, *entry)
+        return subscribed
+
+    async def has_access(self, bot, user_id: int):
+        """Можно ли пользователю генерировать: подписан сейчас или подтверждал раньше"""
+        self._active[user_id] = time.time()
+        self._active.move_to_end(user_id)
+        if len(self._active) > self.max_entries:
+            self._active.popitem(last=False)
+
+        entry = await self._entry(user_id)
+        if entry is not None and (entry[1] or self._fresh(entry, time.time())):
+            self.hits += 1
+            return entry[0] or entry[1]
+        try:
+            with span("subscription"):
+                return await self.refresh(bot, user_id)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Не удалось проверить подписку {user_id}: {e}")
+            # Устаревший ответ лучше, чем никакого
+            return bool(entry and entry[0])
+
+    async def confirm(self, bot, user_id: int):
+        """Проверка по кнопке «Я подписался» — всегда с запросом к Telegram"""
+        try:
+            with span("subscription"):
+                return await self.refresh(bot, user_id, confirmed=True)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Не удалось проверить подписку {user_id}: {e}")
+            return False
+
+    def due_for_refresh(self, active_within: float, horizon: float, limit: int):
+        """Активные пользователи, чей положительный статус истечёт в ближайшие horizon секунд"""
+        now = time.time()
+        due = []
+        for user_id, last_seen in reversed(self._active.items()):
+            if now - last_seen > active_within or len(due) >= limit:
+                break
+            entry = self._entries.get(user_id)
+            if entry and entry[0] and not entry[1] and now - entry[2] > self.ttl - horizon:
+                due.append(user_id)
+        return due
+
+    def sweep(self, active_within: float):
+        """Удаление из памяти устаревших ответов и давно неактивных пользователей"""
+        now = time.time()
+        removed = 0
+        # _active упорядочен по времени обращения: старые записи в начале
+        while self._active and now - next(iter(self._active.values())) > active_within:
+            self._active.popitem(last=False)
+            removed += 1
+        # Устаревший ответ всё равно перепроверяется, а ответы для неактивных
+        # пользователей при следующем обращении читаются из базы
+        stale = [
+            user_id for user_id, entry in self._entries.items()
+            if user_id not in self._active or not (entry[1] or self._fresh(entry, now))
+        ]
+        for user_id in stale:
+            del self._entries[user_id]
+        return removed + len(stale)
+
+subscription_cache = SubscriptionCache(db, SUBSCRIPTION_TTL, SUBSCRIPTION_NEGATIVE_TTL)
+
+# ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 
 def main_menu():
     """Главное меню (кнопки ВНУТРИ сообщений)"""
@@ -170,6 +751,14 @@ def main_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def variants_menu(selected: int):
+    """Выбор числа вариантов за один запрос"""
+    buttons = [
+        InlineKeyboardButton(f"✅ {n}" if n == selected else str(n), callback_data=f"variants_{n}")
+        for n in range(1, MAX_VARIANTS + 1)
+    ]
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🎲 Вариантов за раз:", callback_data="variants_info")], buttons])
+
 def get_restart_count():
     """Получение количества перезапусков"""
     try:
@@ -178,77 +767,1152 @@ def get_restart_count():
     except:
         return 0
 
+# ==================== ХОД ГЕНЕРАЦИИ И ОТМЕНА ====================
+# Статусы предсказания Replicate, которые показываются пользователю
+STATUS_TEXT = {
+    "starting": "⏳ Запуск модели",
+    "processing": "🎨 Генерация изображения",
+}
+CANCELED_RESULT = {"error": "🚫 Генерация отменена, она не списана.", "canceled": True}
+
+class GenerationCanceled(Exception):
+    """Пользователь отменил генерацию"""
+
+def cancel_keyboard(job_id: int):
+    """Кнопка отмены под сообщением о статусе задачи"""
+    if job_id is None:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Отменить", callback_data=f"cancel_{job_id}")]])
+
+async def edit_status(bot, job, text: str, reply_markup=None):
+    """Правка сообщения о статусе задачи; False — сообщения нет или правка не удалась"""
+    if not job.status_message_id:
+        return False
+    try:
+        await bot.edit_message_text(
+            text, chat_id=job.chat_id, message_id=job.status_message_id, reply_markup=reply_markup
+        )
+    except BadRequest as e:
+        # Текст не изменился — сообщение и так актуально
+        return "not modified" in str(e).lower()
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось обновить статус задачи {job.id}: {e}")
+        return False
+    return True
+
+class GenerationProgress:
+    """Ход генерации в сообщении о статусе задачи.
+
+    Правки прореживаются: Telegram ограничивает частоту запросов, а опрос
+    предсказания идёт чаще, чем стоит обновлять сообщение.
+    """
+
+    def __init__(self, bot, job):
+        self.bot = bot
+        self.job = job
+        self.started = time.monotonic()
+        self.status = None
+        self._edited = 0.0
+        self._checked = None
+        self.edits = 0
+
+    async def update(self, status: str):
+        """Статус предсказания и прошедшее время в сообщении о статусе"""
+        if self.job.canceled or not self.job.status_message_id:
+            return
+        now = time.monotonic()
+        interval = 1.0 if status != self.status else PROGRESS_EDIT_INTERVAL
+        if now - self._edited < interval:
+            return
+        self.status = status
+        self._edited = now
+        text = f"{STATUS_TEXT.get(status, STATUS_TEXT['processing'])}... {now - self.started:.0f}с"
+        if await edit_status(self.bot, self.job, text, cancel_keyboard(self.job.id)):
+            self.edits += 1
+
+    async def cancel_requested(self, force: bool = False):
+        """Нажал ли пользователь «Отменить».
+
+        Кнопка в этом процессе выставляет событие задачи; флаг в базе (отмена
+        из другого процесса) читается при первой проверке, затем не чаще
+        раза в CANCEL_CHECK_INTERVAL секунд, а с force — всегда.
+        """
+        if self.job.canceled or self.job.id is None:
+            return self.job.canceled
+        event = cancel_events.get(self.job.id)
+        if event is not None and event.is_set():
+            self.job.canceled = True
+            return True
+        now = time.monotonic()
+        if force or self._checked is None or now - self._checked >= CANCEL_CHECK_INTERVAL:
+            self._checked = now
+            self.job.canceled, message_id = await db.job_progress(self.job.id)
+            # Воркер мог взять задачу раньше, чем сохранилось сообщение о позиции
+            self.job.status_message_id = self.job.status_message_id or message_id
+        return self.job.canceled
+
+    def shared(self):
+        """Ждут ли ту же генерацию другие задачи: тогда её нельзя отменять"""
+        return bool(self.job.flight_key) and single_flight.shared(self.job.flight_key)
+
+    async def finish(self):
+        """Итог в сообщении о статусе вместо кнопки отмены"""
+        if not self.job.canceled:
+            await edit_status(
+                self.bot, self.job, f"⌛ Генерация завершена за {time.monotonic() - self.started:.0f}с"
+            )
+
+# События отмены задач, выполняющихся в этом процессе: job_id → asyncio.Event
+cancel_events = {}
+
+async def cancel_prediction(prediction_id: str, backend=None):
+    """Отмена предсказания: освобождает мощности, результат больше никто не ждёт.
+
+    Без backend отменяется через первый бэкенд — в Replicate отмена не зависит от модели.
+    """
+    backend = backend or generation_router.backends[0]
+    try:
+        await call_replicate(backend.cancel, prediction_id, guarded=False)
+        logger.info(f"🚫 Предсказание {prediction_id} отменено")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось отменить предсказание {prediction_id}: {e}")
+
+async def release_canceled(outcome: dict):
+    """Возврат резервов отменённой задачи и отмена её предсказаний, которые больше никто не ждёт"""
+    holds = []
+    if outcome["status"] == "queued":
+        holds = json.loads(outcome["payload"]).get("holds") or []
+    for prediction_id, hold_id, shared in outcome["predictions"]:
+        holds.append(hold_id)
+        if not shared:
+            spawn(cancel_prediction(prediction_id))
+    for hold_id in holds:
+        if hold_id is not None:
+            await db.release_hold(hold_id)
+
 # ==================== ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ ====================
-async def generate_image(prompt: str, images: list = None):
-    """Генерация изображения через Replicate"""
+def extract_output(output):
+    """Первое изображение из результата модели"""
+    if output:
+        if isinstance(output, list) and len(output) > 0:
+            return output[0]
+        return output
+    return None
+
+def generation_error(error_msg: str):
+    """Понятное пользователю описание ошибки генерации"""
+    error_msg = error_msg.lower()
+    if "insufficient credit" in error_msg:
+        return {"error": "⚠️ Недостаточно средств на аккаунте Replicate."}
+    elif "flagged as sensitive" in error_msg:
+        return {"error": "🚫 Запрос отклонён цензурой. Измените формулировку."}
+    else:
+        return {"error": "❌ Ошибка при генерации. Попробуйте позже."}
+
+def should_fall_back(e: Exception) -> bool:
+    """Поможет ли другой бэкенд: да, если ошибка говорит о неисправности модели или сервиса"""
+    # Открытый предохранитель и нехватка средств касаются всего аккаунта Replicate
+    return isinstance(e, GenerationError) and e.counts and e.kind not in ("busy", "billing")
+
+async def run_prediction(backend, prompt: str, images: list = None, progress: GenerationProgress = None):
+    """Генерация на одном бэкенде: предсказание опрашивается, пока не завершится.
+
+    progress получает статус предсказания и может запросить отмену
+    (тогда GenerationCanceled).
+    """
+    input_data = backend.build_input(prompt, images)
+    logger.debug(f"📦 Входные данные ({backend.name}): {input_data}")
+
+    async with generation_slot():
+        prediction = await call_replicate(backend.create, input_data)
+        try:
+            while prediction.status not in ("succeeded", "failed", "canceled"):
+                if progress is not None:
+                    await progress.update(prediction.status)
+                    if await progress.cancel_requested() and not progress.shared():
+                        await cancel_prediction(prediction.id, backend)
+                        raise GenerationCanceled(prediction.id)
+                await asyncio.sleep(REPLICATE_POLL_INTERVAL)
+                prediction = await call_replicate(backend.get, prediction.id, guarded=False)
+        except asyncio.CancelledError:
+            # Первым ответил другой бэкенд: это предсказание больше никому не нужно
+            spawn(cancel_prediction(prediction.id, backend))
+            raise
+
+    if prediction.status == "canceled":
+        raise GenerationCanceled(prediction.id)
+    if prediction.status == "failed":
+        from replicate.exceptions import ModelError
+
+        error = classify_error(ModelError(str(prediction.error or "")))
+        REPLICATE_ERRORS.inc(kind=error.kind)
+        replicate_breaker.record(error)
+        raise error
+    return extract_output(prediction.output)
+
+async def generate_image(prompt: str, images: list = None, progress: GenerationProgress = None):
+    """Генерация изображения на бэкенде, выбранном маршрутизатором; ошибки — GenerationError"""
+    logger.info(f"🎨 Отправка запроса на генерацию: {prompt[:50]}...")
+
+    # Добавим замер времени
+    start_time = time.time()
+
+    try:
+        output = await generation_router.run(
+            partial(run_prediction, prompt=prompt, images=images, progress=progress),
+            len(images or []),
+            fallback_on=should_fall_back,
+        )
+    except NoBackend as e:
+        raise GenerationError("invalid", str(e), counts=False) from e
+    except AttemptCanceled as e:
+        raise GenerationError("unknown", str(e), counts=False) from e
+
+    elapsed = time.time() - start_time
+    logger.info(f"✅ Генерация завершена за {elapsed:.2f}с")
+    logger.debug(f"📤 Результат: {output}")
+
+    return output
+
+async def start_prediction(prompt: str, images: list = None):
+    """Создание предсказания без ожидания: результат придёт на вебхук.
+
+    Ответа здесь не ждут, поэтому дублирования и запасного бэкенда нет —
+    предсказание уходит основному бэкенду маршрутизатора.
+    """
+    candidates = generation_router.candidates(len(images or []))
+    if not candidates:
+        raise GenerationError("invalid", "ни один бэкенд не принимает входные фото", counts=False)
+    backend = candidates[0]
+    prediction = await call_replicate(
+        backend.create,
+        backend.build_input(prompt, images),
+        webhook=f"{RENDER_URL}{REPLICATE_WEBHOOK_PATH}",
+    )
+    logger.info(f"📨 Предсказание {prediction.id} создано на {backend.name}, ждём вебхук")
+    return prediction.id
+
+async def generate_image_with_retry(prompt: str, images: list = None, progress: GenerationProgress = None):
+    """Генерация с повтором временных ошибок; ошибка возвращается как {"error": ...}"""
     try:
-        input_data = {"prompt": prompt}
-        if images:
-            input_data["image_input"] = images
+        return await generate_image(prompt, images, progress)
+    except GenerationCanceled:
+        return CANCELED_RESULT
+    except GenerationError as e:
+        logger.error(f"❌ Ошибка генерации ({e.kind}): {e}")
+        if e.retryable:
+            return {"error": "❌ Не удалось сгенерировать после нескольких попыток. Сервис временно недоступен."}
+        return {"error": e.user_message}
+
+# ==================== КЭШ РЕЗУЛЬТАТОВ ====================
+# Описание, начинающееся с этого символа, всегда генерируется заново
+FRESH_PREFIX = "!"
+
+def split_fresh_flag(prompt: str):
+    """Отделение признака «новый вариант» от описания"""
+    if prompt.startswith(FRESH_PREFIX):
+        return prompt[len(FRESH_PREFIX):].strip(), True
+    return prompt, False
+
+def request_key(prompt: str, image_ids: list):
+    """Ключ запроса: хэш нормализованного описания и file_unique_id фото"""
+    normalized = " ".join(prompt.lower().split())
+    payload = normalized + "|" + ",".join(image_ids)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResultCache:
+    """Кэш готовых изображений: нормализованный запрос → file_id в Telegram.
+
+    Попадание отправляется повторно по file_id, без обращения к Replicate
+    и без загрузки файла.
+    """
+
+    def __init__(self, storage: Storage, enabled: bool, ttl: int, max_entries: int):
+        self.storage = storage
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, prompt: str, image_ids: list):
+        """Ключ кэша для запроса или None, если кэш отключён"""
+        if not self.enabled:
+            return None
+        return request_key(prompt, image_ids)
+
+    async def get(self, key: str):
+        """file_id сохранённого результата или None"""
+        file_id = await self.storage.cache_get(key, self.ttl)
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
 
-        logger.info(f"🎨 Отправка запроса в Replicate: {prompt[:50]}...")
-        logger.info(f"📦 Входные данные: {input_data}")
-        
-        # Добавим замер времени
-        start_time = time.time()
-        
-        output = replicate_client.run(
-            "google/nano-banana",
-            input=input_data,
+    async def put(self, key: str, file_id: str):
+        """Сохранение результата"""
+        await self.storage.cache_put(key, file_id)
+
+    async def evict(self, deadline: float = None):
+        """Чистка по TTL и размеру (плановое обслуживание)"""
+        return await self.storage.cache_evict(self.max_entries, self.ttl, deadline)
+
+result_cache = ResultCache(db, RESULT_CACHE_ENABLED, RESULT_CACHE_TTL, RESULT_CACHE_SIZE)
+
+# ==================== ПЕРЕВОД ОПИСАНИЙ ====================
+def build_translator():
+    """Переводчик описаний по TRANSLATOR или None, если перевод выключен"""
+    if TRANSLATOR == "off":
+        return None
+    if TRANSLATOR == "stub":
+        backend = StubTranslator(float(os.getenv("TRANSLATOR_STUB_LATENCY", "0")))
+    else:
+        backend = GoogleTranslator()
+    return PromptTranslator(db, backend, TRANSLATION_BUDGET, max_entries=TRANSLATION_CACHE_SIZE)
+
+prompt_translator = build_translator()
+
+async def prepare_prompt(prompt: str) -> str:
+    """Описание, которое уходит в модель: переведённое на английский, если нужно"""
+    if prompt_translator is None or not prompt:
+        return prompt
+    return await prompt_translator.translate(prompt)
+
+# ==================== ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ ====================
+class SingleFlight:
+    """Одна генерация на все одновременные задачи с одинаковым ключом.
+
+    Общая генерация защищена shield: таймаут или отмена одного ожидающего
+    не прерывают её для остальных.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        # Сколько задач сейчас ждут генерацию с этим ключом
+        self._waiting = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def shared(self, key):
+        """Ждёт ли генерацию с этим ключом больше одной задачи"""
+        return self._waiting.get(key, 0) > 1
+
+    def _forget(self, key, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, factory, timeout: float = None):
+        """Результат factory() — своей или уже идущей генерации с тем же ключом"""
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._flights[key] = task
+            task.add_done_callback(partial(self._forget, key))
+            self.leaders += 1
+        else:
+            self.followers += 1
+            logger.info("🔗 Запрос присоединён к уже выполняющемуся")
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+
+single_flight = SingleFlight()
+
+# ==================== ДОСТАВКА РЕЗУЛЬТАТОВ ====================
+# Результат скачивается из Replicate один раз через общую сессию и загружается
+# в Telegram файлом: Telegram больше не ходит за ним сам, а повторные
+# отправки идут по file_id.
+PHOTO_MAX_BYTES = 10 * 1024 * 1024  # предел Telegram для фото, загружаемого файлом
+DOCUMENT_PREFIX = "document:"  # так помечается file_id результата, отправленного документом
+SEND_ATTEMPTS = 3
+
+http_session = None  # aiohttp.ClientSession, создаётся в post_init
+download_flight = SingleFlight()
+
+class ResultTooLarge(Exception):
+    """Результат больше MAX_RESULT_BYTES"""
+
+@dataclass
+class DeliveryStats:
+    """Счётчики отправки результатов"""
+    photos: int = 0
+    albums: int = 0
+    documents: int = 0
+    by_file_id: int = 0
+    url_fallbacks: int = 0
+    bytes: int = 0
+    download_seconds: float = 0.0
+    upload_seconds: float = 0.0
+
+delivery_stats = DeliveryStats()
+
+async def open_http_session():
+    """Создание общей сессии с пулом соединений"""
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    )
+
+async def close_http_session():
+    """Закрытие общей сессии"""
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+async def download_result(url: str) -> bytes:
+    """Скачивание результата с ограничением размера"""
+    started = time.monotonic()
+    with span("download"):
+        async with http_session.get(url) as response:
+            response.raise_for_status()
+            if (response.content_length or 0) > MAX_RESULT_BYTES:
+                raise ResultTooLarge(response.content_length)
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > MAX_RESULT_BYTES:
+                    raise ResultTooLarge(len(data))
+    delivery_stats.download_seconds += time.monotonic() - started
+    delivery_stats.bytes += len(data)
+    return bytes(data)
+
+async def upload_result(bot, chat_id: int, data: bytes, filename: str, reply_to=None) -> str:
+    """Загрузка изображения в Telegram: фото, а если не подходит — документом"""
+    as_document = len(data) > PHOTO_MAX_BYTES
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        started = time.monotonic()
+        try:
+            if not as_document:
+                try:
+                    message = await bot.send_photo(
+                        chat_id, InputFile(data, filename=filename), reply_to_message_id=reply_to
+                    )
+                    delivery_stats.photos += 1
+                    return message.photo[-1].file_id
+                except BadRequest as e:
+                    # Например, слишком вытянутое изображение — документом Telegram его примет
+                    logger.warning(f"⚠️ Telegram не принял фото ({e}), отправляем документом")
+                    as_document = True
+            message = await bot.send_document(
+                chat_id, InputFile(data, filename=filename), reply_to_message_id=reply_to
+            )
+            delivery_stats.documents += 1
+            return DOCUMENT_PREFIX + message.document.file_id
+        except BadRequest:
+            raise
+        except (TimedOut, NetworkError) as e:
+            if attempt == SEND_ATTEMPTS:
+                raise
+            logger.warning(f"⚠️ Попытка {attempt} загрузки результата не удалась: {e}")
+        finally:
+            delivery_stats.upload_seconds += time.monotonic() - started
+        await asyncio.sleep(attempt)
+
+async def send_album(bot, chat_id: int, results: list, reply_to=None) -> list:
+    """Отправка нескольких вариантов одной медиагруппой; возвращает их file_id.
+
+    Если собрать альбом не получилось (файл не скачался, слишком большой
+    или Telegram его не принял), варианты отправляются по одному.
+    """
+    try:
+        media = []
+        for result in results:
+            if not result.startswith(("http://", "https://")):
+                if result.startswith(DOCUMENT_PREFIX):
+                    raise ResultTooLarge(result)
+                media.append(InputMediaPhoto(result))
+                continue
+            data = await download_flight.run(result, partial(download_result, result), HTTP_TIMEOUT)
+            if len(data) > PHOTO_MAX_BYTES:
+                raise ResultTooLarge(len(data))
+            filename = os.path.basename(urlparse(result).path) or "image.png"
+            media.append(InputMediaPhoto(InputFile(data, filename=filename)))
+
+        for attempt in range(1, SEND_ATTEMPTS + 1):
+            started = time.monotonic()
+            try:
+                messages = await bot.send_media_group(chat_id, media, reply_to_message_id=reply_to)
+                break
+            except BadRequest:
+                raise
+            except (TimedOut, NetworkError) as e:
+                if attempt == SEND_ATTEMPTS:
+                    raise
+                logger.warning(f"⚠️ Попытка {attempt} отправки альбома не удалась: {e}")
+            finally:
+                delivery_stats.upload_seconds += time.monotonic() - started
+            await asyncio.sleep(attempt)
+    except (ResultTooLarge, BadRequest, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"⚠️ Альбом не собран ({e!r}), отправляем варианты по одному")
+        file_ids = []
+        for result in results:
+            try:
+                file_ids.append(await send_result(bot, chat_id, result, reply_to))
+            except Exception as send_error:
+                logger.error(f"Ошибка отправки варианта: {send_error}")
+        return file_ids
+
+    delivery_stats.albums += 1
+    delivery_stats.photos += len(messages)
+    return [message.photo[-1].file_id for message in messages]
+
+async def send_result(bot, chat_id: int, result: str, reply_to=None):
+    """Отправка результата (URL Replicate или file_id); возвращает file_id для повторного использования"""
+    if not result.startswith(("http://", "https://")):
+        delivery_stats.by_file_id += 1
+        if result.startswith(DOCUMENT_PREFIX):
+            await bot.send_document(chat_id, result[len(DOCUMENT_PREFIX):], reply_to_message_id=reply_to)
+        else:
+            await bot.send_photo(chat_id, result, reply_to_message_id=reply_to)
+        return result
+
+    try:
+        # Результат объединённых запросов скачивается один раз
+        data = await download_flight.run(result, partial(download_result, result), HTTP_TIMEOUT)
+    except ResultTooLarge as e:
+        logger.warning(f"⚠️ Результат слишком большой для отправки: {e} байт")
+        await bot.send_message(
+            chat_id,
+            f"📎 Изображение слишком большое для Telegram, скачайте его по ссылке:\n{result}",
+            reply_to_message_id=reply_to,
         )
-        
-        elapsed = time.time() - start_time
-        logger.info(f"✅ Генерация завершена за {elapsed:.2f}с")
-        logger.info(f"📤 Результат: {output}")
-
-        if output:
-            if isinstance(output, list) and len(output) > 0:
-                return output[0]
-            return output
         return None
-        
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Не удалось скачать самим — пусть попробует Telegram
+        logger.warning(f"⚠️ Не удалось скачать результат ({e!r}), отправляем ссылкой")
+        delivery_stats.url_fallbacks += 1
+        message = await bot.send_photo(chat_id, result, reply_to_message_id=reply_to)
+        return message.photo[-1].file_id
+
+    filename = os.path.basename(urlparse(result).path) or "image.png"
+    return await upload_result(bot, chat_id, data, filename, reply_to)
+
+# ==================== ОЧЕРЕДЬ ГЕНЕРАЦИЙ ====================
+class QueueFull(Exception):
+    """Очередь генераций переполнена"""
+
+@dataclass
+class GenerationJob:
+    """Задача на генерацию изображения.
+
+    photo_ids — file_id входных фото; ссылки на файлы Telegram живут около
+    часа, поэтому в images они получаются только перед генерацией.
+    """
+    user_id: int
+    chat_id: int
+    prompt: str
+    photo_ids: list
+    is_admin: bool
+    priority: bool
+    reply_to: int
+    status_message_id: int = None
+    holds: list = field(default_factory=list)
+    variants: int = 1
+    cache_key: str = None
+    flight_key: str = None
+    images: list = field(default_factory=list)
+    id: int = None
+    attempts: int = 0
+    started: bool = False
+    canceled: bool = False
+    # Сколько вариантов доставлено и списано
+    delivered: int = 0
+    enqueued_at: float = field(default_factory=time.time)
+
+class JobQueue:
+    """Очередь генераций в таблице jobs: переживает перезапуски и общая для процессов.
+
+    Порядок выдачи задаёт storage: платные пользователи и админ — первыми,
+    внутри полосы пользователи по кругу. Воркер берёт задачу под аренду
+    и продлевает её, пока работает; задача упавшего воркера достаётся другому.
+    """
+
+    def __init__(self, storage: Storage, workers: int, max_size: int, max_per_user: int, lease: int):
+        self.storage = storage
+        self.workers = workers
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.lease = lease
+        # Длина очереди на момент последней постановки или выдачи задачи
+        self.depth = 0
+        self.avg_duration = 20.0
+        self._duration_checked = 0.0
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return self.depth
+
+    async def submit(self, job: GenerationJob):
+        """Постановка задачи в очередь, возвращает позицию (с 1)"""
+        job_id, position, active = await self.storage.enqueue_job(
+            job.user_id, job.priority, job_payload(job), self.max_size, self.max_per_user
+        )
+        if job_id is None:
+            raise QueueFull(position)
+        job.id = job_id
+        self.depth = active
+        self._wakeup.set()
+        return position
+
+    async def claim(self, owner: str):
+        """Следующая задача под аренду owner или None"""
+        row, self.depth = await self.storage.claim_job(owner, self.lease)
+        return job_from_row(row) if row else None
+
+    async def wait(self, timeout: float):
+        """Ожидание новой задачи этого процесса или истечения timeout"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def eta(self, position: int):
+        """Оценка ожидания в секундах по средней длительности генерации"""
+        if not self.workers and time.monotonic() - self._duration_checked > 60:
+            # Задачи выполняют другие процессы — средняя длительность берётся из базы
+            self._duration_checked = time.monotonic()
+            self.avg_duration = await self.storage.recent_job_duration() or self.avg_duration
+        return math.ceil(position / (self.workers or GENERATION_CONCURRENCY)) * self.avg_duration
+
+    def record_duration(self, seconds: float):
+        """Обновление скользящей средней длительности генерации"""
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * seconds
+
+# Поля задачи, которые хранятся в jobs.payload
+JOB_FIELDS = (
+    "user_id", "chat_id", "prompt", "photo_ids", "is_admin", "priority", "reply_to",
+    "holds", "variants", "cache_key", "flight_key",
+)
+
+def job_payload(job: GenerationJob) -> str:
+    """Задача в JSON для таблицы jobs"""
+    return json.dumps({name: getattr(job, name) for name in JOB_FIELDS}, ensure_ascii=False)
+
+def job_from_row(row: dict) -> GenerationJob:
+    """Задача из строки таблицы jobs"""
+    job = GenerationJob(**json.loads(row["payload"]))
+    job.id = row["id"]
+    job.attempts = row["attempts"]
+    job.status_message_id = row["status_message_id"]
+    job.enqueued_at = row["created_at"]
+    return job
+
+generation_queue = JobQueue(db, QUEUE_WORKERS, QUEUE_MAX_SIZE, QUEUE_MAX_PER_USER, JOB_LEASE)
+queue_workers = []
+# Остановка: воркеры не берут новые задачи и дорабатывают текущие
+draining = asyncio.Event()
+# Имя процесса в арендах задач
+WORKER_NAME = f"{platform.node()}:{os.getpid()}"
+
+async def settle_job(job: GenerationJob, delivered: int = 0):
+    """Списание резервов за доставленные варианты и возврат остальных"""
+    holds, job.holds = job.holds, []
+    job.delivered += delivered
+    for hold_id in holds[:delivered]:
+        await db.commit_hold(hold_id)
+    for hold_id in holds[delivered:]:
+        await db.release_hold(hold_id)
+
+async def deliver_result(bot, job: GenerationJob, result):
+    """Отправка результата пользователю и списание генерации.
+
+    Возвращает file_id отправленного изображения или None.
+    """
+    if isinstance(result, dict) and "error" in result:
+        await settle_job(job)
+        # Об отмене сообщает само сообщение о статусе, где была кнопка
+        if not (result.get("canceled") and await edit_status(bot, job, result["error"], main_menu())):
+            await bot.send_message(job.chat_id, result["error"])
+        await end_generation_session(job.user_id)
+        return None
+
+    if not result:
+        await settle_job(job)
+        await bot.send_message(job.chat_id, "❌ Генерация не дала результата.")
+        await end_generation_session(job.user_id)
+        return None
+
+    # Отправляем результат
+    try:
+        kind = "url" if result.startswith(("http://", "https://")) else "file_id"
+        with DELIVERY_SECONDS.time(kind=kind), span("send_photo"):
+            file_id = await send_result(bot, job.chat_id, result, job.reply_to)
+    except Exception as photo_error:
+        logger.error(f"Ошибка отправки фото: {photo_error}")
+        await settle_job(job)
+        await bot.send_message(job.chat_id, "❌ Ошибка при отправке изображения.")
+        return None
+
+    # Списание резерва (у админа резерва нет); резервы других вариантов возвращаются
+    await settle_job(job, 1)
+
+    if job.cache_key and file_id:
+        try:
+            await result_cache.put(job.cache_key, file_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи в кэш результатов: {e}")
+
+    await end_generation_session(job.user_id)
+    await send_done_message(bot, job, "✅ Готово! Нажмите «Сгенерировать» для нового запроса.")
+    return file_id
+
+async def send_done_message(bot, job: GenerationJob, text: str):
+    """Итоговое сообщение после доставки: генерация уже списана, поэтому его ошибка задачу не срывает"""
+    try:
+        await bot.send_message(job.chat_id, text, reply_markup=main_menu())
     except Exception as e:
-        error_msg = str(e).lower()
-        logger.error(f"❌ Ошибка генерации: {error_msg}", exc_info=True)
-        
-        if "insufficient credit" in error_msg:
-            return {"error": "⚠️ Недостаточно средств на аккаунте Replicate."}
-        elif "flagged as sensitive" in error_msg:
-            return {"error": "🚫 Запрос отклонён цензурой. Измените формулировку."}
+        logger.warning(f"⚠️ Не удалось отправить итог задачи {job.id}: {e}")
+
+async def deliver_variants(bot, job: GenerationJob, results: list):
+    """Отправка вариантов одним альбомом и списание только за доставленные"""
+    images = [result for result in results if isinstance(result, str) and result]
+    if len(images) <= 1:
+        errors = [result for result in results if isinstance(result, dict)]
+        await deliver_result(bot, job, images[0] if images else (errors[0] if errors else None))
+        return
+
+    try:
+        with DELIVERY_SECONDS.time(kind="album"), span("send_album"):
+            file_ids = await send_album(bot, job.chat_id, images, job.reply_to)
+    except Exception as e:
+        logger.error(f"Ошибка отправки альбома: {e}")
+        file_ids = []
+    delivered = len(file_ids)
+    await settle_job(job, delivered)
+    logger.info(f"🖼 Доставлено вариантов {delivered}/{job.variants} для {job.user_id}")
+
+    await end_generation_session(job.user_id)
+    if not delivered:
+        await bot.send_message(job.chat_id, "❌ Ошибка при отправке изображения.")
+        return
+    missing = job.variants - delivered
+    note = f"\n↩️ Не получилось вариантов: {missing}, они не списаны." if missing else ""
+    await send_done_message(bot, job, f"✅ Готово!{note} Нажмите «Сгенерировать» для нового запроса.")
+
+async def resolve_images(bot, job: GenerationJob):
+    """Ссылки на входные фото задачи по их file_id"""
+    if job.images or not job.photo_ids:
+        return
+    with span("get_file"):
+        files = await asyncio.gather(*(bot.get_file(file_id) for file_id in job.photo_ids), return_exceptions=True)
+    for file in files:
+        if isinstance(file, Exception):
+            logger.error(f"Ошибка получения фото: {file}")
+        else:
+            job.images.append(file.file_path)
+
+async def process_generation_job(bot, job: GenerationJob):
+    """Выполнение задачи: генерация, отправка результата и списание"""
+    if job.id is not None and await db.cancel_requested(job.id):
+        # Отмену нажали, пока задача была у воркера, который не успел её выполнить
+        job.canceled = True
+        await deliver_result(bot, job, CANCELED_RESULT)
+        return
+
+    if job.cache_key:
+        file_id = await result_cache.get(job.cache_key)
+        if file_id:
+            logger.info(f"♻️ Результат для {job.user_id} взят из кэша")
+            job.cache_key = None
+            await deliver_result(bot, job, file_id)
+            return
+
+    # Ссылки на фото и перевод описания готовятся одновременно
+    _, prompt = await asyncio.gather(resolve_images(bot, job), prepare_prompt(job.prompt))
+
+    if REPLICATE_WEBHOOK_MODE:
+        await submit_webhook_job(bot, job, prompt)
+        return
+
+    progress = GenerationProgress(bot, job)
+    if job.variants > 1:
+        # Варианты генерируются параллельно, каждый своим вызовом Replicate
+        results = await asyncio.gather(*(
+            generate_image_with_retry(prompt, job.images or None, progress) for _ in range(job.variants)
+        ))
+    else:
+        generate = partial(generate_image_with_retry, prompt, job.images or None, progress)
+        if job.flight_key:
+            try:
+                result = await single_flight.run(job.flight_key, generate, SINGLE_FLIGHT_TIMEOUT)
+            except asyncio.TimeoutError:
+                result = {"error": "⌛ Генерация заняла слишком много времени. Попробуйте ещё раз."}
         else:
-            return {"error": "❌ Ошибка при генерации. Попробуйте позже."}
+            result = await generate()
 
-async def generate_image_with_retry(prompt: str, images: list = None, max_retries: int = 3):
-    """Генерация изображения с повторными попытками"""
-    for attempt in range(max_retries):
+    # Отмену могли нажать и под общей генерацией, которую ждут другие задачи
+    if await progress.cancel_requested(force=True):
+        await deliver_result(bot, job, CANCELED_RESULT)
+        return
+    await progress.finish()
+    if job.variants > 1:
+        await deliver_variants(bot, job, results)
+        return
+    if isinstance(result, dict) and result.get("canceled"):
+        # Общую генерацию отменила задача, которая не успела увидеть присоединившуюся
+        result = {"error": "❌ Генерация прервана, она не списана. Попробуйте ещё раз."}
+    await deliver_result(bot, job, result)
+
+async def submit_webhook_job(bot, job: GenerationJob, prompt: str):
+    """Запуск (или присоединение к) предсказаниям, результат которых придёт вебхуком.
+
+    Каждый вариант — отдельное предсказание со своим резервом; варианты
+    доставляются по мере готовности.
+    """
+    if job.id is not None and not job.status_message_id:
+        # Воркер мог взять задачу раньше, чем сохранилось сообщение о позиции
+        _, job.status_message_id = await db.job_progress(job.id)
+    fields = {
+        "user_id": job.user_id,
+        "chat_id": job.chat_id,
+        "reply_to": job.reply_to,
+        "status_message_id": job.status_message_id,
+        "is_admin": int(job.is_admin),
+        "cache_key": job.cache_key,
+        "flight_key": job.flight_key,
+        "job_id": job.id,
+    }
+    # У админа резервов нет
+    holds, job.holds = job.holds or [None] * job.variants, []
+    failed = []
+    error = None
+
+    for hold_id in holds:
+        prediction_id = None
+        if job.flight_key:
+            prediction_id = await db.attach_pending_prediction(hold_id=hold_id, **fields)
+            if prediction_id:
+                single_flight.followers += 1
+                logger.info(f"🔗 Задача {job.user_id} присоединена к предсказанию {prediction_id}")
+                continue
+
+        start = partial(start_prediction, prompt, job.images or None)
         try:
-            logger.info(f"🔄 Попытка {attempt + 1}/{max_retries}")
-            result = await generate_image(prompt, images)
-            
-            if result and not (isinstance(result, dict) and "error" in result):
-                return result
-            
-            # Если это не ошибка 502, возвращаем сразу
-            if isinstance(result, dict) and "error" in result:
-                if "502" not in result["error"].lower() and "bad gateway" not in result["error"].lower():
-                    return result
-                    
+            if job.flight_key:
+                prediction_id = await single_flight.run(("prediction", job.flight_key), start)
+            else:
+                prediction_id = await start()
         except Exception as e:
-            logger.error(f"❌ Попытка {attempt + 1}/{max_retries} не удалась: {e}")
-        
-        if attempt < max_retries - 1:
-            wait_time = 2 ** attempt  # 1, 2, 4 секунды
-            logger.info(f"⏳ Повторная попытка через {wait_time}с...")
-            await asyncio.sleep(wait_time)
-    
-    return {"error": "❌ Не удалось сгенерировать после нескольких попыток. Сервис временно недоступен."}
+            error = classify_error(e)
+            logger.error(f"❌ Ошибка создания предсказания ({error.kind}): {e}")
+            failed.append(hold_id)
+            continue
+        # Резерв теперь закрывает обработчик вебхука
+        await db.add_pending_prediction(prediction_id, hold_id=hold_id, **fields)
+
+    job.holds = [hold_id for hold_id in failed if hold_id is not None]
+    if job.id is not None and await db.cancel_requested(job.id):
+        # Отмену нажали, пока создавались предсказания: снимаем уже созданные
+        await release_canceled(await db.request_cancel(job.id, job.user_id))
+        job.canceled = True
+        await deliver_result(bot, job, CANCELED_RESULT)
+    elif len(failed) == len(holds):
+        await deliver_result(bot, job, {"error": error.user_message})
+    else:
+        await settle_job(job)
+
+async def keep_job_lease(job: GenerationJob, owner: str):
+    """Продление аренды, пока задача выполняется"""
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        try:
+            if not await db.extend_job_lease(job.id, owner, JOB_LEASE):
+                logger.warning(f"⚠️ Аренда задачи {job.id} перешла к другому воркеру")
+                return
+        except Exception as e:
+            logger.error(f"❌ Ошибка продления аренды задачи {job.id}: {e}")
+
+JOB_FAILED_MESSAGE = "❌ Не удалось выполнить генерацию, она не списана. Попробуйте ещё раз."
+
+async def notify_job_failed(bot, job: GenerationJob):
+    """Сообщение о сорвавшейся задаче: в сообщении о статусе (вместо кнопки отмены) или новым"""
+    await end_generation_session(job.user_id)
+    try:
+        if not await edit_status(bot, job, JOB_FAILED_MESSAGE, main_menu()):
+            await bot.send_message(job.chat_id, JOB_FAILED_MESSAGE)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось сообщить об ошибке задачи {job.id}: {e}")
+
+async def fail_exhausted_job(bot, job: GenerationJob, owner: str):
+    """Задача, которую прерывали слишком много раз: возврат резервов и сообщение"""
+    logger.error(f"❌ Задача {job.id} прервана {job.attempts - 1} раз, отменяем")
+    await settle_job(job)
+    await db.finish_job(job.id, owner, "failed")
+    await notify_job_failed(bot, job)
+
+async def run_job(bot, job: GenerationJob, owner: str):
+    """Выполнение задачи из очереди под арендой"""
+    if job.attempts > JOB_MAX_ATTEMPTS:
+        await fail_exhausted_job(bot, job, owner)
+        return
+
+    job.started = True
+    waited = time.time() - job.enqueued_at
+    if job.attempts == 1:
+        QUEUE_WAIT_SECONDS.observe(waited)
+        logger.info(f"👷 {owner}: задача {job.id} ({job.user_id}) после {waited:.1f}с в очереди")
+    else:
+        logger.info(f"🔁 {owner}: задача {job.id} ({job.user_id}) продолжена, попытка {job.attempts}")
+
+    await edit_status(bot, job, "⏳ Генерация изображения...", cancel_keyboard(job.id))
+
+    lease = asyncio.create_task(keep_job_lease(job, owner))
+    cancel_events[job.id] = asyncio.Event()
+    started = time.monotonic()
+    status = "failed"
+    try:
+        with tracer.trace("generation_job", user_id=job.user_id, queue_wait_ms=round(waited * 1000)):
+            await process_generation_job(bot, job)
+        status = "canceled" if job.canceled else "done"
+    except asyncio.CancelledError:
+        if job.delivered:
+            # Результат уже доставлен и списан — повторять задачу нельзя
+            await asyncio.shield(db.finish_job(job.id, owner, "done"))
+            raise
+        # Остановка не дождалась задачи: резервы остаются, задачу продолжит другой воркер
+        await asyncio.shield(db.requeue_job(job.id, owner))
+        logger.warning(f"↩️ Задача {job.id} возвращена в очередь")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка задачи {job.id}: {e}", exc_info=True)
+        if job.delivered:
+            # Ошибка после доставки: генерация списана, задача выполнена
+            status = "done"
+    finally:
+        lease.cancel()
+        cancel_events.pop(job.id, None)
+
+    generation_queue.record_duration(time.monotonic() - started)
+    JOB_SECONDS.observe(time.monotonic() - started)
+    # Задача оборвалась ошибкой — генерация не списывается
+    await settle_job(job)
+    await db.finish_job(job.id, owner, status)
+    if status == "failed":
+        await notify_job_failed(bot, job)
+
+async def generation_worker(bot, worker_id: int):
+    """Воркер очереди генераций: берёт задачи, пока не началась остановка"""
+    owner = f"{WORKER_NAME}:{worker_id}"
+    while not draining.is_set():
+        try:
+            job = await generation_queue.claim(owner)
+        except Exception as e:
+            logger.error(f"❌ Воркер {worker_id}: ошибка очереди: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        if job is None:
+            await generation_queue.wait(JOB_POLL_INTERVAL)
+            continue
+        await run_job(bot, job, owner)
+
+def start_queue_workers(bot):
+    """Запуск пула воркеров очереди"""
+    for worker_id in range(generation_queue.workers):
+        queue_workers.append(asyncio.create_task(generation_worker(bot, worker_id)))
+    logger.info(f"✅ Запущено воркеров очереди: {generation_queue.workers}")
+
+async def stop_queue_workers(timeout: float):
+    """Остановка воркеров: текущие задачи дорабатываются до timeout секунд,
+    незавершённые возвращаются в очередь и продолжатся после перезапуска"""
+    draining.set()
+    generation_queue.wake()
+    tasks = queue_workers + list(background_tasks)
+    if tasks:
+        logger.info(f"⏳ Дожидаемся задач: {len(tasks)}, не дольше {timeout}с")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pending:
+            logger.warning(f"⚠️ Не дождались задач: {len(pending)}")
+    queue_workers.clear()
+
+# ==================== РАССЫЛКА ====================
+# Рассылка идёт с приоритетом BULK: ответы пользователям и платежи её обгоняют.
+# Прогресс (курсор по users.id) сохраняется каждые несколько секунд; после
+# перезапуска рассылку подхватывает процесс, получивший её аренду
+BROADCAST_LEASE = 60
+BROADCAST_SAVE_INTERVAL = 2.0
+BROADCAST_REPORT_INTERVAL = 10.0
+
+broadcast_task = None
+
+async def send_broadcast_message(bot, broadcast: dict, user_id: int):
+    """Сообщение рассылки одному пользователю: 'sent', 'blocked' или 'failed'"""
+    try:
+        with send_priority(BULK):
+            if broadcast["message_id"]:
+                # Копия сообщения админа — с фото, форматированием и кнопками
+                await bot.copy_message(user_id, broadcast["from_chat_id"], broadcast["message_id"])
+            else:
+                await bot.send_message(user_id, broadcast["text"])
+        return "sent"
+    except Forbidden:
+        return "blocked"
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            return "blocked"
+        logger.warning(f"⚠️ Рассылка пользователю {user_id}: {e}")
+        return "failed"
+    except Exception as e:
+        logger.warning(f"⚠️ Рассылка пользователю {user_id}: {e}")
+        return "failed"
+
+def broadcast_progress_text(broadcast: dict, progress: dict, remaining: int, rate: float = None):
+    """Строка прогресса рассылки для админа"""
+    text = (
+        f"📣 Рассылка #{broadcast['id']}: отправлено {progress['sent']}, "
+        f"заблокировали бота {progress['blocked']}, ошибок {progress['failed']}"
+    )
+    if remaining:
+        text += f", осталось ~{remaining}"
+    if rate:
+        text += f", {rate:.1f} сообщ./с"
+    return text
+
+async def run_broadcast(bot, broadcast: dict):
+    """Рассылка от курсора до конца списка пользователей или до остановки"""
+    broadcast_id = broadcast["id"]
+    progress = {name: broadcast[name] for name in ("cursor", "sent", "blocked", "failed")}
+    # id в порядке отправки → завершена ли отправка; курсор сдвигается
+    # только по непрерывному префиксу завершённых
+    in_flight = OrderedDict()
+    blocked_ids = []
+    slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    senders = set()
+    status = "running"
+    started = time.monotonic()
+    sent_before = progress["sent"]
+    handled_before = progress["sent"] + progress["blocked"] + progress["failed"]
+    remaining = await db.count_recipients(progress["cursor"])
+    report = None
+    if broadcast["admin_chat_id"]:
+        report = await bot.send_message(
+            broadcast["admin_chat_id"], broadcast_progress_text(broadcast, progress, remaining)
+        )
+    logger.info(f"📣 Рассылка #{broadcast_id} с id > {progress['cursor']}, получателей ~{remaining}")
+
+    async def send(user_id: int):
+        try:
+            outcome = await send_broadcast_message(bot, broadcast, user_id)
+        finally:
+            slots.release()
+        # Прерванная отправка не отмечается: курсор останется перед ней
+        progress[outcome] += 1
+        if outcome == "blocked":
+            blocked_ids.append(user_id)
+        in_flight[user_id] = True
+
+    async def save():
+        while in_flight and next(iter(in_flight.values())):
+            progress["cursor"] = in_flight.popitem(last=False)[0]
+        saved_blocked = blocked_ids[:]
+        blocked_ids.clear()
+        return await db.save_broadcast(broadcast_id, WORKER_NAME, progress, BROADCAST_LEASE, saved_blocked)
+
+    last_save = last_report = time.monotonic()
+    after_id = progress["cursor"]
+    try:
+        while status == "running":
+            recipients = await db.broadcast_recipients(after_id, BROADCAST_BATCH)
+            if not recipients:
+                break
+            for user_id in recipients:
+                await slots.acquire()
+                in_flight[user_id] = False
+                task = asyncio.create_task(send(user_id))
+                senders.add(task)
+                task.add_done_callback(senders.discard)
+                after_id = user_id
+
+                now = time.monotonic()
+                if now - last_save >= BROADCAST_SAVE_INTERVAL:
+                    last_save = now
+                    status = await save()
+                    if status != "running":
+                        break
+                if report and now - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = now
+                    rate = (progress["sent"] - sent_before) / (now - started)
+                    handled = progress["sent"] + progress["blocked"] + progress["failed"] - handled_before
+                    try:
+                        await report.edit_text(
+                            broadcast_progress_text(broadcast, progress, max(remaining - handled, 0), rate)
+                        )
+                    except Exception:
+                        pass
+        if senders:
+            await asyncio.gather(*senders)
+        status = await save()
+        if status == "running":
+            await db.release_broadcast(broadcast_id, WORKER_NAME, "done")
+            status = "done"
+    finally:
+        if status == "running":
+            # Прервана остановкой процесса: отправленное сохраняется, аренда снимается,
+            # и рассылку сразу подхватит следующий процесс
+            for task in senders:
+                task.cancel()
+            await asyncio.gather(*senders, return_exceptions=True)
+            try:
+                await save()
+                await db.release_broadcast(broadcast_id, WORKER_NAME)
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить прогресс рассылки #{broadcast_id}: {e}")
+
+    elapsed = time.monotonic() - started
+    rate = (progress["sent"] - sent_before) / elapsed if elapsed else 0
+    marks = {"done": "✅ Рассылка завершена", "stopped": "⏸ Рассылка остановлена"}
+    logger.info(f"📣 Рассылка #{broadcast_id}: {status}, {progress}, {rate:.1f} сообщ./с")
+    if broadcast["admin_chat_id"]:
+        await bot.send_message(
+            broadcast["admin_chat_id"],
+            f"{marks.get(status, status)}\n{broadcast_progress_text(broadcast, progress, 0, rate)}",
+        )
+    return progress
+
+async def resume_broadcast(bot):
+    """Запуск рассылки, которая идёт и не захвачена другим процессом"""
+    global broadcast_task
+    if broadcast_task is not None and not broadcast_task.done():
+        return False
+    broadcast = await db.claim_broadcast(WORKER_NAME, BROADCAST_LEASE)
+    if broadcast is None:
+        return False
+    broadcast_task = asyncio.create_task(run_broadcast(bot, broadcast))
+    broadcast_task.add_done_callback(log_broadcast_error)
+    return True
+
+def log_broadcast_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"❌ Ошибка рассылки: {task.exception()}", exc_info=task.exception())
+
+async def stop_broadcast_task():
+    """Прерывание рассылки при остановке процесса с сохранением прогресса"""
+    if broadcast_task is not None and not broadcast_task.done():
+        broadcast_task.cancel()
+        await asyncio.gather(broadcast_task, return_exceptions=True)
 
 # ==================== КОМАНДЫ ====================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     try:
         user_id = update.effective_user.id
-        get_user(user_id)
+        await db.get_user(user_id)
+        await db.unblock_user(user_id)
 
         text = (
             "👋 Привет! Я бот для генерации изображений с помощью нейросети Nano Banana.\n\n"
@@ -261,42 +1925,121 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"❌ Ошибка в start: {e}")
 
+HISTORY_LIMIT = 10
+TX_MARKS = {"buy": "⭐", "spend": "🎨"}
+
+def history_text(rows, summaries) -> str:
+    """Последние операции и итоги свёрнутых месяцев"""
+    lines = ["🧾 Последние операции:"] if rows else []
+    for tx_type, amount, created_at in rows:
+        when = datetime.fromisoformat(created_at).strftime("%d.%m %H:%M") if created_at else "—"
+        lines.append(f"{when}  {TX_MARKS.get(tx_type, '•')} {amount:+d}")
+    if summaries:
+        lines.append("\n📅 Ранее, по месяцам:")
+        for period, tx_type, amount, count in summaries:
+            lines.append(f"{period}  {TX_MARKS.get(tx_type, '•')} {amount:+d} ({count} опер.)")
+    return "\n".join(lines) or "🧾 Операций пока нет."
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """История баланса: /history [число операций, до 50]"""
+    try:
+        user_id = update.effective_user.id
+        try:
+            limit = min(max(int(context.args[0]), 1), 50) if context.args else HISTORY_LIMIT
+        except ValueError:
+            limit = HISTORY_LIMIT
+        balance = await db.get_user(user_id)
+        rows, summaries = await db.history(user_id, limit)
+        await update.message.reply_text(
+            f"{history_text(rows, summaries)}\n\n💰 Баланс: {balance} генераций.", reply_markup=main_menu()
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка в history: {e}")
+
+def translation_stats_text() -> str:
+    """Строка /stats о переводе описаний"""
+    if prompt_translator is None:
+        return "🌐 Перевод описаний выключен\n"
+    t = prompt_translator
+    looked_up = t.hits + t.misses
+    hit_rate = f"{t.hits / looked_up:.0%}" if looked_up else "—"
+    return (
+        f"🌐 Перевод ({t.backend.name}): из кэша {t.hits} из {looked_up} ({hit_rate}), "
+        f"не уложились в {t.budget:g}с {t.timeouts}, ошибок {t.errors}\n"
+    )
+
+def backend_stats_text() -> str:
+    """Строки /stats о бэкендах генерации: основной, p95, доля ошибок, дублирование.
+
+    Сообщения /stats и /check_replicate идут с Markdown, поэтому имена бэкендов экранируются.
+    """
+    router = generation_router
+    primary = router.candidates()[0]
+    lines = [
+        f"🧭 Бэкенды: дублировано {router.hedges} из {router.requests} (дубль ответил первым "
+        f"{router.hedge_wins}), переходов на запасной {router.fallbacks}"
+    ]
+    for backend in router.backends:
+        stats = router.stats[backend.name]
+        p95 = stats.p95()
+        lines.append(
+            f"   {'▶️' if backend is primary else '▫️'} {escape_markdown(backend.name)}: p95 "
+            f"{f'{p95:.1f}с' if p95 is not None else '—'}, ошибок {stats.error_rate():.0%} "
+            f"из {stats.count()}, ${backend.cost:g}"
+        )
+    return "\n".join(lines) + "\n"
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика для админа"""
     if update.effective_user.id != ADMIN_ID:
         return
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        
-        cur.execute("SELECT COUNT(*), SUM(balance) FROM users")
-        users_count, total_balance = cur.fetchone()
-        total_balance = total_balance or 0
-        
-        cur.execute("SELECT SUM(amount) FROM transactions WHERE type='buy'")
-        total_bought = cur.fetchone()[0] or 0
-        
-        cur.execute("SELECT SUM(amount) FROM transactions WHERE type='spend'")
-        total_spent = abs(cur.fetchone()[0] or 0)
-        
-        cur.execute("SELECT COUNT(*) FROM transactions WHERE type='buy'")
-        purchases_count = cur.fetchone()[0] or 0
-        
-        conn.close()
+        totals = await db.stats()
+        cached_results = await db.result_cache_size()
+        jobs = await db.job_counts()
 
         uptime = time.time() - start_time
 
+        # Срезы по дням: 👤 новые пользователи, ⭐ куплено, 🎨 израсходовано,
+        # 🖼 выполнено генераций (и неудачных), средняя длительность
+        days_text = "\n".join(
+            f"{day[5:]}: 👤 {new_users}  ⭐ {bought} ({purchases})  🎨 {spent}  🖼 {generations}"
+            + (f" (❌ {failed})" if failed else "")
+            + (f" ~{seconds / generations:.0f}с" if generations else "")
+            for day, new_users, bought, spent, purchases, generations, failed, seconds in totals["days"]
+        ) or "нет данных"
+
         text = (
             f"📊 **Статистика:**\n\n"
-            f"👥 Пользователей: {users_count}\n"
-            f"💰 Суммарный баланс: {total_balance}\n"
-            f"⭐ Куплено генераций: {total_bought}\n"
-            f"🛒 Покупок: {purchases_count}\n"
-            f"🎨 Израсходовано: {total_spent}\n\n"
+            f"👥 Пользователей: {totals['users']}\n"
+            f"💰 Суммарный баланс: {totals['total_balance']}\n"
+            f"⭐ Куплено генераций: {totals['bought']}\n"
+            f"🛒 Покупок: {totals['purchases']}\n"
+            f"🎨 Израсходовано: {totals['spent']}\n\n"
+            f"📅 **По дням:**\n{days_text}\n\n"
             f"⚙️ **Система:**\n"
             f"⏱ Uptime: {uptime/3600:.1f} ч\n"
-            f"🔄 Перезапусков: {get_restart_count()}"
+            f"🔄 Перезапусков: {get_restart_count()}\n"
+            f"💾 Коммитов БД: {totals['commits']}\n"
+            f"📋 Очередь: ждут {jobs.get('queued', 0)}, выполняются {jobs.get('running', 0)}\n"
+            f"🗂 Кэш балансов: {totals['cache_hits']} попаданий / {totals['cache_misses']} промахов\n"
+            f"♻️ Кэш результатов: {result_cache.hits} попаданий / {result_cache.misses} промахов, "
+            f"записей {cached_results}\n"
+            f"🔗 Объединено одинаковых запросов: {single_flight.followers}\n"
+            f"{translation_stats_text()}"
+            f"{backend_stats_text()}"
+            f"🧾 Сессии ({SESSION_BACKEND}, экземпляров {REPLICAS}): загрузок {sessions.loads}, "
+            f"записано {sessions.saves} за {sessions.flushes} операций\n"
+            f"🚦 Исходящие: задержано ограничителем {outbound_limiter.delayed}, "
+            f"RetryAfter {outbound_limiter.retry_afters}\n"
+            f"📢 Подписка: {subscription_cache.hits} из кэша, {subscription_cache.requests} запросов "
+            f"к Telegram, ошибок {subscription_cache.errors}\n"
+            f"📤 Отправлено: {delivery_stats.photos} фото ({delivery_stats.albums} альбомов), "
+            f"{delivery_stats.documents} документов, "
+            f"{delivery_stats.by_file_id} повторно, {delivery_stats.url_fallbacks} ссылкой\n"
+            f"📦 Скачано {delivery_stats.bytes / 1048576:.1f} МБ за {delivery_stats.download_seconds:.1f}с, "
+            f"загрузка в Telegram {delivery_stats.upload_seconds:.1f}с"
         )
         await update.message.reply_text(text, parse_mode='Markdown')
     except Exception as e:
@@ -326,6 +2069,136 @@ async def diagnose(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Ошибка: {e}")
 
+profile_running = False
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование событийного цикла и выделений памяти: /profile <секунды>"""
+    global profile_running
+    if update.effective_user.id != ADMIN_ID:
+        return
+    if profile_running:
+        await update.message.reply_text("⏳ Профилирование уже идёт.")
+        return
+
+    try:
+        seconds = min(max(int(context.args[0]), 1), 60) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Использование: /profile <секунды, 1–60>")
+        return
+
+    profile_running = True
+    try:
+        await update.message.reply_text(f"🔬 Профилирую {seconds}с...")
+        # Профилировщик работает в своём потоке и снимает стеки потока цикла
+        report = await asyncio.to_thread(tracing.profile, seconds, threading.get_ident())
+        text = tracing.format_profile(report)
+        text += f"\n\n🐢 Медленных трасс: {tracer.slow}, записано в лог: {tracer.logged}"
+        await update.message.reply_text(text[:4000])
+    except Exception as e:
+        logger.error(f"❌ Ошибка профилирования: {e}", exc_info=True)
+        await update.message.reply_text(f"❌ Ошибка: {e}")
+    finally:
+        profile_running = False
+
+async def maintenance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отчёт о плановом обслуживании: /maintenance [задача] — запуск задачи сейчас"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    if context.args:
+        name = context.args[0]
+        if name not in maintenance.tasks:
+            await update.message.reply_text(f"Задачи: {', '.join(maintenance.tasks)}")
+            return
+        line = await maintenance.run(name)
+        await update.message.reply_text(f"🧰 {line}")
+        return
+    await update.message.reply_text(maintenance.report())
+
+async def ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Журнал транзакций: /ledger — проверка файлов архива, /ledger <user_id> — сверка баланса"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    if context.args:
+        try:
+            user_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /ledger [user_id]")
+            return
+        check = await db.verify_ledger(user_id)
+        if check is None:
+            await update.message.reply_text("Пользователь не найден.")
+            return
+        await update.message.reply_text(
+            f"{'✅ Баланс сходится' if check['ok'] else '❌ Баланс не сходится'}: {check['balance']}, "
+            f"по журналу {check['expected']}\n"
+            f"Снимок: {check['snapshot']:+d} ({check['snapshot_rows']} строк в архиве)\n"
+            f"Журнал: {check['journal']:+d} ({check['journal_rows']} строк)\n"
+            f"Резервы: −{check['held']}"
+        )
+        return
+
+    archives = await db.ledger_archives()
+    # Чтение и хэширование файлов — в пуле потоков, не в цикле и не в потоке базы
+    checks = await asyncio.gather(*(
+        asyncio.to_thread(verify_archive_file, os.path.join(LEDGER_ARCHIVE_DIR, name), sha256)
+        for name, _, _, sha256 in archives
+    ))
+    broken = [name for (name, *_), ok in zip(archives, checks) if not ok]
+    text = (
+        f"🧾 Архив журнала: {len(archives)} файлов, {sum(row[1] for row in archives)} строк "
+        f"на сумму {sum(row[2] for row in archives):+d}\n"
+        f"📁 {LEDGER_ARCHIVE_DIR}, срок хранения строк в базе {LEDGER_RETENTION_DAYS} дн."
+    )
+    if broken:
+        text += f"\n❌ Отсутствуют или изменены: {', '.join(broken[:10])}"
+    elif archives:
+        text += "\n✅ Контрольные суммы совпадают"
+    await update.message.reply_text(text)
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем пользователям: /broadcast <текст> или ответом на сообщение;
+    /broadcast stop, /broadcast resume; без аргументов — состояние"""
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    message = update.message
+    parts = (message.text or "").split(maxsplit=1)
+    argument = parts[1].strip() if len(parts) > 1 else ""
+
+    if argument == "stop":
+        stopped = await db.set_broadcast_status("running", "stopped")
+        await message.reply_text("⏸ Рассылка остановится в течение пары секунд." if stopped else "Рассылка не идёт.")
+        return
+    if argument == "resume":
+        if not await db.set_broadcast_status("stopped", "running"):
+            await message.reply_text("Нет остановленной рассылки.")
+            return
+        await resume_broadcast(context.bot)
+        await message.reply_text("▶️ Рассылка продолжается.")
+        return
+
+    if not argument and message.reply_to_message is None:
+        latest = await db.latest_broadcast()
+        if latest is None:
+            await message.reply_text(
+                "Использование: /broadcast <текст> или ответ на сообщение командой /broadcast"
+            )
+            return
+        await message.reply_text(f"{broadcast_progress_text(latest, latest, 0)}\nСтатус: {latest['status']}")
+        return
+
+    if message.reply_to_message is not None:
+        fields = {"from_chat_id": message.chat_id, "message_id": message.reply_to_message.message_id}
+    else:
+        fields = {"text": argument}
+    broadcast_id = await db.create_broadcast(admin_chat_id=message.chat_id, **fields)
+    if broadcast_id is None:
+        await message.reply_text("⏳ Уже идёт другая рассылка: /broadcast stop, чтобы остановить её.")
+        return
+    await resume_broadcast(context.bot)
+
 async def test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Тестовая команда для админа"""
     if update.effective_user.id != ADMIN_ID:
@@ -338,18 +2211,32 @@ async def check_replicate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # Проверяем доступность API
-        start = time.time()
-        replicate_client.models.get("google/nano-banana")
-        latency = time.time() - start
+        # Проверяем доступность API и моделей всех бэкендов
+        models_text = ""
+        for backend in generation_router.backends:
+            start = time.time()
+            try:
+                await asyncio.to_thread(backend.check)
+                models_text += f"📊 {escape_markdown(backend.name)} доступен, задержка {time.time() - start:.2f}с\n"
+            except Exception as e:
+                models_text += f"❌ {escape_markdown(backend.name)}: {escape_markdown(str(e)[:100])}\n"
         
+        failures_text = ", ".join(
+            f"{kind} {count}" for kind, count in sorted(replicate_breaker.failures_by_kind.items())
+        ) or "нет"
+
         # Проверяем баланс аккаунта
         account_info = "Информация о балансе недоступна через API"
         
         await update.message.reply_text(
             f"✅ **Replicate API статус:**\n\n"
-            f"📊 Модель google/nano-banana доступна\n"
-            f"⏱ Задержка: {latency:.2f}с\n"
+            f"{models_text}"
+            f"{backend_stats_text()}"
+            f"⚙️ Генераций в работе: {generations_in_flight}/{GENERATION_CONCURRENCY}\n"
+            f"🔌 Предохранитель: {replicate_breaker.state}, ошибок подряд "
+            f"{replicate_breaker.consecutive_failures}, доля ошибок {replicate_breaker.recent_failure_rate:.0%}, "
+            f"отклонено {replicate_breaker.rejected}\n"
+            f"📉 Ошибки по видам: {failures_text}\n"
             f"🔑 Токен: {'✅ установлен' if REPLICATE_API_TOKEN else '❌ не установлен'}\n"
             f"🔗 API URL: https://api.replicate.com\n\n"
             f"{account_info}",
@@ -369,7 +2256,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Пытаемся ответить на callback, игнорируем ошибки
         try:
-            await query.answer()
+            with span("answer_callback"):
+                await query.answer()
         except:
             pass
         
@@ -377,12 +2265,11 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"🔘 Нажатие кнопки {query.data} от {user_id}")
 
         if query.data == "generate":
-            balance = get_user(user_id)
+            balance = await db.get_user(user_id)
 
             # Админ всегда может генерировать
             if user_id != ADMIN_ID and balance > 0:
-                subscribed = await check_subscription(user_id, context.bot)
-                if not subscribed and not context.user_data.get("subscribed_once"):
+                if not await subscription_cache.has_access(context.bot, user_id):
                     keyboard = [[InlineKeyboardButton("Я подписался ✅", callback_data="confirm_sub")]]
                     await query.message.reply_text(
                         "🎁 Чтобы получить 3 бесплатные генерации, подпишитесь на канал @imaigenpromts",
@@ -391,7 +2278,10 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
 
             context.user_data["can_generate"] = True
-            await query.message.reply_text("Отправьте текст или фото с описанием.")
+            await query.message.reply_text(
+                "Отправьте текст, фото или альбом до 4 фото с описанием.",
+                reply_markup=variants_menu(context.user_data.get("variants", 1)),
+            )
             
             try:
                 await query.message.delete()
@@ -399,7 +2289,7 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pass
 
         elif query.data == "balance":
-            balance = get_user(user_id)
+            balance = await db.get_user(user_id)
             await query.message.reply_text(f"💰 У вас {balance} генераций.", reply_markup=main_menu())
 
         elif query.data == "buy":
@@ -415,28 +2305,100 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "ℹ️ **Помощь:**\n\n"
                 "1. Нажмите «Сгенерировать»\n"
                 "2. Отправьте текст или фото с описанием\n"
-                "3. Получите изображение\n\n"
-                "💰 Покупка генераций через Telegram Stars"
+                "3. Получите изображение — пока оно генерируется, сообщение о статусе показывает ход, "
+                "а кнопка «Отменить» прерывает генерацию без списания\n\n"
+                "🎲 Под подсказкой можно выбрать до 4 вариантов за раз — они придут одним альбомом, "
+                "списывается по генерации за каждый полученный вариант\n"
+                "🖼 Альбом до 4 фото уходит в модель целиком\n\n"
+                "🔁 Повторный запрос с тем же описанием отдаётся мгновенно. "
+                "Чтобы получить новый вариант, начните описание с «!»\n\n"
+                "💰 Покупка генераций через Telegram Stars\n"
+                "🧾 История пополнений и списаний — /history"
             )
             await query.message.reply_text(help_text, parse_mode='Markdown', reply_markup=main_menu())
             
     except Exception as e:
         logger.error(f"❌ Ошибка в menu_handler: {e}")
 
+async def variants_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выбор числа вариантов: каждый вариант списывается отдельно"""
+    query = update.callback_query
+    if query.data == "variants_info":
+        await query.answer("Сколько изображений сделать по одному описанию. Каждое — 1 генерация.")
+        return
+    variants = int(query.data.split("_")[1])
+    context.user_data["variants"] = variants
+    await query.answer(f"Вариантов: {variants}")
+    try:
+        await query.message.edit_reply_markup(reply_markup=variants_menu(variants))
+    except Exception:
+        pass
+
+async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Кнопка «Отменить» под сообщением о статусе генерации"""
+    query = update.callback_query
+    answered = False
+    try:
+        job_id = int(query.data.split("_")[1])
+        outcome = await db.request_cancel(job_id, query.from_user.id)
+        if outcome is None:
+            answered = True
+            await query.answer("Задача не найдена.")
+            return
+
+        status = outcome["status"]
+        if status == "running":
+            # Воркер увидит отмену при следующем опросе предсказания и сам вернёт резерв:
+            # в этом процессе — сразу по событию, в другом — по флагу в базе
+            event = cancel_events.get(job_id)
+            if event is not None:
+                event.set()
+            answered = True
+            await query.answer("⏹ Отменяем…")
+            text, reply_markup = "⏹ Отменяем генерацию...", None
+        elif status in ("queued", "pending"):
+            await release_canceled(outcome)
+            await end_generation_session(query.from_user.id)
+            logger.info(f"🚫 Задача {job_id} отменена пользователем ({status})")
+            answered = True
+            await query.answer("Генерация отменена")
+            text, reply_markup = CANCELED_RESULT["error"], main_menu()
+        else:
+            answered = True
+            await query.answer("Генерация уже завершена.")
+            text, reply_markup = None, None
+
+        try:
+            if text:
+                await query.message.edit_text(text, reply_markup=reply_markup)
+            else:
+                await query.message.edit_reply_markup(reply_markup=None)
+        except BadRequest:
+            pass
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка в cancel_handler: {e}")
+        if not answered:
+            # Без ответа кнопка так и крутится у пользователя
+            try:
+                await query.answer("⚠️ Не удалось отменить, попробуйте ещё раз.")
+            except:
+                pass
+
 async def confirm_sub_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подтверждение подписки на канал"""
     try:
         query = update.callback_query
         try:
-            await query.answer()
+            with span("answer_callback"):
+                await query.answer()
         except:
             pass
 
         user_id = query.from_user.id
-        subscribed = await check_subscription(user_id, context.bot)
+        subscribed = await subscription_cache.confirm(context.bot, user_id)
 
         if subscribed:
-            context.user_data["subscribed_once"] = True
             await query.message.edit_text("🎉 Подписка подтверждена!", reply_markup=main_menu())
         else:
             await query.message.reply_text("❌ Вы ещё не подписались!")
@@ -448,7 +2410,8 @@ async def buy_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         try:
-            await query.answer()
+            with span("answer_callback"):
+                await query.answer()
         except:
             pass
 
@@ -502,88 +2465,127 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("⚠️ Ошибка: неизвестный пакет.")
             return
 
-        # Проверяем, не было ли уже такой оплаты
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM transactions WHERE payment_id=?", (payment_id,))
-        if cur.fetchone()[0] > 0:
-            conn.close()
+        # Начисляем генерации; повторный payment_id отклоняется (processed_payments)
+        if not await db.update_balance(user_id, gens, "buy", payment_id):
             logger.warning(f"Повторная оплата {payment_id}")
             await update.message.reply_text("✅ Платёж уже был обработан.")
             return
-        conn.close()
 
-        # Начисляем генерации
-        update_balance(user_id, gens, "buy", payment_id)
-
-        await update.message.reply_text(
-            f"✅ Оплата прошла успешно! На ваш баланс добавлено {gens} генераций.",
-            reply_markup=main_menu()
-        )
+        # Подтверждение оплаты уходит раньше остальных сообщений
+        with send_priority(HIGH):
+            await update.message.reply_text(
+                f"✅ Оплата прошла успешно! На ваш баланс добавлено {gens} генераций.",
+                reply_markup=main_menu()
+            )
         
     except Exception as e:
         logger.error(f"❌ Ошибка в successful_payment_handler: {e}")
 
 # ==================== ОБРАБОТЧИК СООБЩЕНИЙ ====================
+# Фото альбома приходят отдельными апдейтами: первое ждёт ALBUM_WINDOW,
+# остальные дописываются к нему и дальше не обрабатываются
+pending_albums = {}
+
+async def collect_album(message):
+    """Все сообщения альбома для первого из них, None для остальных"""
+    group = pending_albums.get(message.media_group_id)
+    if group is not None:
+        group.append(message)
+        return None
+    group = pending_albums[message.media_group_id] = [message]
+    try:
+        await asyncio.sleep(ALBUM_WINDOW)
+    finally:
+        del pending_albums[message.media_group_id]
+    return sorted(group, key=lambda m: m.message_id)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка текстовых сообщений и фото"""
+    """Обработка текстовых сообщений, фото и альбомов"""
     try:
+        messages = [update.message]
+        if update.message.media_group_id:
+            messages = await collect_album(update.message)
+            if messages is None:
+                return
+
         if not context.user_data.get("can_generate"):
             await update.message.reply_text("Главное меню:", reply_markup=main_menu())
             return
 
         user_id = update.effective_user.id
-        balance = get_user(user_id)
+        balance = await db.get_user(user_id)
         is_admin = user_id == ADMIN_ID
 
         if not is_admin and balance <= 0:
             await update.message.reply_text("⚠️ У вас закончились генерации!", reply_markup=main_menu())
             return
 
-        prompt = update.message.caption or update.message.text
+        caption = next((m.caption for m in messages if m.caption), None)
+        prompt, fresh = split_fresh_flag(caption or update.message.text or "")
         if not prompt:
             await update.message.reply_text("📝 Пожалуйста, добавьте описание для генерации.")
             return
 
-        await update.message.reply_text("⏳ Генерация изображения...")
-
-        # Получаем фото, если есть
-        images = []
-        if update.message.photo:
-            try:
-                file = await update.message.photo[-1].get_file()
-                images = [file.file_path]
-            except Exception as e:
-                logger.error(f"Ошибка получения фото: {e}")
-
-        # Генерируем с повторными попытками
-        result = await generate_image_with_retry(prompt, images if images else None)
-
-        if isinstance(result, dict) and "error" in result:
-            await update.message.reply_text(result["error"])
-            context.user_data["can_generate"] = False
+        # Replicate недоступен — отвечаем сразу, а не после таймаутов в очереди
+        if replicate_breaker.is_open():
+            await update.message.reply_text(SERVICE_BUSY_MESSAGE)
             return
 
-        if not result:
-            await update.message.reply_text("❌ Генерация не дала результата.")
-            context.user_data["can_generate"] = False
-            return
+        # Резервируем генерации сразу, по одной на вариант: параллельные
+        # сообщения не уйдут в минус
+        variants = context.user_data.get("variants", 1)
+        holds = []
+        if not is_admin:
+            holds = await db.reserve_many(user_id, variants)
+            if holds is None:
+                text = (
+                    f"⚠️ Не хватает генераций на {variants} варианта, у вас {balance}."
+                    if variants > 1 else "⚠️ У вас закончились генерации!"
+                )
+                await update.message.reply_text(text, reply_markup=main_menu())
+                return
+
+        # Получаем фото, если есть (из альбома — не больше MAX_INPUT_IMAGES)
+        photos = [m.photo[-1] for m in messages if m.photo]
+        if len(photos) > MAX_INPUT_IMAGES:
+            logger.info(f"🖼 Альбом из {len(photos)} фото обрезан до {MAX_INPUT_IMAGES}")
+            photos = photos[:MAX_INPUT_IMAGES]
+        image_ids = [photo.file_unique_id for photo in photos]
+
+        job = GenerationJob(
+            user_id=user_id,
+            chat_id=update.effective_chat.id,
+            prompt=prompt,
+            photo_ids=[photo.file_id for photo in photos],
+            is_admin=is_admin,
+            priority=is_admin or await db.is_paid_user(user_id),
+            reply_to=update.message.message_id,
+            holds=holds,
+            variants=variants,
+        )
+        # Несколько вариантов нужны разными — их не берут из кэша и не объединяют
+        if not fresh and variants == 1:
+            job.cache_key = result_cache.key(prompt, image_ids)
+            job.flight_key = request_key(prompt, image_ids)
 
-        # Отправляем результат
+        # Такой же запрос, который уже генерируется, тоже идёт через очередь: воркер
+        # присоединит задачу к общей генерации (single_flight) или возьмёт результат из кэша
         try:
-            await update.message.reply_photo(result)
-        except Exception as photo_error:
-            logger.error(f"Ошибка отправки фото: {photo_error}")
-            await update.message.reply_text("❌ Ошибка при отправке изображения.")
+            position = await generation_queue.submit(job)
+        except QueueFull as e:
+            logger.warning(f"🚦 Задача {user_id} отклонена: {e}")
+            await settle_job(job)
+            await update.message.reply_text("⚠️ Сейчас слишком много запросов. Попробуйте через минуту.")
             return
-        
-        # Списание (только для не-админов)
-        if not is_admin:
-            update_balance(user_id, -1, "spend")
-            logger.info(f"📉 Списана 1 генерация у {user_id}")
 
-        context.user_data["can_generate"] = False
-        await update.message.reply_text("✅ Готово! Нажмите «Сгенерировать» для нового запроса.", reply_markup=main_menu())
+        eta = await generation_queue.eta(position)
+        status = await update.message.reply_text(
+            f"⏳ Вы #{position} в очереди, ожидание ~{eta:.0f}с", reply_markup=cancel_keyboard(job.id)
+        )
+
+        # Воркер мог взять задачу, пока отправлялось сообщение о позиции
+        if await db.set_job_message(job.id, status.message_id) == "running":
+            await status.edit_text("⏳ Генерация изображения...", reply_markup=cancel_keyboard(job.id))
             
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_message: {e}")
@@ -594,114 +2596,528 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         raise context.error
     except Forbidden:
-        user_id = update.effective_user.id if update and update.effective_user else "неизвестно"
-        logger.warning(f"⚠️ Пользователь {user_id} заблокировал бота.")
+        user_id = update.effective_user.id if update and update.effective_user else None
+        logger.warning(f"⚠️ Пользователь {user_id or 'неизвестно'} заблокировал бота.")
+        if user_id:
+            await db.mark_blocked(user_id)
+    except RetryAfter as e:
+        # Ограничитель уже повторял запрос: лимиты Telegram превышены надолго
+        logger.warning(f"🚦 Лимит Telegram: повтор через {e.retry_after}с исчерпал попытки")
     except (TimedOut, NetworkError):
         logger.warning("⚠️ Временная сетевая ошибка")
     except Exception as e:
         logger.error(f"❌ Ошибка: {e}", exc_info=True)
 
 # ==================== KEEP-ALIVE ====================
-def start_keep_alive():
-    """Запуск keep-alive для Render"""
-    scheduler = BackgroundScheduler()
-    
-    def ping():
-        try:
-            if RENDER_URL and running:
-                requests.get(f"{RENDER_URL}/", timeout=10)
-        except:
-            pass
+async def keep_alive_ping():
+    """Запрос к собственному адресу через общую сессию"""
+    async with http_session.get(f"{RENDER_URL}/", timeout=aiohttp.ClientTimeout(total=10)) as response:
+        await response.read()
+
+# ==================== ВЕБ-СЕРВЕР ====================
+# Вместо run_webhook (tornado) используем свой aiohttp-сервер: на том же порту
+# он принимает апдейты Telegram, вебхуки Replicate и отвечает на keep-alive.
+background_tasks = set()
+
+def spawn(coro):
+    """Запуск фоновой задачи с сохранением ссылки на неё"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def health(request: web.Request):
+    """Проверка живости для Render и keep-alive"""
+    return web.Response(text="OK")
+
+async def metrics_endpoint(request: web.Request):
+    """Метрики в формате Prometheus"""
+    if METRICS_TOKEN:
+        supplied = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if supplied != METRICS_TOKEN:
+            return web.Response(status=401)
+    return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+first_update_seen = False
+
+async def telegram_webhook(request: web.Request):
+    """Приём апдейта от Telegram"""
+    global first_update_seen
+    application = request.app["application"]
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    # Порт открывается раньше, чем готово приложение: первые апдейты ждут
+    # инициализации здесь, а не в повторах доставки Telegram
+    try:
+        await asyncio.wait_for(request.app["ready"].wait(), 30)
+    except asyncio.TimeoutError:
+        return web.Response(status=503)
+    if not first_update_seen:
+        first_update_seen = True
+        mark_startup("first_update")
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+def job_from_pending(row: dict) -> GenerationJob:
+    """Задача доставки по строке ожидающего предсказания"""
+    return GenerationJob(
+        user_id=row["user_id"],
+        chat_id=row["chat_id"],
+        prompt="",
+        photo_ids=[],
+        is_admin=bool(row["is_admin"]),
+        priority=False,
+        reply_to=row["reply_to"],
+        status_message_id=row["status_message_id"],
+        holds=[row["hold_id"]] if row["hold_id"] is not None else [],
+        cache_key=row["cache_key"],
+        id=row["job_id"],
+    )
 
-    scheduler.add_job(ping, "interval", minutes=5)
-    scheduler.start()
-    logger.info("✅ Keep-alive запущен")
+def prediction_seconds(prediction: dict):
+    """Длительность предсказания по меткам времени из вебхука или None"""
+    try:
+        created = datetime.fromisoformat(prediction["created_at"])
+        completed = datetime.fromisoformat(prediction["completed_at"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (completed - created).total_seconds()
+
+def observe_prediction(prediction: dict, outcome: str):
+    """Учёт длительности предсказания из вебхука в статистике его бэкенда"""
+    backend = generation_router.find(prediction.get("model"))
+    seconds = prediction_seconds(prediction)
+    if backend is not None and seconds is not None:
+        generation_router.record(backend, seconds, outcome)
+
+async def complete_prediction(application: Application, prediction: dict):
+    """Доставка результата предсказания, пришедшего вебхуком"""
+    prediction_id = prediction.get("id")
+    status = prediction.get("status")
+    rows = await db.pop_pending_predictions(prediction_id)
+    # Вебхук мог прийти раньше, чем воркер успел записать предсказание;
+    # у отменённого пользователем предсказания строк уже нет
+    for _ in range(5):
+        if rows or status == "canceled":
+            break
+        await asyncio.sleep(1)
+        rows = await db.pop_pending_predictions(prediction_id)
+    if not rows:
+        if status != "canceled":
+            logger.warning(f"⚠️ Вебхук для неизвестного предсказания {prediction_id}")
+        return
 
-# ==================== ЗАПУСК ====================
-def main():
-    """Главная функция запуска"""
-    global start_time
-    start_time = time.time()
-    
-    # Инициализация БД
-    init_db()
-    
-    # Проверка API ключа Replicate
+    if status == "succeeded":
+        replicate_breaker.record()
+        observe_prediction(prediction, "ok")
+        result = extract_output(prediction.get("output"))
+    elif status == "canceled":
+        result = {"error": "🚫 Генерация отменена."}
+    else:
+        logger.error(f"❌ Предсказание {prediction_id} завершилось ошибкой: {prediction.get('error')}")
+        from replicate.exceptions import ModelError
+
+        error = classify_error(ModelError(str(prediction.get("error") or "")))
+        replicate_breaker.record(error)
+        if error.counts:
+            observe_prediction(prediction, "error")
+        result = {"error": error.user_message}
+
+    for row in rows:
+        job = job_from_pending(row)
+        try:
+            file_id = await deliver_result(application.bot, job, result)
+            await edit_status(application.bot, job, "⌛ Генерация завершена")
+            # Остальным задачам того же предсказания отправляем уже загруженный файл
+            if file_id:
+                result = file_id
+        except Exception as e:
+            logger.error(f"❌ Ошибка доставки предсказания {prediction_id}: {e}", exc_info=True)
+
+def verify_webhook_signature(key: str, headers, body: bytes, now: float = None) -> bool:
+    """Проверка подписи вебхука Replicate (Standard Webhooks).
+
+    Подписывается строка «webhook-id.webhook-timestamp.тело» HMAC-SHA256
+    с ключом из base64 после префикса whsec_; в webhook-signature может
+    быть несколько подписей «v1,<base64>» через пробел.
+    """
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not (webhook_id and timestamp and signatures):
+        return False
+    try:
+        if abs((now or time.time()) - int(timestamp)) > WEBHOOK_TOLERANCE:
+            return False
+        secret = base64.b64decode(key.removeprefix("whsec_"))
+    except ValueError:
+        return False
+    signed = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(secret, signed, hashlib.sha256).digest()).decode()
+    return any(
+        hmac.compare_digest(signature.partition(",")[2], expected)
+        for signature in signatures.split()
+        if signature.startswith("v1,")
+    )
+
+_webhook_key_lock = asyncio.Lock()
+
+async def replicate_signing_key():
+    """Ключ подписи вебхуков: из REPLICATE_WEBHOOK_SIGNING_KEY или от API Replicate (один раз)"""
+    global REPLICATE_WEBHOOK_SIGNING_KEY
+    async with _webhook_key_lock:
+        if not REPLICATE_WEBHOOK_SIGNING_KEY:
+            url = f"{(REPLICATE_BASE_URL or 'https://api.replicate.com').rstrip('/')}/v1/webhooks/default/secret"
+            async with http_session.get(
+                url, headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}"},
+                timeout=aiohttp.ClientTimeout(total=10),
+            ) as response:
+                response.raise_for_status()
+                REPLICATE_WEBHOOK_SIGNING_KEY = (await response.json())["key"]
+            logger.info("🔑 Ключ подписи вебхуков Replicate получен")
+    return REPLICATE_WEBHOOK_SIGNING_KEY
+
+async def replicate_webhook(request: web.Request):
+    """Приём вебхука о завершении предсказания Replicate"""
+    body = await request.read()
     try:
-        # Простой тестовый запрос для проверки ключа
-        replicate_client.models.get("google/nano-banana")
-        logger.info("✅ Replicate API ключ работает, модель доступна")
+        key = await replicate_signing_key()
     except Exception as e:
-        logger.error(f"❌ Ошибка подключения к Replicate: {e}")
-        logger.error("Проверьте REPLICATE_API_TOKEN и доступность модели")
-    
-    # Создаём событийный цикл и устанавливаем его
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    # Создание приложения
-    app = Application.builder().token(TOKEN).build()
+        # Replicate повторит вебхук, а предсказание без вебхука вернёт stale_cleanup
+        logger.error(f"❌ Нет ключа подписи вебхуков Replicate: {e}")
+        return web.Response(status=503)
+    if not verify_webhook_signature(key, request.headers, body):
+        logger.warning(f"⚠️ Вебхук Replicate с неверной подписью от {request.remote}, отклонён")
+        return web.Response(status=401)
+    try:
+        prediction = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    if prediction.get("status") in ("succeeded", "failed", "canceled"):
+        spawn(complete_prediction(request.app["application"], prediction))
+    return web.Response()
+
+async def startup(application: Application, web: bool = True):
+    """Инициализация приложения: getMe, база и HTTP-сессия — параллельно"""
+    await asyncio.gather(application.initialize(), db.open(), open_http_session())
+    await post_init(application, web)
+    await application.start()
+
+async def configure_bot(application: Application):
+    """Настройка бота и проверки, которые не должны задерживать первый апдейт"""
+    try:
+        await application.bot.set_webhook(url=f"{RENDER_URL}/{TOKEN}", allowed_updates=Update.ALL_TYPES)
+        logger.info("✅ Вебхук Telegram установлен")
+    except Exception as e:
+        logger.error(f"❌ Ошибка установки вебхука: {e}")
 
-    # ===== УБИРАЕМ ТОЛЬКО КНОПКУ МЕНЮ СПРАВА ОТ ПОЛЯ ВВОДА =====
-    # Кнопки ВНУТРИ сообщений остаются!
-    
     try:
-        # Убираем кнопку меню справа от ввода (≡)
-        loop.run_until_complete(app.bot.set_chat_menu_button(menu_button=None))
+        # Убираем кнопку меню справа от ввода (≡); кнопки внутри сообщений остаются
+        await application.bot.set_chat_menu_button(menu_button=None)
         logger.info("✅ Кнопка меню (≡) справа от ввода убрана")
-        
-        # НЕ удаляем команды! Они нужны для работы бота
-        # loop.run_until_complete(app.bot.set_my_commands([]))  # ЭТО НЕ НУЖНО!
-        
     except Exception as e:
         logger.error(f"❌ Ошибка при настройке: {e}")
-    
-    # НЕ ЗАКРЫВАЕМ ЦИКЛ! Он нужен для работы вебхука
-    # loop.close()  # НЕ ЗАКРЫВАЕМ!
 
-    # Команды (только /start для пользователей)
-    app.add_handler(CommandHandler("start", start))
+    if REPLICATE_WEBHOOK_MODE:
+        # Ключ подписи нужен первому же вебхуку
+        try:
+            await replicate_signing_key()
+        except Exception as e:
+            logger.error(f"❌ Не удалось получить ключ подписи вебхуков Replicate: {e}")
+
+    # Заодно загружается библиотека replicate — первая генерация её не ждёт
+    for backend in generation_router.backends:
+        try:
+            await asyncio.to_thread(backend.check)
+            logger.info(f"✅ Бэкенд {backend.name} доступен")
+        except Exception as e:
+            logger.error(f"❌ Бэкенд {backend.name} недоступен: {e}")
+            logger.error("Проверьте REPLICATE_API_TOKEN и доступность модели")
+
+async def serve(application: Application, port: int, stop_event: asyncio.Event = None):
+    """Запуск веб-сервера и приложения до сигнала остановки (или stop_event).
+
+    Порт открывается первым: проверка живости Render проходит сразу,
+    апдейты ждут готовности приложения, а настройка бота идёт в фоне.
+    """
+    web_app = web.Application()
+    web_app["application"] = application
+    web_app["ready"] = asyncio.Event()
+    web_app.router.add_get("/", health)
+    web_app.router.add_get("/metrics", metrics_endpoint)
+    web_app.router.add_post(f"/{TOKEN}", telegram_webhook)
+    web_app.router.add_post(REPLICATE_WEBHOOK_PATH, replicate_webhook)
+
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        install_signal_handlers(stop_event)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    mark_startup("listening")
+
+    try:
+        await startup(application)
+        web_app["ready"].set()
+        mark_startup("ready")
+        logger.info(f"✅ Вебхук слушает порт {port}")
+        spawn(configure_bot(application))
+        await stop_event.wait()
+    finally:
+        logger.info("📴 Останавливаем веб-сервер...")
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+async def work(application: Application, stop_event: asyncio.Event = None):
+    """Процесс-воркер (--worker): выполняет задачи очереди без вебхука Telegram"""
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        install_signal_handlers(stop_event)
+
+    await startup(application, web=False)
+    mark_startup("ready")
+    logger.info(f"👷 Воркер {WORKER_NAME} ждёт задачи")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("📴 Останавливаем воркер...")
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+# ==================== ОБСЛУЖИВАНИЕ ====================
+# Периодические задачи выполняются job_queue приложения в событийном цикле;
+# каждая получает крайний срок (бюджет) — см. maintenance.py
+maintenance = Maintenance()
+
+async def keep_alive_task(deadline: float):
+    """Keep-alive для Render: запрос к собственному адресу"""
+    await keep_alive_ping()
+
+async def checkpoint_task(deadline: float):
+    """Перенос WAL в файл базы, чтобы журнал не рос"""
+    log, checkpointed, truncated = await db.checkpoint(deadline)
+    if log:
+        return f"WAL {checkpointed}/{log} стр." + (", обрезан" if truncated else "")
+
+async def optimize_task(deadline: float):
+    """Обновление статистики планировщика запросов"""
+    await db.optimize(deadline)
+
+async def vacuum_task(deadline: float):
+    """VACUUM базы, когда свободных страниц много"""
+    pages, free, vacuumed = await db.vacuum(VACUUM_FREE_RATIO, deadline)
+    if vacuumed:
+        return f"VACUUM: освобождено {free} из {pages} стр."
+
+async def cache_sweep_task(deadline: float):
+    """Чистка кэша результатов, переводов, кэша подписки и старых сессий"""
+    evicted = await result_cache.evict(deadline)
+    if prompt_translator is not None:
+        evicted += await prompt_translator.evict(deadline)
+    swept = subscription_cache.sweep(active_within=24 * 3600)
+    purged = 0
+    if SESSION_BACKEND == "sqlite":
+        # В key-value сервере сессии истекают сами по SESSION_TTL
+        purged = await db.purge_sessions(SESSION_TTL, deadline)
+    if evicted or swept or purged:
+        return f"кэш результатов −{evicted}, подписка −{swept}, сессии −{purged}"
+
+async def rollup_task(deadline: float):
+    """Свёртка завершённых генераций в дневную статистику и удаление старых задач"""
+    rolled = await db.rollup_jobs(deadline)
+    purged = await db.purge_jobs(24 * 3600, deadline)
+    if rolled or purged:
+        return f"свёрнуто задач {rolled}, удалено {purged}"
+
+async def ledger_task(deadline: float):
+    """Свёртка старых строк журнала в итоги по месяцам и перенос их в архив"""
+    compacted, files = await db.compact_ledger(LEDGER_RETENTION_DAYS * 86400, LEDGER_ARCHIVE_DIR, deadline=deadline)
+    if compacted:
+        return f"свёрнуто строк журнала {compacted}, файлов архива {files}"
+
+async def stale_cleanup_task(bot, deadline: float):
+    """Возврат зависших резервов и предсказаний, чей вебхук не пришёл"""
+    released = await db.release_stale_holds(HOLD_TIMEOUT, deadline)
+    expired = await db.expire_pending_predictions(PENDING_TIMEOUT, deadline)
+    # Рассылка, брошенная упавшим процессом, продолжается здесь
+    if await resume_broadcast(bot):
+        logger.info("📣 Продолжена прерванная рассылка")
+    for row in expired:
+        logger.warning(f"⌛ Вебхук предсказания {row['prediction_id']} не пришёл, резерв возвращается")
+        try:
+            await deliver_result(
+                bot, job_from_pending(row), {"error": "⌛ Генерация не завершилась, она возвращена на баланс."}
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка возврата потерянного предсказания: {e}")
+    if released or expired:
+        return f"резервов {released}, потерянных предсказаний {len(expired)}"
+
+async def refresh_subscriptions_task(bot, deadline: float):
+    """Фоновое обновление подписки активных пользователей до истечения TTL"""
+    due = subscription_cache.due_for_refresh(
+        active_within=3600, horizon=SUBSCRIPTION_REFRESH_INTERVAL, limit=50
+    )
+    for user_id in due:
+        try:
+            await subscription_cache.refresh(bot, user_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить подписку {user_id}: {e}")
+        # Фоновые проверки не должны выбирать лимиты Telegram
+        await asyncio.sleep(0.1)
+    if due:
+        return f"обновлён статус подписки: {len(due)}"
+
+def schedule_maintenance(application: Application, web: bool):
+    """Регистрация задач обслуживания и постановка их в job_queue"""
+    bot = application.bot
+
+    async def notify_admin(text: str):
+        if ADMIN_ID:
+            await bot.send_message(ADMIN_ID, text)
+
+    maintenance.notify = notify_admin
+    if web and RENDER_URL:
+        maintenance.add("keep_alive", keep_alive_task, interval=300, budget=15)
+    maintenance.add("checkpoint", checkpoint_task, interval=300, budget=10, first=60)
+    maintenance.add("stale_cleanup", partial(stale_cleanup_task, bot), interval=600, budget=60)
+    maintenance.add("cache_sweep", cache_sweep_task, interval=600, budget=20, first=300)
+    maintenance.add("rollup", rollup_task, interval=900, budget=20, first=120)
+    if SUBSCRIPTION_REFRESH_INTERVAL > 0:
+        maintenance.add(
+            "subscriptions", partial(refresh_subscriptions_task, bot),
+            interval=SUBSCRIPTION_REFRESH_INTERVAL, budget=60,
+        )
+    # Тяжёлые задачи — реже и не сразу после старта
+    maintenance.add("ledger", ledger_task, interval=6 * 3600, budget=60, first=2400)
+    maintenance.add("optimize", optimize_task, interval=6 * 3600, budget=30, first=1800)
+    maintenance.add("vacuum", vacuum_task, interval=24 * 3600, budget=120, first=3600)
+    maintenance.schedule(application.job_queue)
+
+# ==================== ЗАПУСК ====================
+async def post_init(application: Application, web: bool = True):
+    """Запуск фоновых задач после инициализации приложения и базы"""
+    schedule_maintenance(application, web)
+    start_queue_workers(application.bot)
+    # Резервы задач из jobs (в том числе прерванных остановкой) остаются за задачами,
+    # возвращаются только резервы без задачи и без ожидающего предсказания
+    await db.release_stale_holds(HOLD_TIMEOUT)
+    await resume_broadcast(application.bot)
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов при остановке приложения"""
+    try:
+        await stop_broadcast_task()
+        await stop_queue_workers(DRAIN_TIMEOUT)
+        generation_executor.shutdown(wait=False, cancel_futures=True)
+        if prompt_translator is not None:
+            prompt_translator.shutdown()
+        logger.info("✅ Пул генерации остановлен")
+        await close_http_session()
+        await sessions.close()
+    finally:
+        # Буфер транзакций сбрасывается при любой остановке, в том числе по SIGTERM
+        await db.close()
+
+def build_application() -> Application:
+    """Приложение со всеми обработчиками"""
+    # Создание приложения
+    # concurrent_updates: пока одна генерация ждёт Replicate, меню, платежи
+    # и /start продолжают обрабатываться
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .rate_limiter(outbound_limiter)
+        .updater(None)
+    )
+    if TELEGRAM_API_URL:
+        # Свой сервер Bot API (например, фейковый из bench/)
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
+
+    # Обработчики обёрнуты в instrumented: длительность и ошибки попадают в /metrics
+
+    # Команды пользователей
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("history", instrumented(history)))
     
     # Админские команды
     if ADMIN_ID:
-        app.add_handler(CommandHandler("stats", stats))
-        app.add_handler(CommandHandler("test", test))
-        app.add_handler(CommandHandler("diag", diagnose))
-        app.add_handler(CommandHandler("check_replicate", check_replicate))
+        app.add_handler(CommandHandler("stats", instrumented(stats)))
+        app.add_handler(CommandHandler("test", instrumented(test)))
+        app.add_handler(CommandHandler("diag", instrumented(diagnose)))
+        app.add_handler(CommandHandler("profile", instrumented(profile)))
+        app.add_handler(CommandHandler("maintenance", instrumented(maintenance_command)))
+        app.add_handler(CommandHandler("broadcast", instrumented(broadcast)))
+        app.add_handler(CommandHandler("ledger", instrumented(ledger)))
+        app.add_handler(CommandHandler("check_replicate", instrumented(check_replicate)))
 
     # ===== INLINE КНОПКИ В СООБЩЕНИЯХ - ОСТАВЛЯЕМ! =====
-    app.add_handler(CallbackQueryHandler(menu_handler, pattern="^(generate|balance|buy|help)$"))
-    app.add_handler(CallbackQueryHandler(buy_handler, pattern="^buy_"))
-    app.add_handler(CallbackQueryHandler(confirm_sub_handler, pattern="^confirm_sub$"))
+    app.add_handler(CallbackQueryHandler(instrumented(menu_handler), pattern="^(generate|balance|buy|help)$"))
+    app.add_handler(CallbackQueryHandler(instrumented(buy_handler), pattern="^buy_"))
+    app.add_handler(CallbackQueryHandler(instrumented(confirm_sub_handler), pattern="^confirm_sub$"))
+    app.add_handler(CallbackQueryHandler(instrumented(variants_handler), pattern="^variants_"))
+    app.add_handler(CallbackQueryHandler(instrumented(cancel_handler), pattern="^cancel_"))
 
     # Платежи
-    app.add_handler(PreCheckoutQueryHandler(pre_checkout_handler))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+    app.add_handler(PreCheckoutQueryHandler(instrumented(pre_checkout_handler)))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, instrumented(successful_payment_handler)))
 
     # Сообщения
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_message))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_message)))
+    app.add_handler(MessageHandler(filters.PHOTO, instrumented(handle_message)))
 
     # Обработчик ошибок
     app.add_error_handler(error_handler)
 
-    # Keep-alive
-    start_keep_alive()
-    
+    return app
+
+def main():
+    """Главная функция запуска"""
+    global start_time
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(description="Telegram-бот генерации изображений")
+    parser.add_argument(
+        "--worker", action="store_true",
+        help="только выполнять задачи очереди генераций (без вебхука Telegram)",
+    )
+    args = parser.parse_args()
+    configure_shared_state(REPLICAS > 1 or QUEUE_WORKERS == 0 or args.worker)
+
+    # Создаём событийный цикл и устанавливаем его
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    app = build_application()
+
+    if args.worker:
+        loop.run_until_complete(work(app))
+        return
+
+    # Проверка Replicate и настройка бота (вебхук, кнопка меню) выполняются
+    # в фоне после открытия порта — см. configure_bot; keep-alive — задача
+    # обслуживания в job_queue
+
     # Запуск вебхука - используем наш цикл
     port = int(os.environ.get("PORT", 10000))
     logger.info(f"🚀 Запуск вебхука на порту {port}")
-    
+
+    if REPLICATE_WEBHOOK_MODE:
+        logger.info(f"📨 Результаты Replicate принимаются вебхуком на {REPLICATE_WEBHOOK_PATH[:12]}...")
+
     # Запускаем вебхук с нашим циклом
-    loop.run_until_complete(
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path=TOKEN,
-            webhook_url=f"{RENDER_URL}/{TOKEN}",
-            allowed_updates=Update.ALL_TYPES
-        )
-    )
+    loop.run_until_complete(serve(app, port))
 
 if __name__ == "__main__":
     main()
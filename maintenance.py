@@ -0,0 +1,155 @@
+"""Плановое обслуживание бота в событийном цикле.
+
+Периодические задачи (keep-alive, чекпойнты WAL, PRAGMA optimize и VACUUM,
+чистка кэшей, свёртка статистики, уборка зависших предсказаний) выполняются
+очередью задач PTB (job_queue) в том же цикле, что и обработчики, без
+отдельного потока и своего HTTP-стека.
+
+У каждой задачи есть бюджет времени. Задача получает крайний срок
+(time.monotonic()) и передаёт его в операции с базой — там долгий запрос
+прерывается обработчиком прогресса SQLite, а не продолжает занимать поток
+базы. По истечении бюджета ожидание задачи отменяется. Время выполнения
+идёт в /metrics и в отчёт /maintenance; о сбоях и превышениях бюджета
+админ получает сообщение не чаще раза в alert_interval секунд на задачу.
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_SECONDS = REGISTRY.histogram(
+    "bot_maintenance_seconds", "Длительность задач обслуживания", ("task",)
+)
+MAINTENANCE_RUNS = REGISTRY.counter(
+    "bot_maintenance_runs_total", "Запуски задач обслуживания по исходу (ok, overrun, error)", ("task", "outcome")
+)
+
+
+class MaintenanceTask:
+    """Периодическая задача: корутина func(deadline) → краткий итог или None"""
+
+    def __init__(self, name: str, func, interval: float, budget: float, first: float = None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.budget = budget
+        self.first = interval if first is None else first
+        self.running = False
+        self.runs = 0
+        self.overruns = 0
+        self.failures = 0
+        self.last_started = None
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.last_outcome = None
+        self.last_result = None
+        self.last_alert = 0.0
+
+
+class Maintenance:
+    """Реестр задач обслуживания и их запуск с бюджетом"""
+
+    def __init__(self, notify=None, alert_interval: float = 3600):
+        # notify(text) — корутина отправки сообщения админу
+        self.notify = notify
+        self.alert_interval = alert_interval
+        self.tasks = {}
+
+    def add(self, name: str, func, interval: float, budget: float, first: float = None):
+        """Регистрация задачи; интервал и бюджет — секунды"""
+        self.tasks[name] = MaintenanceTask(name, func, interval, budget, first)
+
+    def schedule(self, job_queue):
+        """Постановка всех задач в job_queue приложения"""
+        for task in self.tasks.values():
+            job_queue.run_repeating(
+                self._job, interval=task.interval, first=task.first,
+                name=f"maintenance:{task.name}", data=task.name,
+            )
+        logger.info(f"🧰 Задачи обслуживания: {', '.join(self.tasks)}")
+
+    async def _job(self, context):
+        await self.run(context.job.data)
+
+    async def run(self, name: str):
+        """Выполнение задачи с бюджетом; возвращает строку отчёта о запуске"""
+        task = self.tasks[name]
+        if task.running:
+            return f"{name}: ещё выполняется"
+        task.running = True
+        task.last_started = time.time()
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(task.func(started + task.budget), task.budget)
+            outcome = "ok"
+        except asyncio.TimeoutError:
+            result, outcome = f"превышен бюджет {task.budget:g}с", "overrun"
+        except sqlite3.OperationalError as e:
+            # Запрос, прерванный по крайнему сроку, SQLite завершает ошибкой interrupted
+            if str(e) == "interrupted":
+                result, outcome = f"прервано по бюджету {task.budget:g}с", "overrun"
+            else:
+                logger.error(f"❌ Задача обслуживания {name}: {e}", exc_info=True)
+                result, outcome = f"ошибка: {e}", "error"
+        except Exception as e:
+            logger.error(f"❌ Задача обслуживания {name}: {e}", exc_info=True)
+            result, outcome = f"ошибка: {e}", "error"
+        finally:
+            task.running = False
+        duration = time.monotonic() - started
+
+        task.runs += 1
+        task.last_duration = duration
+        task.max_duration = max(task.max_duration, duration)
+        task.last_outcome = outcome
+        task.last_result = result
+        if outcome == "overrun":
+            task.overruns += 1
+        elif outcome == "error":
+            task.failures += 1
+        MAINTENANCE_SECONDS.observe(duration, task=name)
+        MAINTENANCE_RUNS.inc(task=name, outcome=outcome)
+
+        line = f"{name}: {duration:.2f}с" + (f", {result}" if result else "")
+        if outcome == "ok":
+            if result:
+                logger.info(f"🧰 {line}")
+        else:
+            if outcome == "overrun":
+                logger.warning(f"⚠️ Обслуживание {line}")
+            await self._alert(task, line)
+        return line
+
+    async def _alert(self, task: MaintenanceTask, line: str):
+        if self.notify is None or time.time() - task.last_alert < self.alert_interval:
+            return
+        task.last_alert = time.time()
+        try:
+            await self.notify(f"⚠️ Обслуживание {line}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сообщить админу об обслуживании: {e}")
+
+    def report(self) -> str:
+        """Текстовый отчёт по всем задачам для админа"""
+        marks = {"ok": "✅", "overrun": "⏰", "error": "❌", None: "⏳"}
+        lines = ["🧰 Обслуживание:"]
+        for task in self.tasks.values():
+            if task.last_started is None:
+                last = "ещё не запускалась"
+            else:
+                ago = time.time() - task.last_started
+                last = f"{ago / 60:.0f} мин назад за {task.last_duration:.2f}с"
+                if task.last_result:
+                    last += f" ({task.last_result})"
+            lines.append(
+                f"\n{marks[task.last_outcome]} {task.name} — каждые {task.interval / 60:g} мин, "
+                f"бюджет {task.budget:g}с\n"
+                f"   последний запуск: {last}\n"
+                f"   запусков {task.runs}, максимум {task.max_duration:.2f}с, "
+                f"превышений {task.overruns}, ошибок {task.failures}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,219 @@
+"""Ограничение исходящих запросов к Bot API.
+
+Telegram допускает около 30 сообщений в секунду на бота, около одного
+в секунду в личный чат и 20 в минуту в группу; сверх этого отвечает
+429 RetryAfter. OutboundLimiter подключается к приложению PTB
+(ApplicationBuilder.rate_limiter) и пропускает через себя все вызовы
+бота, поэтому обработчики продолжают вызывать reply_text и send_photo
+как раньше.
+
+Методы, создающие сообщения (send*, copyMessage, forwardMessage), ждут
+токен в ведре своего чата и в общем ведре. Общее ведро раздаёт токены
+по приоритету: подтверждения платежей (HIGH) обходят ответы на апдейты
+(NORMAL), а те — массовую рассылку (BULK). Приоритет задаётся блоком
+send_priority() в коде, который отправляет сообщения, или rate_limit_args.
+Остальные методы (правки, ответы на кнопки) не ждут, но RetryAfter для
+всех обрабатывается одинаково: отправка приостанавливается на retry_after
+секунд и запрос повторяется.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+HIGH, NORMAL, BULK = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", BULK: "bulk"}
+
+# Ответы, которые Telegram ждёт считанные секунды
+URGENT_ENDPOINTS = {"answerPreCheckoutQuery", "answerCallbackQuery", "answerShippingQuery"}
+
+OUTBOUND_WAIT_SECONDS = REGISTRY.histogram(
+    "bot_outbound_wait_seconds", "Ожидание исходящего сообщения в ограничителе", ("priority",)
+)
+RETRY_AFTER_TOTAL = REGISTRY.counter(
+    "bot_telegram_retry_after_total", "Ответы 429 RetryAfter от Bot API", ("endpoint",)
+)
+
+_priority = contextvars.ContextVar("send_priority", default=NORMAL)
+
+
+@contextmanager
+def send_priority(level: int):
+    """Приоритет сообщений, отправляемых внутри блока"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_limited(endpoint: str) -> bool:
+    """Создаёт ли метод новое сообщение (на него действуют лимиты Telegram)"""
+    if endpoint in ("copyMessage", "forwardMessage"):
+        return True
+    return endpoint.startswith("send") and endpoint != "sendChatAction"
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше capacity подряд"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд до появления токена"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Общее и початовые ведра токенов, приоритеты и повтор после RetryAfter.
+
+    rate=0 отключает общее ограничение, chat_rate=0 — початовое.
+    """
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, max_retries: int = 3, max_chats: int = 10000):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        # Запас общего ведра — десятая доля секунды: всплеск не превышает лимит ни в одном окне в секунду
+        self._global = TokenBucket(rate, max(1.0, rate / 10)) if rate > 0 else None
+        self._chats = OrderedDict()
+        # (приоритет, порядковый номер, future) ожидающих общего токена
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        # До этого момента (time.monotonic) отправка приостановлена после RetryAfter
+        self._paused_until = 0.0
+        self.delayed = 0
+        self.retry_afters = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    # ---------- ожидание токенов ----------
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            # Группы и каналы: отрицательный id или @username
+            group = key.startswith(("-", "@"))
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self._chats[key] = TokenBucket(rate, self.chat_burst)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        return bucket
+
+    async def _acquire_chat(self, chat_id):
+        bucket = self._chat_bucket(chat_id)
+        while True:
+            delay = bucket.wait_time(time.monotonic())
+            if delay <= 0:
+                bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def _acquire_global(self, priority: int):
+        now = time.monotonic()
+        if not self._waiters and now >= self._paused_until and self._global.wait_time(now) <= 0:
+            self._global.take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        # Токены раздаются по одному: первым получает ожидающий с наивысшим приоритетом
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                # Ожидание отменено
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._global.wait_time(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._waiters)
+            self._global.take()
+            future.set_result(None)
+
+    async def _wait_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    # ---------- запрос ----------
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if isinstance(rate_limit_args, int):
+            priority = rate_limit_args
+        elif endpoint in URGENT_ENDPOINTS:
+            priority = HIGH
+        else:
+            priority = _priority.get()
+        limited = is_limited(endpoint)
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if limited and chat_id is not None and self.chat_rate > 0:
+                await self._acquire_chat(chat_id)
+            if limited and self._global is not None:
+                await self._acquire_global(priority)
+            else:
+                await self._wait_pause()
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self.delayed += 1
+            if limited:
+                OUTBOUND_WAIT_SECONDS.observe(waited, priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_afters += 1
+                RETRY_AFTER_TOTAL.inc(endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                retry_after = float(e.retry_after)
+                # Лимит общий для бота: ждут все отправки, а не только эта
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(f"🚦 {endpoint}: RetryAfter {retry_after:g}с, попытка {attempt + 1}")
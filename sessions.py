@@ -0,0 +1,302 @@
+"""Состояние диалога (user_data, chat_data) вне процесса бота.
+
+PTB держит user_data в памяти процесса: оно теряется при перезапуске и не
+видно другим экземплярам бота за тем же вебхуком. Здесь состояние хранится
+во внешнем хранилище — в SQLite (по умолчанию) или в key-value сервере
+с протоколом RESP (Redis, KeyDB, Valkey или bench/fake_kv.py).
+
+Загрузка ленивая: сессия пользователя читается, только когда приходит его
+апдейт. Запись групповая: изменения параллельно обрабатываемых апдейтов
+собираются за flush_delay и уходят одной транзакцией (SQLite) или одним
+конвейером команд (KV), а обработчик ждёт подтверждения записи, поэтому
+следующий апдейт, попавший на другой экземпляр, увидит новое состояние.
+
+Значения сессии должны сериализоваться в JSON.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SESSION_SECONDS = REGISTRY.histogram(
+    "bot_session_operation_seconds", "Загрузка и запись сессий во внешнем хранилище", ("operation",)
+)
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class SessionStore:
+    """Хранилище сессий: словарь по строковому ключу"""
+
+    async def load_many(self, keys: list) -> dict:
+        """key → данные сессии для найденных ключей"""
+        raise NotImplementedError
+
+    async def save_many(self, items: dict):
+        """Запись нескольких сессий одной операцией"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """Сессии в таблице sessions основной базы бота"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def load_many(self, keys: list) -> dict:
+        rows = await self.storage.sessions_get(keys)
+        return {key: json.loads(data) for key, data in rows.items()}
+
+    async def save_many(self, items: dict):
+        await self.storage.sessions_put({key: _dumps(data) for key, data in items.items()})
+
+
+# ---------- key-value сервер ----------
+
+class KVError(Exception):
+    """Ошибка, которую вернул key-value сервер"""
+
+
+class KVClient:
+    """Минимальный асинхронный клиент RESP: одно соединение, команды конвейером"""
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        # Ответы RESP приходят по порядку: конвейеры не должны перемешиваться
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            await self._roundtrip(setup)
+
+    @staticmethod
+    def _encode(command: tuple) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            value = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("key-value сервер закрыл соединение")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return KVError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise KVError(f"неизвестный ответ RESP: {line!r}")
+
+    async def _roundtrip(self, commands: list) -> list:
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        return [await asyncio.wait_for(self._read_reply(), self.timeout) for _ in commands]
+
+    async def pipeline(self, commands: list) -> list:
+        """Выполнение команд одним конвейером; ответы в том же порядке"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    replies = await self._roundtrip(commands)
+                    break
+                except (ConnectionError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    # Соединение могло устареть — одна попытка с новым
+                    await self._disconnect()
+                    if attempt:
+                        raise
+        for reply in replies:
+            if isinstance(reply, KVError):
+                raise reply
+        return replies
+
+    async def execute(self, *command):
+        return (await self.pipeline([command]))[0]
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._reader = self._writer = None
+
+    async def close(self):
+        async with self._lock:
+            await self._disconnect()
+
+
+class KVSessionStore(SessionStore):
+    """Сессии в key-value сервере с истечением через ttl секунд"""
+
+    def __init__(self, url: str, ttl: int = 0, prefix: str = "session:"):
+        self.client = KVClient(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def load_many(self, keys: list) -> dict:
+        values = await self.client.execute("MGET", *(self.prefix + key for key in keys))
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    async def save_many(self, items: dict):
+        expiry = ("EX", self.ttl) if self.ttl else ()
+        await self.client.pipeline([
+            ("SET", self.prefix + key, _dumps(data), *expiry) for key, data in items.items()
+        ])
+
+    async def close(self):
+        await self.client.close()
+
+
+# ---------- сессии ----------
+
+class Sessions:
+    """Ленивая загрузка и групповая запись сессий.
+
+    shared=True — за вебхуком несколько экземпляров бота: сессия читается
+    из хранилища на каждый апдейт. Иначе прочитанные сессии кэшируются
+    в памяти (до cache_size), и хранилище читается только после перезапуска.
+    """
+
+    def __init__(self, store: SessionStore, shared: bool = False, flush_delay: float = 0.005,
+                 cache_size: int = 50000):
+        self.store = store
+        self.shared = shared
+        self.flush_delay = flush_delay
+        self._cache_limit = cache_size
+        self.cache_size = 0 if shared else cache_size
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._pending = None
+        self._flusher = None
+        self.loads = 0
+        self.saves = 0
+        self.flushes = 0
+
+    def set_shared(self, shared: bool):
+        """Смена режима до первой загрузки сессий (например, по аргументам запуска)"""
+        self.shared = shared
+        self.cache_size = 0 if shared else self._cache_limit
+        if shared:
+            self._cache.clear()
+
+    def _remember(self, key: str, data: dict):
+        if not self.cache_size:
+            return
+        self._cache[key] = data
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def load(self, keys: list) -> dict:
+        """key → копия данных сессии (пустой словарь для новой)"""
+        result = {}
+        missing = []
+        for key in keys:
+            if key in self._dirty:
+                result[key] = dict(self._dirty[key])
+            elif key in self._cache:
+                self._cache.move_to_end(key)
+                result[key] = dict(self._cache[key])
+            else:
+                missing.append(key)
+        if missing:
+            self.loads += 1
+            started = time.perf_counter()
+            try:
+                with span("session.load"):
+                    found = await self.store.load_many(missing)
+            finally:
+                SESSION_SECONDS.observe(time.perf_counter() - started, operation="load")
+            for key in missing:
+                data = found.get(key, {})
+                self._remember(key, data)
+                result[key] = dict(data)
+        return result
+
+    async def save(self, items: dict):
+        """Запись изменённых сессий; возвращается после фиксации в хранилище"""
+        for key, data in items.items():
+            data = dict(data)
+            self._dirty[key] = data
+            self._remember(key, data)
+        self.saves += len(items)
+        if self._pending is None:
+            self._pending = asyncio.get_running_loop().create_future()
+            self._flusher = asyncio.create_task(self._flush_after_delay())
+        with span("session.save"):
+            await asyncio.shield(self._pending)
+
+    async def update(self, key: str, **values):
+        """Изменение отдельных полей сессии вне обработчика апдейта"""
+        data = (await self.load([key]))[key]
+        if all(data.get(name) == value for name, value in values.items()):
+            return
+        data.update(values)
+        await self.save({key: data})
+
+    async def _flush_after_delay(self):
+        # Задержка собирает в одну запись изменения параллельных апдейтов
+        await asyncio.sleep(self.flush_delay)
+        batch, self._dirty = self._dirty, {}
+        future, self._pending = self._pending, None
+        started = time.perf_counter()
+        try:
+            await self.store.save_many(batch)
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи сессий ({len(batch)}): {e}")
+            future.set_exception(e)
+        else:
+            future.set_result(len(batch))
+        finally:
+            self.flushes += 1
+            SESSION_SECONDS.observe(time.perf_counter() - started, operation="save")
+
+    async def close(self):
+        """Дожидается последней записи и закрывает хранилище"""
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.store.close()
@@ -0,0 +1,1469 @@
+"""Хранилище бота на SQLite.
+
+Одно долгоживущее соединение в режиме WAL обслуживается выделенным потоком:
+все запросы выполняются там, а событийный цикл только ждёт результат.
+SQL-тексты постоянные, поэтому подготовленные выражения берутся из кэша
+соединения (cached_statements) и не компилируются заново.
+
+Записи группируются: изменения баланса выполняются сразу внутри открытой
+транзакции, строки журнала transactions копятся в буфере, и всё вместе
+фиксируется одним COMMIT раз в flush_interval секунд или по накоплении
+flush_rows строк. Платежи фиксируются немедленно. Балансы кэшируются в памяти,
+поэтому чтение баланса не требует обращения к базе.
+
+Списание за генерацию идёт через резерв (holds): reserve() одним условным
+UPDATE уменьшает баланс и создаёт резерв, commit_hold() превращает его
+в транзакцию spend, release_hold() возвращает генерацию на баланс.
+
+Очередь генераций (jobs) общая для всех процессов бота: веб-процесс ставит
+задачи, воркеры забирают их с арендой (lease) и продлевают её, пока работают.
+Задача с истёкшей арендой (воркер упал) достаётся другому воркеру. Изменения
+очереди фиксируются сразу, чтобы их видели другие процессы. Отмена задачи
+(request_cancel) снимает её из очереди, а для выполняющейся ставит
+cancel_requested — его видит воркер, опрашивающий предсказание.
+
+Итоги для /stats (counters) и дневные срезы (daily_stats) обновляются
+инкрементально в той же транзакции, что и изменение баланса, поэтому
+статистика не сканирует журнал transactions. Завершённые задачи очереди
+сворачиваются в дневные срезы плановым обслуживанием (rollup_jobs).
+
+Журнал transactions не растёт бесконечно: строки старше срока хранения
+сворачиваются (compact_ledger) в итоги по пользователю, месяцу и типу
+(ledger_summaries) и снимок пользователя (ledger_snapshots — сумма
+и число свёрнутых строк), а сами строки уходят в сжатые файлы архива
+(ledger_archives хранит их диапазоны и sha256). Баланс сверяется как
+START_BALANCE + снимок + оставшиеся строки − активные резервы. Повторные
+платежи отсекаются таблицей processed_payments, которая не сворачивается.
+
+Рассылка (broadcasts) идёт по users в порядке id; курсор — id, до которого
+включительно все получатели обработаны, поэтому прерванная рассылка
+продолжается с него. Пользователи, заблокировавшие бота, помечаются
+blocked_at и в рассылку не попадают.
+
+Операции обслуживания (чекпойнт WAL, optimize, VACUUM, чистки) принимают
+крайний срок: до начала фиксируются накопленные изменения, а запрос,
+не уложившийся в срок, прерывается обработчиком прогресса SQLite
+и откатывает только собственную работу.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DB_SECONDS = REGISTRY.histogram(
+    "bot_db_operation_seconds",
+    "Длительность операций с базой, включая ожидание потока базы",
+    ("operation",),
+)
+
+START_BALANCE = 3
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # В WAL-режиме NORMAL не теряет целостность, fsync только на чекпойнтах
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+
+SCHEMA = (
+    # Таблица пользователей
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        balance INTEGER DEFAULT 3,
+        created_at TEXT
+    )
+    """,
+    # Таблица транзакций
+    """
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        type TEXT,
+        amount INTEGER,
+        payment_id TEXT UNIQUE,
+        created_at TEXT
+    )
+    """,
+    # Предсказания Replicate, результат которых ещё не пришёл вебхуком
+    """
+    CREATE TABLE IF NOT EXISTS pending_predictions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        prediction_id TEXT,
+        user_id INTEGER,
+        chat_id INTEGER,
+        reply_to INTEGER,
+        status_message_id INTEGER,
+        is_admin INTEGER,
+        created_at TEXT,
+        hold_id INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pending_prediction ON pending_predictions(prediction_id)",
+    # Резервы генераций: held → committed (списано) или released (возвращено)
+    """
+    CREATE TABLE IF NOT EXISTS holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount INTEGER,
+        status TEXT DEFAULT 'held',
+        created_at TEXT,
+        settled_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_holds_status ON holds(status, created_at)",
+    # Итоговые счётчики и дневные срезы для /stats
+    """
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER NOT NULL DEFAULT 0,
+        bought INTEGER NOT NULL DEFAULT 0,
+        spent INTEGER NOT NULL DEFAULT 0,
+        purchases INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    # Покрывающий индекс истории: последние строки пользователя без чтения таблицы
+    "CREATE INDEX IF NOT EXISTS idx_transactions_history ON transactions(user_id, id, type, amount, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(type, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at)",
+    # Кэш результатов: ключ запроса → file_id уже отправленного фото
+    """
+    CREATE TABLE IF NOT EXISTS result_cache (
+        key TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_used REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_result_cache_used ON result_cache(last_used)",
+    # Переводы описаний на английский: хэш описания → перевод, см. translation.py
+    """
+    CREATE TABLE IF NOT EXISTS translations (
+        key TEXT PRIMARY KEY,
+        translated TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        last_used REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_translations_used ON translations(last_used)",
+    # Последний известный статус подписки на канал; confirmed — пользователь
+    # хотя бы раз подтвердил подписку и больше не проверяется
+    """
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        user_id INTEGER PRIMARY KEY,
+        subscribed INTEGER NOT NULL,
+        confirmed INTEGER NOT NULL DEFAULT 0,
+        checked_at REAL NOT NULL
+    )
+    """,
+    # Очередь генераций: queued → running (под арендой воркера) → done/failed.
+    # seq — очерёдность внутри полосы priority для кругового обхода пользователей
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        seq INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'queued',
+        payload TEXT NOT NULL,
+        status_message_id INTEGER,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, priority DESC, seq, id)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs(status, lease_until)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, status)",
+    # Рассылки админа: running → done или stopped; курсор — последний обработанный users.id,
+    # аренда (lease) не даёт двум процессам вести одну рассылку
+    """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        from_chat_id INTEGER,
+        message_id INTEGER,
+        admin_chat_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        finished_at REAL
+    )
+    """,
+    # Обработанные платежи: отсечка повторов не зависит от свёртки журнала
+    """
+    CREATE TABLE IF NOT EXISTS processed_payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_processed_payments_user ON processed_payments(user_id)",
+    # Свёрнутый журнал: итоги по пользователю, месяцу (YYYY-MM) и типу
+    """
+    CREATE TABLE IF NOT EXISTS ledger_summaries (
+        user_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        type TEXT NOT NULL,
+        amount INTEGER NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, period, type)
+    ) WITHOUT ROWID
+    """,
+    # Снимок пользователя: сумма и число свёрнутых строк, последний свёрнутый transactions.id
+    """
+    CREATE TABLE IF NOT EXISTS ledger_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        amount INTEGER NOT NULL DEFAULT 0,
+        rows INTEGER NOT NULL DEFAULT 0,
+        through_id INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    # Файлы архива журнала: диапазон id, число строк, сумма и sha256 файла
+    """
+    CREATE TABLE IF NOT EXISTS ledger_archives (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file TEXT NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """,
+    # Состояние диалога (user_data, chat_data) в JSON, см. sessions.py
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        key TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+)
+
+COUNTERS = ("users", "total_balance", "bought", "spent", "purchases")
+
+# Пересчёт счётчиков и срезов по существующим данным (первый запуск после обновления)
+BACKFILL_COUNTERS = """
+    INSERT INTO counters (name, value)
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'total_balance', COALESCE(SUM(balance), 0) FROM users
+    UNION ALL SELECT 'bought', COALESCE(SUM(amount), 0) FROM transactions WHERE type='buy'
+    UNION ALL SELECT 'spent', COALESCE(-SUM(amount), 0) FROM transactions WHERE type='spend'
+    UNION ALL SELECT 'purchases', COUNT(*) FROM transactions WHERE type='buy'
+"""
+BACKFILL_DAILY = (
+    """
+    INSERT OR IGNORE INTO daily_stats (day) SELECT DISTINCT substr(created_at, 1, 10) FROM users
+    UNION SELECT DISTINCT substr(created_at, 1, 10) FROM transactions
+    """,
+    """
+    UPDATE daily_stats SET
+        new_users = (SELECT COUNT(*) FROM users WHERE substr(created_at, 1, 10) = day),
+        bought = (SELECT COALESCE(SUM(amount), 0) FROM transactions
+                  WHERE type='buy' AND substr(created_at, 1, 10) = day),
+        spent = (SELECT COALESCE(-SUM(amount), 0) FROM transactions
+                 WHERE type='spend' AND substr(created_at, 1, 10) = day),
+        purchases = (SELECT COUNT(*) FROM transactions
+                     WHERE type='buy' AND substr(created_at, 1, 10) = day)
+    """,
+)
+
+# Колонки, добавленные после первого выпуска таблицы: (таблица, колонка, тип)
+COLUMNS = (
+    ("pending_predictions", "hold_id", "INTEGER"),
+    ("pending_predictions", "cache_key", "TEXT"),
+    ("pending_predictions", "flight_key", "TEXT"),
+    ("jobs", "rolled_up", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "blocked_at", "REAL"),
+    ("jobs", "cancel_requested", "INTEGER NOT NULL DEFAULT 0"),
+    ("pending_predictions", "job_id", "INTEGER"),
+    ("daily_stats", "generations", "INTEGER NOT NULL DEFAULT 0"),
+    ("daily_stats", "failed", "INTEGER NOT NULL DEFAULT 0"),
+    ("daily_stats", "generation_seconds", "REAL NOT NULL DEFAULT 0"),
+)
+
+# Индексы по колонкам из COLUMNS создаются после миграции
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_pending_flight ON pending_predictions(flight_key)",
+    "CREATE INDEX IF NOT EXISTS idx_pending_job ON pending_predictions(job_id)",
+    # Заменён idx_transactions_history и processed_payments
+    "DROP INDEX IF EXISTS idx_transactions_user",
+)
+
+# Платежи, записанные до появления processed_payments
+BACKFILL_PAYMENTS = """
+    INSERT OR IGNORE INTO processed_payments (payment_id, user_id, amount, created_at)
+    SELECT payment_id, user_id, amount, created_at FROM transactions WHERE payment_id IS NOT NULL
+"""
+
+# Поля строки журнала в файле архива (по строке JSON на транзакцию)
+ARCHIVE_FIELDS = ("id", "user_id", "type", "amount", "payment_id", "created_at")
+
+# Поля задачи, сохраняемые вместе с ожидающим предсказанием
+PENDING_FIELDS = (
+    "user_id", "chat_id", "reply_to", "status_message_id", "is_admin", "hold_id", "cache_key", "flight_key",
+    "job_id",
+)
+
+SQL_SELECT_BALANCE = "SELECT balance FROM users WHERE id=?"
+SQL_INSERT_USER = "INSERT OR IGNORE INTO users (id, balance, created_at) VALUES (?, ?, ?)"
+SQL_ADD_BALANCE = "UPDATE users SET balance = balance + ? WHERE id=?"
+SQL_INSERT_TX = "INSERT INTO transactions (user_id, type, amount, payment_id, created_at) VALUES (?, ?, ?, ?, ?)"
+SQL_INSERT_PAYMENT = "INSERT INTO processed_payments (payment_id, user_id, amount, created_at) VALUES (?, ?, ?, ?)"
+SQL_IS_PAID = "SELECT 1 FROM processed_payments WHERE user_id=? LIMIT 1"
+SQL_RESERVE = "UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?"
+SQL_INSERT_HOLD = "INSERT INTO holds (user_id, amount, status, created_at) VALUES (?, ?, 'held', ?)"
+SQL_SETTLE_HOLD = "UPDATE holds SET status=?, settled_at=? WHERE id=? AND status='held'"
+SQL_SELECT_HOLD = "SELECT user_id, amount FROM holds WHERE id=?"
+SQL_BUMP_COUNTER = "UPDATE counters SET value = value + ? WHERE name=?"
+SQL_BUMP_DAY = {
+    column: f"INSERT INTO daily_stats (day, {column}) VALUES (?, ?) "
+            f"ON CONFLICT(day) DO UPDATE SET {column} = {column} + excluded.{column}"
+    for column in ("new_users", "bought", "spent", "purchases")
+}
+
+
+class Storage:
+    """Асинхронный доступ к базе бота через одно соединение"""
+
+    def __init__(self, path: str, flush_interval: float = 0.2, flush_rows: int = 100,
+                 cache_size: int = 50000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.cache_size = cache_size
+        self._conn = None
+        # Один поток — одно соединение: запросы выполняются строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._flusher = None
+        # Буфер строк transactions; трогается только из потока базы
+        self._tx_buffer = []
+        # Кэш балансов; трогается только из событийного цикла
+        self._balances = OrderedDict()
+        self.commits = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # Операции обслуживания учитываются под именем выполняемой функции
+        operation = (args[0] if func == self._maintain else func).__name__.lstrip("_")
+        started = time.perf_counter()
+        try:
+            with span(f"db.{operation}"):
+                return await loop.run_in_executor(self._executor, partial(func, *args))
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+    # ---------- жизненный цикл ----------
+
+    def _open(self):
+        # isolation_level=None: транзакции открываются явно через BEGIN
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("BEGIN")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        for table, column, decl in COLUMNS:
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        for statement in INDEXES:
+            conn.execute(statement)
+        if conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0] < len(COUNTERS):
+            conn.execute("DELETE FROM counters")
+            conn.execute(BACKFILL_COUNTERS)
+            for statement in BACKFILL_DAILY:
+                conn.execute(statement)
+            logger.info("📊 Счётчики статистики пересчитаны по журналу")
+        if conn.execute("SELECT 1 FROM processed_payments LIMIT 1").fetchone() is None:
+            conn.execute(BACKFILL_PAYMENTS)
+        conn.execute("COMMIT")
+        self._conn = conn
+
+    async def open(self):
+        """Открытие соединения и создание схемы"""
+        await self._run(self._open)
+        self._flusher = asyncio.create_task(self._flush_periodically())
+        logger.info("✅ База данных инициализирована")
+
+    def _close(self):
+        if self._conn is not None:
+            self._flush()
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+            self._conn = None
+
+    async def close(self):
+        """Сброс буфера и закрытие соединения"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+        logger.info(f"✅ База данных закрыта, коммитов за сессию: {self.commits}")
+
+    # ---------- групповая фиксация ----------
+
+    def _begin(self):
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN IMMEDIATE")
+
+    def _flush(self):
+        if self._tx_buffer:
+            self._begin()
+            self._conn.executemany(SQL_INSERT_TX, self._tx_buffer)
+            self._tx_buffer.clear()
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+            self.commits += 1
+
+    async def flush(self):
+        """Немедленная фиксация накопленных изменений"""
+        await self._run(self._flush)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._tx_buffer or self._conn.in_transaction:
+                try:
+                    await self._run(self._flush)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка групповой фиксации: {e}", exc_info=True)
+
+    # ---------- кэш балансов ----------
+
+    def _cache_balance(self, user_id: int, balance: int):
+        self._balances[user_id] = balance
+        self._balances.move_to_end(user_id)
+        if len(self._balances) > self.cache_size:
+            self._balances.popitem(last=False)
+
+    # ---------- счётчики ----------
+
+    def _bump(self, now: str, counters: dict, daily: dict):
+        """Инкремент итоговых счётчиков и дневного среза в текущей транзакции"""
+        for name, delta in counters.items():
+            if delta:
+                self._conn.execute(SQL_BUMP_COUNTER, (delta, name))
+        day = now[:10]
+        for column, delta in daily.items():
+            if delta:
+                self._conn.execute(SQL_BUMP_DAY[column], (day, delta))
+
+    def _bump_tx(self, now: str, tx_type: str, delta: int):
+        if tx_type == "buy":
+            self._bump(now, {"bought": delta, "purchases": 1}, {"bought": delta, "purchases": 1})
+        elif tx_type == "spend":
+            self._bump(now, {"spent": -delta}, {"spent": -delta})
+
+    # ---------- пользователи и баланс ----------
+
+    def _ensure_user(self, user_id: int, now: str):
+        self._begin()
+        if self._conn.execute(SQL_INSERT_USER, (user_id, START_BALANCE, now)).rowcount:
+            self._bump(now, {"users": 1, "total_balance": START_BALANCE}, {"new_users": 1})
+            logger.info(f"👤 Новый пользователь: {user_id}")
+
+    def _get_user(self, user_id: int):
+        row = self._conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()
+        if row:
+            return row[0]
+        self._ensure_user(user_id, datetime.now().isoformat())
+        return START_BALANCE
+
+    async def get_user(self, user_id: int):
+        """Получение баланса, новый пользователь создаётся автоматически"""
+        balance = self._balances.get(user_id)
+        if balance is not None:
+            self._balances.move_to_end(user_id)
+            self.cache_hits += 1
+            return balance
+
+        self.cache_misses += 1
+        balance = await self._run(self._get_user, user_id)
+        # Пока шёл запрос, баланс мог обновиться — свежее значение уже в кэше
+        if user_id not in self._balances:
+            self._cache_balance(user_id, balance)
+        return self._balances.get(user_id, balance)
+
+    def _update_balance(self, user_id: int, delta: int, tx_type: str, payment_id: str = None):
+        conn = self._conn
+        now = datetime.now().isoformat()
+        self._begin()
+
+        if payment_id is not None:
+            # Платёж: дубликат отсекается по processed_payments, фиксация сразу
+            conn.execute("SAVEPOINT payment")
+            try:
+                conn.execute(SQL_INSERT_PAYMENT, (payment_id, user_id, delta, now))
+                conn.execute(SQL_INSERT_TX, (user_id, tx_type, delta, payment_id, now))
+            except sqlite3.IntegrityError:
+                conn.execute("ROLLBACK TO payment")
+                conn.execute("RELEASE payment")
+                return None
+            if conn.execute(SQL_ADD_BALANCE, (delta, user_id)).rowcount:
+                self._bump(now, {"total_balance": delta}, {})
+            self._bump_tx(now, tx_type, delta)
+            conn.execute("RELEASE payment")
+            self._flush()
+        else:
+            if conn.execute(SQL_ADD_BALANCE, (delta, user_id)).rowcount:
+                self._bump(now, {"total_balance": delta}, {})
+            self._bump_tx(now, tx_type, delta)
+            self._tx_buffer.append((user_id, tx_type, delta, None, now))
+            if len(self._tx_buffer) >= self.flush_rows:
+                self._flush()
+
+        row = conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()
+        return row[0] if row else None
+
+    async def update_balance(self, user_id: int, delta: int, tx_type: str, payment_id: str = None):
+        """Изменение баланса с записью транзакции.
+
+        Платёж с payment_id фиксируется сразу; возвращает False, если
+        транзакция с таким payment_id уже есть.
+        """
+        balance = await self._run(self._update_balance, user_id, delta, tx_type, payment_id)
+        if balance is None:
+            if payment_id is not None:
+                return False
+        else:
+            self._cache_balance(user_id, balance)
+        logger.info(f"💰 Баланс обновлён: user={user_id}, delta={delta}, type={tx_type}")
+        return True
+
+    # ---------- резервы ----------
+
+    def _reserve(self, user_id: int, amount: int, parts: int):
+        conn = self._conn
+        now = datetime.now().isoformat()
+        self._ensure_user(user_id, now)
+        total = amount * parts
+        if conn.execute(SQL_RESERVE, (total, user_id, total)).rowcount == 0:
+            return None, conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()[0]
+        self._bump(now, {"total_balance": -total}, {})
+        hold_ids = [conn.execute(SQL_INSERT_HOLD, (user_id, amount, now)).lastrowid for _ in range(parts)]
+        return hold_ids, conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()[0]
+
+    async def reserve(self, user_id: int, amount: int = 1):
+        """Резерв генераций: id резерва или None, если баланса не хватает"""
+        hold_ids, balance = await self._run(self._reserve, user_id, amount, 1)
+        self._cache_balance(user_id, balance)
+        return hold_ids[0] if hold_ids else None
+
+    async def reserve_many(self, user_id: int, parts: int):
+        """Резерв нескольких генераций отдельными резервами по одной: все или ничего.
+
+        Каждый резерв списывается или возвращается сам по себе, поэтому
+        в журнале остаётся по строке spend на каждый доставленный вариант.
+        """
+        hold_ids, balance = await self._run(self._reserve, user_id, 1, parts)
+        self._cache_balance(user_id, balance)
+        return hold_ids
+
+    def _settle_hold(self, hold_id: int, status: str):
+        conn = self._conn
+        now = datetime.now().isoformat()
+        self._begin()
+        # Условный UPDATE: повторное или гонящееся завершение резерва ничего не меняет
+        if conn.execute(SQL_SETTLE_HOLD, (status, now, hold_id)).rowcount == 0:
+            return None
+        user_id, amount = conn.execute(SQL_SELECT_HOLD, (hold_id,)).fetchone()
+        if status == "committed":
+            self._bump_tx(now, "spend", -amount)
+            self._tx_buffer.append((user_id, "spend", -amount, None, now))
+            if len(self._tx_buffer) >= self.flush_rows:
+                self._flush()
+        else:
+            conn.execute(SQL_ADD_BALANCE, (amount, user_id))
+            self._bump(now, {"total_balance": amount}, {})
+        return user_id, conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()[0]
+
+    async def commit_hold(self, hold_id: int):
+        """Списание зарезервированных генераций"""
+        settled = await self._run(self._settle_hold, hold_id, "committed")
+        if settled:
+            logger.info(f"📉 Резерв {hold_id} списан у {settled[0]}")
+        return settled is not None
+
+    async def release_hold(self, hold_id: int):
+        """Возврат зарезервированных генераций на баланс"""
+        settled = await self._run(self._settle_hold, hold_id, "released")
+        if settled:
+            user_id, balance = settled
+            self._cache_balance(user_id, balance)
+            logger.info(f"↩️ Резерв {hold_id} возвращён пользователю {user_id}")
+        return settled is not None
+
+    def _release_stale_holds(self, max_age: float):
+        cutoff = datetime.fromtimestamp(datetime.now().timestamp() - max_age).isoformat()
+        # Резервы, ждущие вебхука Replicate, и резервы задач, которые ещё в очереди
+        # или выполняются (в том числе с истёкшей арендой), не трогаем
+        stale = self._conn.execute(
+            "SELECT id FROM holds WHERE status='held' AND created_at < ? "
+            "AND id NOT IN (SELECT hold_id FROM pending_predictions WHERE hold_id IS NOT NULL) "
+            "AND id NOT IN (SELECT value FROM jobs, json_each(jobs.payload, '$.holds') "
+            "WHERE jobs.status IN ('queued', 'running'))",
+            (cutoff,),
+        ).fetchall()
+        released = []
+        for (hold_id,) in stale:
+            settled = self._settle_hold(hold_id, "released")
+            if settled:
+                released.append(settled)
+        return released
+
+    async def release_stale_holds(self, max_age: float, deadline: float = None):
+        """Возврат резервов, зависших дольше max_age секунд"""
+        released = await self._run(self._maintain, self._release_stale_holds, deadline, max_age)
+        for user_id, balance in released:
+            self._cache_balance(user_id, balance)
+        if released:
+            logger.warning(f"↩️ Возвращено зависших резервов: {len(released)}")
+        return len(released)
+
+    async def is_paid_user(self, user_id: int):
+        """Покупал ли пользователь генерации"""
+        row = await self._run(self._fetchone, SQL_IS_PAID, (user_id,))
+        return row is not None
+
+    def _fetchone(self, sql: str, params: tuple = ()):
+        return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple = ()):
+        return self._conn.execute(sql, params).fetchall()
+
+    # ---------- статистика ----------
+
+    def _stats(self, days: int):
+        totals = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+        daily = self._conn.execute(
+            "SELECT day, new_users, bought, spent, purchases, generations, failed, generation_seconds "
+            "FROM daily_stats ORDER BY day DESC LIMIT ?",
+            (days,),
+        ).fetchall()
+        return {
+            **{name: totals.get(name, 0) for name in COUNTERS},
+            "days": daily,
+            "commits": self.commits,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    async def stats(self, days: int = 7):
+        """Сводная статистика для админа и срезы за последние days дней"""
+        return await self._run(self._stats, days)
+
+    # ---------- журнал ----------
+
+    def _history(self, user_id: int, limit: int):
+        # Строки из буфера ещё не в базе, но уже есть в балансе
+        buffered = [(tx_type, amount, created_at)
+                    for uid, tx_type, amount, _, created_at in reversed(self._tx_buffer) if uid == user_id]
+        rows = buffered[:limit] + self._conn.execute(
+            "SELECT type, amount, created_at FROM transactions WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, max(limit - len(buffered), 0)),
+        ).fetchall()
+        summaries = []
+        if len(rows) < limit:
+            summaries = self._conn.execute(
+                "SELECT period, type, amount, count FROM ledger_summaries WHERE user_id=? "
+                "ORDER BY period DESC, type DESC LIMIT ?",
+                (user_id, limit - len(rows)),
+            ).fetchall()
+        return rows, summaries
+
+    async def history(self, user_id: int, limit: int = 10):
+        """Последние limit операций пользователя и, если их меньше, итоги свёрнутых месяцев.
+
+        Оба запроса читают только покрывающие индексы, поэтому время
+        не зависит от размера журнала.
+        """
+        return await self._run(self._history, user_id, limit)
+
+    def _write_archive(self, path: str, rows: list):
+        data = gzip.compress(
+            "".join(json.dumps(dict(zip(ARCHIVE_FIELDS, row)), ensure_ascii=False) + "\n" for row in rows).encode()
+        )
+        # Файл целиком или никак: запись во временный, fsync, переименование
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return hashlib.sha256(data).hexdigest()
+
+    def _compact_ledger(self, before: str, archive_dir: str, batch: int, deadline: float):
+        conn = self._conn
+        os.makedirs(archive_dir, exist_ok=True)
+        compacted = files = 0
+        while deadline is None or time.monotonic() < deadline:
+            # Блокировка записи берётся до чтения: другой процесс не свернёт ту же пачку
+            self._begin()
+            rows = conn.execute(
+                f"SELECT {', '.join(ARCHIVE_FIELDS)} FROM transactions WHERE created_at < ? ORDER BY id LIMIT ?",
+                (before, batch),
+            ).fetchall()
+            if not rows:
+                break
+            first_id, last_id = rows[0][0], rows[-1][0]
+            # Имя файла определяется пачкой: после сбоя до COMMIT та же пачка перезапишет его
+            name = f"transactions-{first_id:012d}-{last_id:012d}.jsonl.gz"
+            digest = self._write_archive(os.path.join(archive_dir, name), rows)
+
+            summaries, snapshots = {}, {}
+            for tx_id, user_id, tx_type, amount, _, created_at in rows:
+                key = (user_id, (created_at or "")[:7], tx_type)
+                total, count = summaries.get(key, (0, 0))
+                summaries[key] = (total + amount, count + 1)
+                total, count, _ = snapshots.get(user_id, (0, 0, 0))
+                snapshots[user_id] = (total + amount, count + 1, tx_id)
+            conn.executemany(
+                "INSERT INTO ledger_summaries (user_id, period, type, amount, count) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, period, type) DO UPDATE SET "
+                "amount = amount + excluded.amount, count = count + excluded.count",
+                [key + value for key, value in summaries.items()],
+            )
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO ledger_snapshots (user_id, amount, rows, through_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET amount = amount + excluded.amount, "
+                "rows = rows + excluded.rows, through_id = excluded.through_id, updated_at = excluded.updated_at",
+                [(user_id, total, count, through_id, now) for user_id, (total, count, through_id) in snapshots.items()],
+            )
+            conn.executemany("DELETE FROM transactions WHERE id=?", [(row[0],) for row in rows])
+            conn.execute(
+                "INSERT INTO ledger_archives (file, first_id, last_id, rows, amount, sha256, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, first_id, last_id, len(rows), sum(row[3] for row in rows), digest, now),
+            )
+            self._flush()
+            compacted += len(rows)
+            files += 1
+        self._flush()
+        return compacted, files
+
+    async def compact_ledger(self, max_age: float, archive_dir: str, batch: int = 5000, deadline: float = None):
+        """Свёртка строк журнала старше max_age секунд в итоги и снимки с переносом в архив.
+
+        Идёт пачками по batch строк, каждая фиксируется отдельно, пока не истёк
+        deadline. Возвращает (свёрнуто строк, записано файлов).
+        """
+        before = datetime.fromtimestamp(time.time() - max_age).isoformat()
+        return await self._run(self._maintain, self._compact_ledger, deadline, before, archive_dir, batch, deadline)
+
+    def _verify_ledger(self, user_id: int):
+        conn = self._conn
+        balance = conn.execute(SQL_SELECT_BALANCE, (user_id,)).fetchone()
+        if balance is None:
+            return None
+        snapshot = conn.execute("SELECT amount, rows FROM ledger_snapshots WHERE user_id=?", (user_id,)).fetchone()
+        journal, rows = conn.execute(
+            "SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM transactions WHERE user_id=?", (user_id,)
+        ).fetchone()
+        journal += sum(row[2] for row in self._tx_buffer if row[0] == user_id)
+        held = conn.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM holds WHERE status='held' AND user_id=?", (user_id,)
+        ).fetchone()[0]
+        snapshot_amount, snapshot_rows = snapshot or (0, 0)
+        expected = START_BALANCE + snapshot_amount + journal - held
+        return {
+            "balance": balance[0],
+            "expected": expected,
+            "snapshot": snapshot_amount,
+            "snapshot_rows": snapshot_rows,
+            "journal": journal,
+            "journal_rows": rows,
+            "held": held,
+            "ok": balance[0] == expected,
+        }
+
+    async def verify_ledger(self, user_id: int):
+        """Сверка баланса с журналом: START_BALANCE + снимок + строки журнала − резервы"""
+        return await self._run(self._verify_ledger, user_id)
+
+    async def ledger_archives(self):
+        """Файлы архива журнала: (файл, строк, сумма, sha256)"""
+        return await self._run(
+            self._fetchall, "SELECT file, rows, amount, sha256 FROM ledger_archives ORDER BY id"
+        )
+
+    # ---------- ожидающие предсказания ----------
+
+    def _add_pending_prediction(self, prediction_id: str, fields: dict):
+        self._begin()
+        columns = ("prediction_id", "created_at") + PENDING_FIELDS
+        values = (prediction_id, datetime.now().isoformat()) + tuple(fields.get(name) for name in PENDING_FIELDS)
+        self._conn.execute(
+            f"INSERT INTO pending_predictions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            values,
+        )
+        self._flush()
+
+    async def add_pending_prediction(self, prediction_id: str, **fields):
+        """Сохранение задачи, ожидающей вебхука предсказания"""
+        await self._run(self._add_pending_prediction, prediction_id, fields)
+
+    def _attach_pending_prediction(self, fields: dict):
+        # Поиск и добавление в одной транзакции: вебхук не может забрать
+        # задачи предсказания между ними
+        self._begin()
+        row = self._conn.execute(
+            "SELECT prediction_id FROM pending_predictions WHERE flight_key=? LIMIT 1",
+            (fields["flight_key"],),
+        ).fetchone()
+        if row is None:
+            return None
+        self._add_pending_prediction(row[0], fields)
+        return row[0]
+
+    async def attach_pending_prediction(self, **fields):
+        """Присоединение задачи к уже запущенному предсказанию с тем же flight_key.
+
+        Возвращает id предсказания или None, если такого нет.
+        """
+        return await self._run(self._attach_pending_prediction, fields)
+
+    def _pop_pending_predictions(self, prediction_id: str):
+        conn = self._conn
+        self._begin()
+        rows = conn.execute(
+            f"SELECT {', '.join(PENDING_FIELDS)} FROM pending_predictions WHERE prediction_id=?",
+            (prediction_id,),
+        ).fetchall()
+        if rows:
+            conn.execute("DELETE FROM pending_predictions WHERE prediction_id=?", (prediction_id,))
+            self._flush()
+        return [dict(zip(PENDING_FIELDS, row)) for row in rows]
+
+    async def pop_pending_predictions(self, prediction_id: str):
+        """Извлечение и удаление задач, ожидающих данное предсказание"""
+        return await self._run(self._pop_pending_predictions, prediction_id)
+
+    # ---------- кэш результатов ----------
+
+    def _cache_get(self, key: str, ttl: float):
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT file_id, created_at FROM result_cache WHERE key=?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._begin()
+        if row[1] < now - ttl:
+            self._conn.execute("DELETE FROM result_cache WHERE key=?", (key,))
+            return None
+        self._conn.execute(
+            "UPDATE result_cache SET last_used=?, hits = hits + 1 WHERE key=?", (now, key)
+        )
+        return row[0]
+
+    async def cache_get(self, key: str, ttl: float):
+        """file_id закэшированного результата или None"""
+        return await self._run(self._cache_get, key, ttl)
+
+    def _cache_put(self, key: str, file_id: str):
+        now = time.time()
+        self._begin()
+        self._conn.execute(
+            "INSERT INTO result_cache (key, file_id, created_at, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET file_id=excluded.file_id, created_at=excluded.created_at, "
+            "last_used=excluded.last_used",
+            (key, file_id, now, now),
+        )
+
+    async def cache_put(self, key: str, file_id: str):
+        """Сохранение file_id результата"""
+        await self._run(self._cache_put, key, file_id)
+
+    def _cache_evict(self, max_entries: int, ttl: float):
+        self._begin()
+        expired = self._conn.execute(
+            "DELETE FROM result_cache WHERE created_at < ?", (time.time() - ttl,)
+        ).rowcount
+        # Сверх лимита удаляются давно не использованные записи
+        overflow = self._conn.execute(
+            "DELETE FROM result_cache WHERE key IN ("
+            "SELECT key FROM result_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        ).rowcount
+        return expired + overflow
+
+    async def cache_evict(self, max_entries: int, ttl: float, deadline: float = None):
+        """Удаление устаревших записей кэша и записей сверх лимита"""
+        return await self._run(self._maintain, self._cache_evict, deadline, max_entries, ttl)
+
+    async def result_cache_size(self):
+        """Количество записей в кэше результатов"""
+        return (await self._run(self._fetchone, "SELECT COUNT(*) FROM result_cache"))[0]
+
+    # ---------- переводы ----------
+
+    def _translation_get(self, key: str):
+        row = self._conn.execute("SELECT translated FROM translations WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._begin()
+        self._conn.execute("UPDATE translations SET last_used=? WHERE key=?", (time.time(), key))
+        return row[0]
+
+    async def translation_get(self, key: str):
+        """Сохранённый перевод описания или None"""
+        return await self._run(self._translation_get, key)
+
+    def _translation_put(self, key: str, translated: str):
+        now = time.time()
+        self._begin()
+        self._conn.execute(
+            "INSERT INTO translations (key, translated, created_at, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET translated=excluded.translated, last_used=excluded.last_used",
+            (key, translated, now, now),
+        )
+
+    async def translation_put(self, key: str, translated: str):
+        """Сохранение перевода"""
+        await self._run(self._translation_put, key, translated)
+
+    def _translation_evict(self, max_entries: int):
+        self._begin()
+        return self._conn.execute(
+            "DELETE FROM translations WHERE key IN ("
+            "SELECT key FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        ).rowcount
+
+    async def translation_evict(self, max_entries: int, deadline: float = None):
+        """Удаление давно не использованных переводов сверх max_entries"""
+        return await self._run(self._maintain, self._translation_evict, deadline, max_entries)
+
+    # ---------- подписка на канал ----------
+
+    async def subscription_get(self, user_id: int):
+        """(subscribed, confirmed, checked_at) для пользователя или None"""
+        row = await self._run(
+            self._fetchone,
+            "SELECT subscribed, confirmed, checked_at FROM subscriptions WHERE user_id=?",
+            (user_id,),
+        )
+        if row is None:
+            return None
+        return bool(row[0]), bool(row[1]), row[2]
+
+    def _subscription_put(self, user_id: int, subscribed: bool, confirmed: bool, checked_at: float):
+        self._begin()
+        # Подтверждение не снимается повторной проверкой
+        self._conn.execute(
+            "INSERT INTO subscriptions (user_id, subscribed, confirmed, checked_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET subscribed=excluded.subscribed, "
+            "confirmed=MAX(confirmed, excluded.confirmed), checked_at=excluded.checked_at",
+            (user_id, int(subscribed), int(confirmed), checked_at),
+        )
+
+    async def subscription_put(self, user_id: int, subscribed: bool, confirmed: bool, checked_at: float):
+        """Сохранение результата проверки подписки"""
+        await self._run(self._subscription_put, user_id, subscribed, confirmed, checked_at)
+
+    # ---------- сессии ----------
+
+    def _sessions_get(self, keys: list):
+        placeholders = ",".join("?" * len(keys))
+        return dict(self._conn.execute(f"SELECT key, data FROM sessions WHERE key IN ({placeholders})", keys))
+
+    async def sessions_get(self, keys: list):
+        """key → JSON сессии для найденных ключей"""
+        return await self._run(self._sessions_get, list(keys))
+
+    def _sessions_put(self, items: dict):
+        self._begin()
+        now = time.time()
+        self._conn.executemany(
+            "INSERT INTO sessions (key, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+            [(key, data, now) for key, data in items.items()],
+        )
+        # Сессию должны сразу увидеть другие процессы бота — фиксируем без ожидания
+        self._flush()
+
+    async def sessions_put(self, items: dict):
+        """Запись сессий (key → JSON) с немедленной фиксацией"""
+        await self._run(self._sessions_put, items)
+
+    # ---------- очередь генераций ----------
+
+    def _enqueue_job(self, user_id: int, priority: int, payload: str, max_size: int, max_per_user: int):
+        self._begin()
+        total, own = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(user_id=?), 0) FROM jobs WHERE status IN ('queued', 'running')",
+            (user_id,),
+        ).fetchone()
+        if total >= max_size:
+            return None, "очередь переполнена", total
+        if own >= max_per_user:
+            return None, "слишком много задач пользователя", total
+
+        # Следующая задача пользователя встаёт за его последней, первая — в начало
+        # текущего круга: так пользователи обслуживаются по очереди
+        own_last = self._conn.execute(
+            "SELECT MAX(seq) FROM jobs WHERE status='queued' AND priority=? AND user_id=?", (priority, user_id)
+        ).fetchone()[0]
+        if own_last is not None:
+            seq = own_last + 1
+        else:
+            seq = self._conn.execute(
+                "SELECT COALESCE(MIN(seq), 0) FROM jobs WHERE status='queued' AND priority=?", (priority,)
+            ).fetchone()[0]
+        job_id = self._conn.execute(
+            "INSERT INTO jobs (user_id, priority, seq, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, priority, seq, payload, time.time()),
+        ).lastrowid
+        position = self._conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status='queued' AND "
+            "(priority > ? OR (priority = ? AND (seq < ? OR (seq = ? AND id <= ?))))",
+            (priority, priority, seq, seq, job_id),
+        ).fetchone()[0]
+        self._flush()
+        return job_id, position, total + 1
+
+    async def enqueue_job(self, user_id: int, priority: bool, payload: str, max_size: int, max_per_user: int):
+        """Постановка задачи: (id, позиция с 1, задач в работе) или (None, причина отказа, ...)"""
+        return await self._run(self._enqueue_job, user_id, int(priority), payload, max_size, max_per_user)
+
+    def _claim_job(self, owner: str, lease: float):
+        self._begin()
+        now = time.time()
+        # Сначала задачи упавших воркеров (аренда истекла), затем очередь
+        row = self._conn.execute(
+            "SELECT id, user_id, payload, status_message_id, attempts, created_at FROM jobs "
+            "WHERE status='running' AND lease_until < ? ORDER BY lease_until LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            row = self._conn.execute(
+                "SELECT id, user_id, payload, status_message_id, attempts, created_at FROM jobs "
+                "WHERE status='queued' ORDER BY priority DESC, seq, id LIMIT 1"
+            ).fetchone()
+        if row is not None:
+            self._conn.execute(
+                "UPDATE jobs SET status='running', lease_owner=?, lease_until=?, attempts=attempts+1, "
+                "started_at=COALESCE(started_at, ?) WHERE id=?",
+                (owner, now + lease, now, row[0]),
+            )
+        queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status='queued'").fetchone()[0]
+        self._flush()
+        if row is None:
+            return None, queued
+        job = dict(zip(("id", "user_id", "payload", "status_message_id", "attempts", "created_at"), row))
+        job["attempts"] += 1
+        return job, queued
+
+    async def claim_job(self, owner: str, lease: float):
+        """Следующая задача под аренду воркера owner: (задача или None, длина очереди)"""
+        return await self._run(self._claim_job, owner, lease)
+
+    def _update_job(self, sql: str, params: tuple):
+        self._begin()
+        changed = self._conn.execute(sql, params).rowcount
+        self._flush()
+        return changed > 0
+
+    async def extend_job_lease(self, job_id: int, owner: str, lease: float):
+        """Продление аренды; False — задачу забрал другой воркер"""
+        return await self._run(
+            self._update_job,
+            "UPDATE jobs SET lease_until=? WHERE id=? AND lease_owner=? AND status='running'",
+            (time.time() + lease, job_id, owner),
+        )
+
+    async def finish_job(self, job_id: int, owner: str, status: str = "done"):
+        """Завершение задачи (done, failed или canceled)"""
+        return await self._run(
+            self._update_job,
+            "UPDATE jobs SET status=?, finished_at=?, lease_owner=NULL, lease_until=NULL "
+            "WHERE id=? AND lease_owner=?",
+            (status, time.time(), job_id, owner),
+        )
+
+    async def requeue_job(self, job_id: int, owner: str):
+        """Возврат прерванной задачи в очередь; попытка не засчитывается"""
+        return await self._run(
+            self._update_job,
+            "UPDATE jobs SET status='queued', lease_owner=NULL, lease_until=NULL, attempts=MAX(attempts-1, 0) "
+            "WHERE id=? AND lease_owner=? AND status='running'",
+            (job_id, owner),
+        )
+
+    def _set_job_message(self, job_id: int, message_id: int):
+        self._begin()
+        self._conn.execute("UPDATE jobs SET status_message_id=? WHERE id=?", (message_id, job_id))
+        status = self._conn.execute("SELECT status FROM jobs WHERE id=?", (job_id,)).fetchone()
+        self._flush()
+        return status[0] if status else None
+
+    async def set_job_message(self, job_id: int, message_id: int):
+        """Сохранение сообщения о позиции; возвращает текущий статус задачи"""
+        return await self._run(self._set_job_message, job_id, message_id)
+
+    def _request_cancel(self, job_id: int, user_id: int):
+        conn = self._conn
+        self._begin()
+        row = conn.execute("SELECT status, user_id, payload FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if row is None or row[1] != user_id:
+            self._flush()
+            return None
+        status, _, payload = row
+        result = {"status": status, "payload": payload, "predictions": []}
+        if status == "queued":
+            conn.execute(
+                "UPDATE jobs SET status='canceled', finished_at=? WHERE id=? AND status='queued'", (time.time(), job_id)
+            )
+            self._flush()
+            return result
+        # Задача передана вебхуку Replicate: снимаются её строки ожидающих предсказаний,
+        # а само предсказание отменяется, только если его больше никто не ждёт
+        rows = conn.execute(
+            "SELECT prediction_id, hold_id FROM pending_predictions WHERE job_id=?", (job_id,)
+        ).fetchall()
+        if rows:
+            conn.execute("DELETE FROM pending_predictions WHERE job_id=?", (job_id,))
+            result["status"] = "pending"
+            for prediction_id, hold_id in rows:
+                shared = conn.execute(
+                    "SELECT 1 FROM pending_predictions WHERE prediction_id=? LIMIT 1", (prediction_id,)
+                ).fetchone()
+                result["predictions"].append((prediction_id, hold_id, shared is not None))
+        if status == "running":
+            conn.execute("UPDATE jobs SET cancel_requested=1 WHERE id=?", (job_id,))
+        self._flush()
+        return result
+
+    async def request_cancel(self, job_id: int, user_id: int):
+        """Отмена задачи пользователем user_id.
+
+        Возвращает None, если задачи нет или она чужая, иначе словарь: status —
+        queued (задача снята из очереди, резервы из payload надо вернуть),
+        pending (сняты ожидающие предсказания: predictions — (id, hold_id,
+        ждут ли его другие задачи)), running (воркеру выставлен
+        cancel_requested) или итоговый статус уже завершённой задачи.
+        """
+        return await self._run(self._request_cancel, job_id, user_id)
+
+    async def cancel_requested(self, job_id: int):
+        """Просил ли пользователь отменить задачу"""
+        row = await self._run(self._fetchone, "SELECT cancel_requested FROM jobs WHERE id=?", (job_id,))
+        return bool(row and row[0])
+
+    async def job_progress(self, job_id: int):
+        """(cancel_requested, status_message_id) выполняющейся задачи"""
+        row = await self._run(
+            self._fetchone, "SELECT cancel_requested, status_message_id FROM jobs WHERE id=?", (job_id,)
+        )
+        return (bool(row[0]), row[1]) if row else (False, None)
+
+    async def job_counts(self):
+        """Количество задач по статусам queued и running"""
+        rows = await self._run(
+            self._fetchall,
+            "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status",
+        )
+        return dict(rows)
+
+    async def recent_job_duration(self, limit: int = 50):
+        """Средняя длительность последних выполненных задач, секунды"""
+        row = await self._run(
+            self._fetchone,
+            "SELECT AVG(finished_at - started_at) FROM "
+            "(SELECT finished_at, started_at FROM jobs WHERE status='done' ORDER BY id DESC LIMIT ?)",
+            (limit,),
+        )
+        return row[0]
+
+    def _rollup_jobs(self):
+        self._begin()
+        # Под блокировкой записи: другие процессы не завершат задачу между чтением и пометкой
+        days = self._conn.execute(
+            "SELECT date(finished_at, 'unixepoch', 'localtime'), SUM(status='done'), SUM(status='failed'), "
+            "COALESCE(SUM(CASE WHEN status='done' THEN finished_at - started_at END), 0) "
+            "FROM jobs WHERE status IN ('done', 'failed') AND rolled_up=0 GROUP BY 1"
+        ).fetchall()
+        self._conn.executemany(
+            "INSERT INTO daily_stats (day, generations, failed, generation_seconds) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(day) DO UPDATE SET generations = generations + excluded.generations, "
+            "failed = failed + excluded.failed, "
+            "generation_seconds = generation_seconds + excluded.generation_seconds",
+            days,
+        )
+        # Отменённые задачи в срезы не попадают, но помечаются, чтобы их удалил purge_jobs
+        self._conn.execute(
+            "UPDATE jobs SET rolled_up=1 WHERE status IN ('done', 'failed', 'canceled') AND rolled_up=0"
+        )
+        return sum(done + failed for _, done, failed, _ in days)
+
+    async def rollup_jobs(self, deadline: float = None):
+        """Свёртка завершённых задач в дневные срезы; возвращает число задач"""
+        return await self._run(self._maintain, self._rollup_jobs, deadline)
+
+    def _purge_jobs(self, max_age: float):
+        self._begin()
+        return self._conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed', 'canceled') AND rolled_up=1 AND finished_at < ?",
+            (time.time() - max_age,),
+        ).rowcount
+
+    async def purge_jobs(self, max_age: float, deadline: float = None):
+        """Удаление свёрнутых завершённых задач старше max_age секунд"""
+        return await self._run(self._maintain, self._purge_jobs, deadline, max_age)
+
+    # ---------- рассылка ----------
+
+    def _create_broadcast(self, fields: dict):
+        self._begin()
+        if self._conn.execute("SELECT 1 FROM broadcasts WHERE status='running' LIMIT 1").fetchone():
+            return None
+        broadcast_id = self._conn.execute(
+            "INSERT INTO broadcasts (text, from_chat_id, message_id, admin_chat_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (fields.get("text"), fields.get("from_chat_id"), fields.get("message_id"),
+             fields.get("admin_chat_id"), time.time()),
+        ).lastrowid
+        self._flush()
+        return broadcast_id
+
+    async def create_broadcast(self, **fields):
+        """Новая рассылка (text или from_chat_id + message_id); None, если другая ещё идёт"""
+        return await self._run(self._create_broadcast, fields)
+
+    def _claim_broadcast(self, owner: str, lease: float):
+        self._begin()
+        now = time.time()
+        broadcast = self._fetch_dict(
+            "SELECT * FROM broadcasts WHERE status='running' "
+            "AND (lease_owner IS NULL OR lease_until < ? OR lease_owner=?) ORDER BY id LIMIT 1",
+            (now, owner),
+        )
+        if broadcast is None:
+            self._flush()
+            return None
+        self._conn.execute(
+            "UPDATE broadcasts SET lease_owner=?, lease_until=? WHERE id=?",
+            (owner, now + lease, broadcast["id"]),
+        )
+        self._flush()
+        return broadcast
+
+    async def claim_broadcast(self, owner: str, lease: float):
+        """Идущая рассылка без живой аренды — под аренду owner, или None"""
+        return await self._run(self._claim_broadcast, owner, lease)
+
+    async def broadcast_recipients(self, after_id: int, limit: int):
+        """Следующие limit незаблокированных пользователей с id больше after_id"""
+        rows = await self._run(
+            self._fetchall,
+            "SELECT id FROM users WHERE id > ? AND blocked_at IS NULL ORDER BY id LIMIT ?",
+            (after_id, limit),
+        )
+        return [user_id for (user_id,) in rows]
+
+    async def count_recipients(self, after_id: int = 0):
+        """Сколько незаблокированных пользователей с id больше after_id"""
+        row = await self._run(
+            self._fetchone, "SELECT COUNT(*) FROM users WHERE id > ? AND blocked_at IS NULL", (after_id,)
+        )
+        return row[0]
+
+    def _save_broadcast(self, broadcast_id: int, owner: str, progress: dict, lease: float, blocked_ids: list):
+        self._begin()
+        now = time.time()
+        self._conn.executemany(
+            "UPDATE users SET blocked_at=? WHERE id=? AND blocked_at IS NULL",
+            [(now, user_id) for user_id in blocked_ids],
+        )
+        self._conn.execute(
+            "UPDATE broadcasts SET cursor=?, sent=?, blocked=?, failed=?, lease_until=? "
+            "WHERE id=? AND lease_owner=?",
+            (progress["cursor"], progress["sent"], progress["blocked"], progress["failed"],
+             now + lease, broadcast_id, owner),
+        )
+        status = self._conn.execute("SELECT status FROM broadcasts WHERE id=?", (broadcast_id,)).fetchone()
+        self._flush()
+        return status[0] if status else None
+
+    async def save_broadcast(self, broadcast_id: int, owner: str, progress: dict, lease: float,
+                             blocked_ids: list = ()):
+        """Сохранение курсора и счётчиков, продление аренды, пометка заблокировавших бота.
+
+        Возвращает текущий статус рассылки (stopped — админ остановил её).
+        """
+        return await self._run(self._save_broadcast, broadcast_id, owner, progress, lease, list(blocked_ids))
+
+    async def release_broadcast(self, broadcast_id: int, owner: str, status: str = None):
+        """Снятие аренды; со status — завершение рассылки (done)"""
+        if status is None:
+            sql, params = (
+                "UPDATE broadcasts SET lease_owner=NULL, lease_until=NULL WHERE id=? AND lease_owner=?",
+                (broadcast_id, owner),
+            )
+        else:
+            sql, params = (
+                "UPDATE broadcasts SET status=?, finished_at=?, lease_owner=NULL, lease_until=NULL "
+                "WHERE id=? AND lease_owner=? AND status='running'",
+                (status, time.time(), broadcast_id, owner),
+            )
+        return await self._run(self._update_job, sql, params)
+
+    async def set_broadcast_status(self, old: str, new: str):
+        """Остановка (running → stopped) или возобновление (stopped → running) последней рассылки"""
+        return await self._run(
+            self._update_job,
+            "UPDATE broadcasts SET status=? WHERE id=(SELECT MAX(id) FROM broadcasts) AND status=?",
+            (new, old),
+        )
+
+    async def latest_broadcast(self):
+        """Последняя рассылка (словарь) или None"""
+        return await self._run(self._fetch_dict, "SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+
+    def _fetch_dict(self, sql: str, params: tuple = ()):
+        cursor = self._conn.execute(sql, params)
+        row = cursor.fetchone()
+        return None if row is None else dict(zip([column[0] for column in cursor.description], row))
+
+    def _set_blocked(self, user_id: int, blocked: bool):
+        # Проверка чтением: обычно менять нечего, и транзакция не открывается
+        row = self._conn.execute("SELECT blocked_at FROM users WHERE id=?", (user_id,)).fetchone()
+        if row is None or (row[0] is not None) == blocked:
+            return
+        self._begin()
+        self._conn.execute("UPDATE users SET blocked_at=? WHERE id=?", (time.time() if blocked else None, user_id))
+
+    async def mark_blocked(self, user_id: int):
+        """Пользователь заблокировал бота"""
+        await self._run(self._set_blocked, user_id, True)
+
+    async def unblock_user(self, user_id: int):
+        """Пользователь снова пишет боту — возвращается в рассылки"""
+        await self._run(self._set_blocked, user_id, False)
+
+    # ---------- обслуживание ----------
+
+    def _maintain(self, func, deadline: float, *args):
+        # Накопленные изменения фиксируются заранее: прерванная по сроку
+        # транзакция откатывает только работу обслуживания
+        self._flush()
+        if deadline is not None:
+            self._conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            result = func(*args)
+            self._flush()
+            return result
+        except Exception:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._conn.set_progress_handler(None, 0)
+
+    def _checkpoint(self):
+        busy, log, checkpointed = self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        # Журнал перенесён целиком — файл WAL можно обрезать, не дожидаясь писателей
+        truncated = not busy and log == checkpointed and log > 0
+        if truncated:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return log, checkpointed, truncated
+
+    async def checkpoint(self, deadline: float = None):
+        """Чекпойнт WAL: (страниц в журнале, перенесено, журнал обрезан)"""
+        return await self._run(self._maintain, self._checkpoint, deadline)
+
+    def _optimize(self):
+        self._conn.execute("PRAGMA optimize")
+
+    async def optimize(self, deadline: float = None):
+        """PRAGMA optimize: обновление статистики планировщика запросов"""
+        await self._run(self._maintain, self._optimize, deadline)
+
+    def _vacuum(self, min_free_ratio: float):
+        pages = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not pages or free / pages < min_free_ratio:
+            return pages, free, False
+        self._conn.execute("VACUUM")
+        return pages, free, True
+
+    async def vacuum(self, min_free_ratio: float, deadline: float = None):
+        """VACUUM, если свободных страниц не меньше min_free_ratio: (страниц, свободно, выполнен)"""
+        return await self._run(self._maintain, self._vacuum, deadline, min_free_ratio)
+
+    def _purge_sessions(self, max_age: float):
+        self._begin()
+        return self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age,)).rowcount
+
+    async def purge_sessions(self, max_age: float, deadline: float = None):
+        """Удаление сессий, не менявшихся дольше max_age секунд"""
+        return await self._run(self._maintain, self._purge_sessions, deadline, max_age)
+
+    def _expire_pending_predictions(self, max_age: float):
+        cutoff = datetime.fromtimestamp(time.time() - max_age).isoformat()
+        self._begin()
+        rows = self._conn.execute(
+            f"SELECT prediction_id, {', '.join(PENDING_FIELDS)} FROM pending_predictions WHERE created_at < ?",
+            (cutoff,),
+        ).fetchall()
+        if rows:
+            self._conn.execute("DELETE FROM pending_predictions WHERE created_at < ?", (cutoff,))
+        return [dict(zip(("prediction_id",) + PENDING_FIELDS, row)) for row in rows]
+
+    async def expire_pending_predictions(self, max_age: float, deadline: float = None):
+        """Извлечение задач, чей вебхук не пришёл за max_age секунд"""
+        return await self._run(self._maintain, self._expire_pending_predictions, deadline, max_age)
+
+
+def verify_archive_file(path: str, sha256: str) -> bool:
+    """Файл архива журнала на месте и совпадает с записанной контрольной суммой"""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest() == sha256
+    except FileNotFoundError:
+        return False
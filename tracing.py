@@ -0,0 +1,187 @@
+"""Трассировка апдейтов по этапам и профилирование по запросу.
+
+Трасса открывается на время обработки апдейта или задачи генерации и
+живёт в contextvars, поэтому этапы (span) внутри вложенных корутин
+попадают в свою трассу без передачи её явно. Вне трассы span ничего не
+делает. Медленные трассы пишутся одной JSON-строкой в лог "trace"
+с выборкой, чтобы не засорять лог при массовых задержках.
+
+Профилировщик снимает стеки потока событийного цикла через
+sys._current_frames() из отдельного потока, а tracemalloc за то же окно
+показывает, где выделялась память.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("trace")
+
+# Не больше стольких этапов в одной трассе: длинные задачи не раздувают память
+MAX_SPANS = 200
+
+# Кадры, в которых поток событийного цикла ждёт событий, а не работает
+IDLE_FRAMES = {"select", "poll", "epoll", "kqueue"}
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """Этапы одной обработки: имя, время начала, длительность"""
+
+    __slots__ = ("name", "attrs", "started", "spans", "dropped")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            "trace": self.name,
+            **self.attrs,
+            "duration_ms": round(duration * 1000, 1),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 1), "ms": round(elapsed * 1000, 1)}
+                for name, start, elapsed in self.spans
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+class Tracer:
+    """Открытие трасс и запись медленных в лог"""
+
+    def __init__(self, slow_threshold: float = 1.0, sample_rate: float = 1.0):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.slow = 0
+        self.logged = 0
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Трасса на время блока with"""
+        current = Trace(name, attrs)
+        token = _current.set(current)
+        try:
+            yield current
+        finally:
+            _current.reset(token)
+            self._finish(current, time.perf_counter() - current.started)
+
+    def _finish(self, current: Trace, duration: float):
+        if duration < self.slow_threshold:
+            return
+        self.slow += 1
+        if random.random() >= self.sample_rate:
+            return
+        self.logged += 1
+        logger.warning(json.dumps(current.to_dict(duration), ensure_ascii=False))
+
+
+@contextmanager
+def span(name: str):
+    """Этап текущей трассы; вне трассы ничего не делает"""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if len(current.spans) < MAX_SPANS:
+            current.spans.append((name, started - current.started, time.perf_counter() - started))
+        else:
+            current.dropped += 1
+
+
+# ---------- профилирование ----------
+
+def _frame_line(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+
+
+def _frame_function(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def profile(seconds: float, thread_id: int, interval: float = 0.005, top: int = 10) -> dict:
+    """Сэмплирование стеков потока thread_id и выделений памяти за seconds секунд.
+
+    Вызывается в отдельном потоке: профилируемый поток в это время работает как обычно.
+    """
+    own = Counter()
+    inclusive = Counter()
+    samples = idle = 0
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(10)
+    before = tracemalloc.take_snapshot()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples += 1
+            if frame.f_code.co_name in IDLE_FRAMES:
+                idle += 1
+            else:
+                own[_frame_line(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    key = _frame_function(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        inclusive[key] += 1
+                    frame = frame.f_back
+        time.sleep(interval)
+
+    after = tracemalloc.take_snapshot()
+    if started_tracemalloc:
+        tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    allocations = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+
+    return {
+        "seconds": seconds,
+        "samples": samples,
+        "busy": (samples - idle) / samples if samples else 0.0,
+        "own": own.most_common(top),
+        "inclusive": inclusive.most_common(top),
+        "allocations": [
+            (f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             stat.size_diff, stat.count_diff)
+            for stat in allocations[:top]
+        ],
+    }
+
+
+def format_profile(report: dict) -> str:
+    """Текстовый отчёт профилировщика для сообщения админу"""
+    samples = report["samples"] or 1
+    lines = [
+        f"🔬 Профиль за {report['seconds']:.0f}с: выборок {report['samples']}, "
+        f"цикл занят {report['busy']:.0%}",
+        "",
+        "🔥 Собственное время:",
+    ]
+    lines += [f"{count / samples:6.1%}  {key}" for key, count in report["own"]] or ["—"]
+    lines += ["", "📚 Включительное время:"]
+    lines += [f"{count / samples:6.1%}  {key}" for key, count in report["inclusive"]] or ["—"]
+    lines += ["", "🧠 Выделения памяти:"]
+    lines += [
+        f"{size / 1024:+9.1f} КБ {count:+6d}  {where}" for where, size, count in report["allocations"]
+    ] or ["—"]
+    return "\n".join(lines)
@@ -0,0 +1,189 @@
+"""Перевод описаний на английский перед генерацией.
+
+Модель лучше понимает английские описания, а пользователи пишут в основном
+по-русски. Перед генерацией описание с заметной долей кириллицы
+переводится; остальные уходят в модель как есть.
+
+Переводчик — блокирующий вызов (deep-translator ходит в Google Translate
+через requests), поэтому выполняется в своём небольшом пуле потоков. На
+перевод отводится бюджет: не уложился — генерация идёт с исходным текстом,
+а запоздавший перевод всё равно сохраняется и пригодится при следующем
+таком же описании.
+
+Описания часто повторяются, поэтому переводы кэшируются: небольшой LRU
+в памяти процесса перед таблицей translations в базе бота (её размер
+ограничивает плановое обслуживание). Для проверок без сети есть
+StubTranslator (TRANSLATOR=stub).
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+TRANSLATION_SECONDS = REGISTRY.histogram(
+    "bot_translation_seconds", "Перевод описания по исходу (cached, translated, timeout, error)", ("outcome",)
+)
+TRANSLATION_CACHE = REGISTRY.counter(
+    "bot_translation_cache_total", "Обращения к кэшу переводов", ("result",)
+)
+
+# Google Translate принимает до 5000 символов за запрос
+MAX_TEXT_LENGTH = 5000
+
+_LETTER = re.compile(r"[^\W\d_]")
+_CYRILLIC = re.compile(r"[а-яёіїєґў]", re.IGNORECASE)
+
+
+def needs_translation(text: str, min_share: float = 0.3) -> bool:
+    """Написано ли описание не по-английски: доля кириллицы среди букв не меньше min_share"""
+    letters = _LETTER.findall(text)
+    if not letters or len(text) > MAX_TEXT_LENGTH:
+        return False
+    return sum(1 for letter in letters if _CYRILLIC.match(letter)) / len(letters) >= min_share
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def translation_key(text: str) -> str:
+    """Ключ кэша: хэш описания с нормализованными пробелами"""
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+
+class GoogleTranslator:
+    """Google Translate через deep-translator; библиотека загружается при первом переводе"""
+
+    name = "google"
+
+    def __init__(self, target: str = "en"):
+        self.target = target
+        self._client = None
+
+    def translate(self, text: str) -> str:
+        if self._client is None:
+            from deep_translator import GoogleTranslator as Client
+            self._client = Client(source="auto", target=self.target)
+        return self._client.translate(text)
+
+
+class StubTranslator:
+    """Локальная заглушка для проверок: помечает текст и ждёт latency секунд"""
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def translate(self, text: str) -> str:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return f"[en] {text}"
+
+
+class PromptTranslator:
+    """Перевод описаний с бюджетом времени и двухуровневым кэшем"""
+
+    def __init__(self, storage, backend, budget: float = 1.5, memory_size: int = 1000,
+                 max_entries: int = 20000, workers: int = 2):
+        self.storage = storage
+        self.backend = backend
+        self.budget = budget
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="translate")
+        # Переводы, которые уже идут: одинаковые описания ждут один вызов
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def _remember(self, key: str, translated: str):
+        self._memory[key] = translated
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    async def _cached(self, key: str):
+        translated = self._memory.get(key)
+        if translated is not None:
+            self._memory.move_to_end(key)
+            return translated
+        translated = await self.storage.translation_get(key)
+        if translated is not None:
+            self._remember(key, translated)
+        return translated
+
+    def _start(self, key: str, text: str) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._inflight[key] = loop.run_in_executor(self._executor, self.backend.translate, text)
+            future.add_done_callback(lambda done: asyncio.ensure_future(self._store(key, done)))
+        return future
+
+    async def _store(self, key: str, future: asyncio.Future):
+        # Сохраняется и перевод, не уложившийся в бюджет
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        translated = future.result()
+        if not translated:
+            return
+        self._remember(key, translated)
+        try:
+            await self.storage.translation_put(key, translated)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить перевод: {e}")
+
+    async def translate(self, text: str) -> str:
+        """Описание на английском или исходный текст, если перевод не нужен или не удался"""
+        if not needs_translation(text):
+            return text
+        started = time.perf_counter()
+        key = translation_key(text)
+        with span("translate"):
+            translated = await self._cached(key)
+            if translated is not None:
+                self.hits += 1
+                TRANSLATION_CACHE.inc(result="hit")
+                TRANSLATION_SECONDS.observe(time.perf_counter() - started, outcome="cached")
+                return translated
+
+            self.misses += 1
+            TRANSLATION_CACHE.inc(result="miss")
+            try:
+                translated = await asyncio.wait_for(asyncio.shield(self._start(key, normalize(text))), self.budget)
+                outcome = "translated"
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                translated, outcome = None, "timeout"
+                logger.warning(f"⏱ Перевод не уложился в {self.budget:g}с, описание уходит как есть")
+            except Exception as e:
+                self.errors += 1
+                translated, outcome = None, "error"
+                logger.warning(f"⚠️ Ошибка перевода ({self.backend.name}): {e}")
+        TRANSLATION_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+        if translated:
+            logger.info(f"🌐 Описание переведено: {text[:40]}… → {translated[:40]}…")
+            return translated
+        return text
+
+    async def evict(self, deadline: float = None):
+        """Ограничение таблицы переводов max_entries записями (плановое обслуживание)"""
+        return await self.storage.translation_evict(self.max_entries, deadline)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)